@@ -8,8 +8,10 @@ HYPER_PARAMETERS_NC = dict(max_features="sqrt", n_estimators=1000, max_depth=5,
 
 HYPER_PARAMETERS_FC = dict(max_features="sqrt", n_estimators=1000, max_depth=10, bootstrap=True)
 
-PREPROCESSING_HYPERPARAMS = dict(rolling_window=7, fc_horizon=14, autoreg_lag=3, tile_id=2)
+# autoreg_lag is either the number of lags or an explicit list of lags, autoreg_windows are rolling means over previous values
+PREPROCESSING_HYPERPARAMS = dict(rolling_window=7, fc_horizon=14, autoreg_lag=3, autoreg_windows=[], tile_id=2)
 
 PATH_TO_MODELS = "./models"
+PATH_TO_WEATHER_FEATURES = "./data/weather_features"
 MODEL_TYPE = dict(nowcast="nowcast", forecast="forecast", auxiliary="auxiliary", preprocessor="preprocessor")
 MODEL_PREFIX = ""
@@ -1,13 +1,61 @@
+import numpy as np
 import pandas as pd
 from functools import reduce
 import datetime as dt
-from typing import Optional
+from typing import Iterator, Optional
 from sklearn.preprocessing import OrdinalEncoder
-from qtrees.constants import PREPROCESSING_HYPERPARAMS
-from qtrees.helper import get_logger
+from qtrees.constants import PREPROCESSING_HYPERPARAMS, PATH_TO_WEATHER_FEATURES
+from qtrees.helper import get_logger, read_sql
+from qtrees.weather_features import WEATHER_COLUMNS, WeatherFeatureStore, weather_source
+from qtrees.watering_features import WATERING_SOURCES, add_watering_features
 
 DATA_START_DATE = "2021-06-01"
-WEATHER_COLUMNS = ["wind_max_ms", "wind_avg_ms", "rainfall_mm", "temp_max_c", "temp_avg_c", "upm"]
+MONTH_COLUMNS = ["january", "february", "march", "april", "may", "june", "july", "august", "september", "october", "november", "december"]
+
+# Expands the next n_trees street trees after last_id to all days of the growing season inside the DB. The shading index of
+# the month is picked from public.shading_monthly, private tree data is joined for private runs only. Only the rows of one
+# page are sorted, the page itself is an index range scan on trees.id.
+TREE_DATES_QUERY = """
+WITH page AS (SELECT id, gattung, standalter FROM public.trees
+              WHERE street_tree = true AND id > %(last_id)s ORDER BY id LIMIT %(n_trees)s)
+SELECT trees.id AS tree_id, trees.gattung, trees.standalter, days.day AS timestamp, EXTRACT(MONTH FROM days.day)::int AS month,
+       {private_columns}(ARRAY[{month_columns}])[EXTRACT(MONTH FROM days.day)::int] AS shading_index
+FROM page AS trees
+CROSS JOIN (SELECT day::date FROM generate_series(%(start)s::date, %(end)s::date, interval '1 day') AS day
+            WHERE EXTRACT(MONTH FROM day) BETWEEN 4 AND 10) AS days
+LEFT JOIN public.shading_monthly AS shading ON shading.tree_id = trees.id
+{private_join}
+ORDER BY trees.id, days.day
+"""
+
+# Compact schema of the frames returned by DataLoader, kept through preprocessing: categories for ids and strings, int8 for
+# small integer keys, nullable Int64 for BIGINT ids, which float32 cannot hold exactly beyond 2^24, and float32 for all
+# numeric features, the precision the tree models of sklearn compute in anyway
+CATEGORY_COLUMNS = ["tree_id", "gattung", "standalter", "baumscheibe_m2", "baumscheibe_surface"]
+INT8_COLUMNS = ["type_id", "month"]
+INT64_COLUMNS = ["site_id"]
+FLOAT32_COLUMNS = ["value", "shading_index", "water_sga", "water_gdk", "ghi_sum_whm2"] + WEATHER_COLUMNS
+
+
+def compact_dtypes(X):
+    '''Casts the columns of X that are part of the compact schema, columns that are already compact or unknown are kept as they are'''
+    dtypes = {}
+    for col in X.columns:
+        if col in CATEGORY_COLUMNS and not isinstance(X[col].dtype, pd.CategoricalDtype):
+            dtypes[col] = "category"
+        elif col in INT8_COLUMNS and X[col].dtype != np.int8 and X[col].notna().all():
+            dtypes[col] = np.int8
+        elif col in INT64_COLUMNS and X[col].dtype != "Int64":
+            dtypes[col] = "Int64"
+        elif col in FLOAT32_COLUMNS and X[col].dtype != np.float32:
+            dtypes[col] = np.float32
+    return X.astype(dtypes) if len(dtypes) > 0 else X
+
+
+def pg_text_array(values):
+    '''Postgres array literal of values, to be bound as one parameter and cast with ::text[] instead of one parameter per value'''
+    return "{" + ",".join('"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for value in values) + "}"
+
 
 class DataLoader:
     """
@@ -32,6 +80,8 @@ class DataLoader:
         Which chunk of data to download
     logger : Logger
        Gives error messages if the data download breaks
+    weather_store : WeatherFeatureStore
+       Incrementally updated rolling weather features, each source is updated from the DB once per DataLoader
 
 
     Methods
@@ -43,9 +93,13 @@ class DataLoader:
     download_training_data(self, forecast, public_run: bool = False):
         Downloads all available training data. Necessarily has sensors and no specific date. If filtering should occur, it has to happen at a later point. Note that initial
         filtering of the data is already done when writing it to the DB
+    iter_inference_batches(date: dt.date, batch_size: int, forecast: bool = False, public_run: bool = False):
+        Yields inference data for consecutive batches of street trees, paged by tree id.
+    stream_inference_data(self, forecast, public_run: bool = False, chunksize: int = 500000):
+        Streams tree data without sensors for every day of the growing season in chunks. The tree x date expansion is done in the DB.
     """
     
-    def __init__(self, engine, logger=None):
+    def __init__(self, engine, logger=None, weather_features_path=PATH_TO_WEATHER_FEATURES):
         """
         Constructs all the necessary attributes for DataLoader.
 
@@ -55,8 +109,12 @@ class DataLoader:
                 Engine for connecting to the SQL DB. Created via the sqlalchemy.create_engine function
             logger : Logger, optional
                 A logger for writing error messages. If none is provided, the function creates one
+            weather_features_path : str, optional
+                Directory of the stored rolling weather features
         """
         self.engine = engine
+        self.weather_store = WeatherFeatureStore(engine, path=weather_features_path)
+        self._updated_weather_sources = set()
         if logger is None:
             self.logger = get_logger(__name__)
         else:
@@ -148,6 +206,101 @@ class DataLoader:
         data = data.merge(self._get_weather_measurements(), how="left", left_on="timestamp", right_index=True)
         return data
 
+    def iter_inference_batches(self, date: dt.date, batch_size: int, forecast: bool = False, public_run: bool = False) -> Iterator[pd.DataFrame]:
+        """
+        Iterates over inference data batch by batch
+
+        Yields the same data as download_nowcast_inference_data or download_forecast_inference_data for consecutive batches of street trees.
+        Batches are paged with a keyset on trees.id, so every batch is an index range scan that continues after the last tree id of the previous
+        batch instead of skipping all earlier rows with OFFSET. The number of trees does not need to be known in advance.
+        Parameters
+        ----------
+        date : Datetime.date
+            Gives the day for which inference data is downloaded if there is any
+        batch_size: int
+            Number of trees per batch
+        forecast: bool, optional
+            If True, yields forecast inference data without weather data
+        public_run : bool, optional
+            If True, uses only publicly available data
+
+        Yields
+        -------
+        pandas.Dataframe
+            Dataframe with columns for metadata for each tree of the batch, plus weather data for nowcasts
+        """
+        self.forecast = forecast
+        self.date = date
+        self.public_run = public_run
+        self.batch_size = batch_size
+        self.batch_num = None
+        self.with_sensors = False
+        weather = None if self.forecast else self._get_weather_measurements()
+        last_id = ""
+        while True:
+            trees = self._read_trees("SELECT id,gattung,standalter FROM public.trees WHERE street_tree = true AND id > %s ORDER BY id LIMIT %s",
+                                     params=(last_id, batch_size))
+            if trees.shape[0] == 0:
+                return
+            last_id = trees["tree_id"].iloc[-1]
+            data = self._add_tree_data(trees)
+            if weather is not None:
+                data = data.merge(weather, how="left", left_on="timestamp", right_index=True)
+            yield data
+
+    def stream_inference_data(self, forecast: bool, public_run: bool = False, chunksize: int = 500000) -> Iterator[pd.DataFrame]:
+        """
+        Streams inference data for all street trees and all days of the growing season
+
+        Same data as the inference downloaders without a date, but the cross join of trees and days, the shading index of the month and the
+        private tree data are computed in PostgreSQL. Every chunk is one query for the next page of trees, paged with a keyset on trees.id as in
+        iter_inference_batches, so neither the client nor the DB ever holds or sorts the full tree x date grid.
+        Parameters
+        ----------
+        forecast: bool
+            If True, streams data for a forecasting model, i.e. including the forecast horizon but without watering and weather data
+        public_run : bool
+            If True, uses only publicly available data
+        chunksize: int, optional
+            Maximum number of rows per chunk, rounded down to whole trees
+
+        Yields
+        -------
+        pandas.Dataframe
+            Dataframe with columns for metadata for each tree and day, plus watering and weather data for nowcasts
+        """
+        self.forecast = forecast
+        self.date = None
+        self.public_run = public_run
+        self.batch_size = None
+        self.with_sensors = False
+        weather = None if self.forecast else self._get_weather_measurements()
+        dates = self._growing_season_dates()
+        query = TREE_DATES_QUERY.format(
+            private_columns="" if self.public_run else "trees_private.baumscheibe_m2, trees_private.baumscheibe_surface, ",
+            private_join="" if self.public_run else "LEFT JOIN private.trees_private ON trees_private.tree_id = trees.id",
+            month_columns=", ".join(f"shading.{month}" for month in MONTH_COLUMNS))
+        params = {"start": dates[0].date(), "end": dates[-1].date(), "n_trees": max(chunksize // len(dates), 1), "last_id": ""}
+        while True:
+            try:
+                chunk = read_sql(self.engine, query, params=params)
+                if chunk.shape[0] == 0:
+                    return
+                params["last_id"] = chunk["tree_id"].iloc[-1]
+                chunk["timestamp"] = pd.to_datetime(chunk["timestamp"]).dt.tz_localize("UTC")
+                chunk["standalter"] = pd.cut(chunk["standalter"], bins=[0, 3, 10, 100], labels=["jung", "mittel", "alt"])
+                if not self.public_run:
+                    chunk["baumscheibe_m2"] = pd.cut(chunk["baumscheibe_m2"], bins=[0, 5, 100], labels=["klein", "groß"])
+                    if not self.forecast:
+                        chunk = self._add_watering(chunk)
+                chunk = compact_dtypes(chunk)
+            except Exception as e:
+                self.logger.error("Failed to stream tree data from DB: %s", e)
+                exit(121)
+            if weather is not None:
+                chunk = chunk.merge(weather, how="left", left_on="timestamp", right_index=True)
+            yield chunk
+
     def _download_data(self, with_sensors: bool = True) -> pd.DataFrame:
         """
         Downloads data and gets called by inference or training data downloader
@@ -168,82 +321,39 @@ class DataLoader:
         if self.with_sensors:
             self.date = None
         # Select all trees
+        if self.batch_size is None:
+            trees = self._read_trees("SELECT id,gattung,standalter FROM public.trees WHERE street_tree = true")
+        else:
+            trees = self._read_trees("SELECT id,gattung,standalter FROM public.trees WHERE street_tree = true ORDER BY id LIMIT %s OFFSET %s",
+                                     params=(self.batch_size, self.batch_size*self.batch_num))
+            if trees.shape[0] == 0:
+                return None
+        data = self._add_tree_data(trees)
+        return data
+
+    def _read_trees(self, query, params=None):
+        '''Reads tree metadata with the given query and bins the tree age'''
         try:
-            if self.batch_size is None:
-                trees = pd.read_sql("SELECT id,gattung,standalter FROM public.trees WHERE street_tree = true", self.engine.connect())
-            else:
-                trees = pd.read_sql("SELECT id,gattung,standalter FROM public.trees WHERE street_tree = true ORDER BY id LIMIT %s OFFSET %s",
-                                    self.engine.connect(), params=(self.batch_size, self.batch_size*self.batch_num))
-                if trees.shape[0] == 0:
-                    return None
+            trees = read_sql(self.engine, query, params=params)
             trees.rename(columns={"id": "tree_id"}, inplace=True)
             trees["standalter"] = pd.cut(trees["standalter"], bins=[0, 3, 10, 100], labels=["jung", "mittel", "alt"])
+            trees = compact_dtypes(trees)
         except Exception as e:
             self.logger.error("Failed to read trees from DB: %s", e)
             exit(121)
-        data = self._add_tree_data(trees)
-        return data
-
+        return trees
 
     def _add_tree_data(self, subset):
         '''Adds sensor data, waterings and shading index to the metadata of each tree. Subsets the data such that only trees remain where there are sensors. Watering is split into Gieß-den-Kiez (gdk) and Grünflächenämter (sga)'''
-        def get_sensors(trees):
-            tree_ids = tuple(subset.tree_id.unique())
-            placeholders = ', '.join(['%s'] * len(tree_ids))
-
-            data = pd.read_sql(f"SELECT tree_id, type_id, timestamp, value FROM private.sensor_measurements WHERE tree_id IN ({placeholders})",
-                               self.engine.connect(), params=tree_ids)
-            tree_devices = pd.read_sql(f"SELECT tree_id, site_id FROM private.tree_devices WHERE tree_id IN ({placeholders})",
-                                       self.engine.connect(), params=tree_ids)
-            if not data.empty:
-                data = data.assign(month=data.timestamp.dt.month)
-                data = reduce(lambda left, right: pd.merge(left, right, on="tree_id",
-                                                           how='left'), [data, trees, tree_devices])
-            return data
-        
-        def get_watering(relevant_trees):
-            placeholders = ', '.join(['%s'] * len(relevant_trees))
-            water_sga = pd.read_sql(f"SELECT * FROM private.watering_sga WHERE tree_id IN ({placeholders})", self.engine.connect(), params=relevant_trees)
-            water_gdk = pd.read_sql(f"SELECT * FROM private.watering_gdk WHERE tree_id IN ({placeholders})", self.engine.connect(), params=relevant_trees)
-            watered_trees = pd.Series(list(set(water_sga.tree_id).union(set(water_gdk.tree_id))), name="tree_id")
-            # Only get last 8 days if we don't take the sensors
-            if self.date is None:
-                dates = pd.date_range(DATA_START_DATE, pd.Timestamp("today"), tz="UTC")
-                dates = dates[dates.month.isin(range(4, 11))]
-                water = pd.DataFrame({"timestamp": dates})
-            else:
-                water = pd.DataFrame({"timestamp": pd.date_range(self.date - dt.timedelta(days=PREPROCESSING_HYPERPARAMS['rolling_window'] + 1), self.date, tz="UTC")})
-            water = water.merge(watered_trees, "cross").assign(temp=0)
-            for source, name in zip([water_sga, water_gdk], ["water_sga", "water_gdk"]):
-                source["date"] = source["date"].astype('datetime64[ns, UTC]')
-                source.rename(columns={"amount_liters": name, "date": "timestamp"}, inplace=True)
-            water = reduce(lambda left, right: pd.merge(left, right, on=["tree_id", "timestamp"],
-                                                        how='left'), [water, water_sga, water_gdk])
-            water = water.drop(columns="temp")
-            water = water.fillna(0)
-            grpd = water.groupby(["tree_id"])
-            water[["water_sga", "water_gdk"]] = grpd[["water_sga", "water_gdk"]].transform(lambda x: x.rolling(PREPROCESSING_HYPERPARAMS['rolling_window'], min_periods=1).sum())
-            return water
-
-        def get_shading_index(relevant_trees):
-            placeholders = ', '.join(['%s'] * len(relevant_trees))
-            monthly_shading = pd.read_sql(f"SELECT * FROM public.shading_monthly WHERE tree_id IN ({placeholders})", self.engine.connect(), params=relevant_trees)
-            shading_long = pd.melt(monthly_shading, id_vars="tree_id")
-            month_mapping = dict((v, k) for v, k in zip(shading_long.variable.unique(), range(1, 13)))
-            shading_long = shading_long.assign(month=[month_mapping[el] for el in shading_long.variable])
-            shading_long.drop(columns="variable", inplace=True)
-            shading_long.rename(columns={"value": "shading_index"}, inplace=True)
-            return shading_long
         try:
             if self.with_sensors:
-                trees = get_sensors(subset)
+                trees = self._get_sensors(subset)
                 if trees.empty:
                     return trees
             else:
                 trees = subset
                 if self.date is None:
-                    dates = pd.date_range(DATA_START_DATE, pd.Timestamp("today") + pd.Timedelta(days=PREPROCESSING_HYPERPARAMS['fc_horizon'] if self.forecast else 0), tz="UTC")
-                    dates = dates[dates.month.isin(range(4, 11))].to_series(name="timestamp")
+                    dates = self._growing_season_dates().to_series(name="timestamp")
                     trees = trees.merge(dates, how="cross")
                 else:
                     trees = trees.assign(timestamp=self.date)
@@ -251,47 +361,73 @@ class DataLoader:
                 trees = trees.assign(month=trees.timestamp.dt.month)
             relevant_trees = tuple(trees.tree_id.unique())
             if not self.public_run:
-                trees_private = pd.read_sql("SELECT tree_id, baumscheibe_m2, baumscheibe_surface FROM private.trees_private", self.engine.connect())
+                trees_private = read_sql(self.engine, "SELECT tree_id, baumscheibe_m2, baumscheibe_surface FROM private.trees_private")
                 trees_private["baumscheibe_m2"] = pd.cut(trees_private["baumscheibe_m2"], bins=[0, 5, 100], labels=["klein", "groß"])
                 trees = trees.merge(trees_private, how="left", on="tree_id")
                 if not self.forecast:
-                    water = get_watering(relevant_trees)
-                    trees = trees.merge(water, how="left", on=["tree_id", "timestamp"])
-            shading = get_shading_index(relevant_trees)
+                    trees = self._add_watering(trees)
+            shading = self._get_shading_index(relevant_trees)
             trees = trees.merge(shading, how="left", on=["tree_id", "month"])
-            return trees
+            return compact_dtypes(trees)
         except Exception as e:
             self.logger.error("Failed to get shading_index, waterings or sensordata from DB: %s", e)
             exit(121)
 
+    def _get_sensors(self, trees):
+        '''Gets the sensor measurements and sensor site of the given trees and merges them with the tree metadata'''
+        params = {"tree_ids": pg_text_array(trees.tree_id.unique())}
+        data = read_sql(self.engine, "SELECT tree_id, type_id, timestamp, value FROM private.sensor_measurements WHERE tree_id = ANY(%(tree_ids)s::text[])",
+                        params=params)
+        tree_devices = read_sql(self.engine, "SELECT tree_id, site_id FROM private.tree_devices WHERE tree_id = ANY(%(tree_ids)s::text[])",
+                                params=params)
+        data = compact_dtypes(data)
+        if not data.empty:
+            data = data.assign(month=data.timestamp.dt.month)
+            data = reduce(lambda left, right: pd.merge(left, right, on="tree_id",
+                                                       how='left'), [data, trees, tree_devices])
+        return data
+
+    def _add_watering(self, trees):
+        '''Adds the waterings of the trees as rolling sums per day, split into Gieß-den-Kiez (gdk) and Grünflächenämter (sga). The sums are computed
+        from the sparse watering events for the tree days in trees only.'''
+        params = {"tree_ids": pg_text_array(trees.tree_id.unique())}
+        waterings = {name: read_sql(self.engine, f"SELECT tree_id, date, amount_liters FROM {table} WHERE tree_id = ANY(%(tree_ids)s::text[])", params=params)
+                     for name, table in WATERING_SOURCES.items()}
+        # Only get last 8 days if we don't take the sensors
+        if self.date is None:
+            dates = pd.date_range(DATA_START_DATE, pd.Timestamp("today"), tz="UTC")
+            dates = dates[dates.month.isin(range(4, 11))]
+        else:
+            dates = pd.date_range(self.date - dt.timedelta(days=PREPROCESSING_HYPERPARAMS['rolling_window'] + 1), self.date, tz="UTC")
+        return add_watering_features(trees, waterings, dates)
+
+    def _get_shading_index(self, relevant_trees):
+        '''Gets the monthly shading index of the given trees in long format with one row per tree and month'''
+        params = {"tree_ids": pg_text_array(relevant_trees)}
+        monthly_shading = read_sql(self.engine, "SELECT * FROM public.shading_monthly WHERE tree_id = ANY(%(tree_ids)s::text[])", params=params)
+        shading_long = pd.melt(monthly_shading, id_vars="tree_id")
+        month_mapping = dict((v, k) for v, k in zip(shading_long.variable.unique(), range(1, 13)))
+        shading_long = shading_long.assign(month=[month_mapping[el] for el in shading_long.variable])
+        shading_long.drop(columns="variable", inplace=True)
+        shading_long.rename(columns={"value": "shading_index"}, inplace=True)
+        return shading_long
+
+    def _growing_season_dates(self):
+        '''All days from April to October since DATA_START_DATE up to today, plus the forecast horizon for forecasts'''
+        dates = pd.date_range(DATA_START_DATE, pd.Timestamp("today") + pd.Timedelta(days=PREPROCESSING_HYPERPARAMS['fc_horizon'] if self.forecast else 0), tz="UTC")
+        return dates[dates.month.isin(range(4, 11))]
+
     def _get_weather_measurements(self):
-        '''Used internally to add weather data to the dataframe. Interpolates gaps in the weather data and calculates rolling averages. Uses different data sources for public and private runs.'''
+        '''Used internally to add weather data to the dataframe. Returns the rolling weather features of the run's source from the incrementally updated store, restricted to self.date if set.
+        The store is updated from the DB on the first lookup of a source only, later lookups just read the stored features.'''
         try:
-            if self.public_run:  # If public run, we only take the public.weather file
-                weather_station = pd.read_sql_table("weather", schema="public", index_col="date",
-                                                    con=self.engine.connect(), columns=WEATHER_COLUMNS)
-            else:  # For private runs we take the solar irradiance in addition to other weather data
-                if self.forecast:  # For forecast we use solar anywhere data as this is the only one with available weather predictions
-                    cols = ['tile_id'] + [x for x in WEATHER_COLUMNS if x != "upm"] + ["ghi_sum_whm2"]
-                    weather_station = pd.read_sql_table("weather_tile_measurement", schema="private", con=self.engine.connect(),
-                                                        index_col="date", columns=cols)
-                    weather_station = weather_station.groupby(level=0).mean().drop(columns="tile_id")
-                else:  # For nowcast we use
-                    weather_station = pd.read_sql_table("weather", schema="public", con=self.engine.connect(),
-                                                        index_col="date", columns=WEATHER_COLUMNS)
-                    weather_solar = pd.read_sql_table("weather_tile_measurement", con=self.engine.connect(), schema="private",
-                                                      columns=["tile_id", "ghi_sum_whm2"], index_col="date")
-                    weather_solar = weather_solar.groupby(level=0).mean().drop(columns="tile_id")
-                    weather_station = weather_station.merge(weather_solar, how="left", left_index=True, right_index=True)
-
-            weather_station.index = weather_station.index.tz_localize("UTC")
-            weather_station.interpolate(limit=PREPROCESSING_HYPERPARAMS['rolling_window'])
-            weather_station["rainfall_mm"] = weather_station["rainfall_mm"].rolling(window=PREPROCESSING_HYPERPARAMS['rolling_window'], min_periods=1).sum()
-            for col in [x for x in weather_station.columns if x != "rainfall_mm"]:
-                weather_station[col] = weather_station[col].rolling(window=PREPROCESSING_HYPERPARAMS['rolling_window'], min_periods=1).mean()
-            col_names = [x for x in WEATHER_COLUMNS+["ghi_sum_whm2"] if x in weather_station.columns]
-            weather_station.columns = col_names
-            return weather_station
+            # public runs only use public.weather, private forecasts the SolarAnywhere tiles as the only source with weather
+            # predictions, private nowcasts public.weather plus the solar irradiance of the tiles
+            source = weather_source(self.public_run, self.forecast)
+            if source not in self._updated_weather_sources:
+                self.weather_store.update(source)
+                self._updated_weather_sources.add(source)
+            return self.weather_store.get(source, start=self.date, end=self.date).astype(np.float32)
 
         except Exception as e:
             self.logger.error("Failed to get weather data from DB: %s", e)
@@ -321,7 +457,8 @@ class Preprocessor():
         X = X[all_cols]
         X = self._transform_features(X)
         X = self._fill_gaps(X)
-        X[self.cat_columns] = self.ordinal_encoder.transform(X[self.cat_columns])
+        X = self._add_autoregressive_features(X)
+        X[self.cat_columns] = self.ordinal_encoder.transform(X[self.cat_columns]).astype(np.float32)
         X = X[X["value"].notna()]
         X.set_index(["tree_id", "timestamp"], inplace=True)
         X = X.rename(columns={"value": "target"})
@@ -337,27 +474,46 @@ class Preprocessor():
             all_cols = [x for x in all_cols if x not in self.weather_features + ["site_id", "value", "type_id"]]
         X = X[all_cols]
         X = self._transform_features(X)
-        X.loc[:, self.cat_columns] = self.ordinal_encoder.transform(X[self.cat_columns])
+        X[self.cat_columns] = self.ordinal_encoder.transform(X[self.cat_columns]).astype(np.float32)
         return X.set_index(["tree_id", "timestamp"])
     
-    def _fill_gaps(self, X):
-        resampled_data = None
-        X.set_index(["type_id", "tree_id", "timestamp"], inplace=True)
-        for depth in [1, 2, 3]:
-            for idx in X.index.get_level_values(1).unique():
-                try:
-                    temp = X.loc[depth, idx, :].resample("D").ffill(limit=7)
-                    temp = temp[temp.index.month.isin(range(4, 10))]
-                    temp["type_id"] = depth
-                    temp["tree_id"] = idx
-                except AttributeError:
-                    temp = None
-                if resampled_data is None:
-                    resampled_data = temp
-                else:
-                    resampled_data = pd.concat([resampled_data, temp])
-        X_filled = resampled_data.reset_index()
-        return X_filled
+    def _fill_gaps(self, X, limit=7):
+        '''Resamples the series of every sensor depth and tree to a daily calendar and forward fills gaps of up to limit days.
+        All (type_id, tree_id) series are reindexed at once with an as-of merge instead of resampling each tree separately.
+        Only the growing season from April to September is kept.'''
+        keys = ["type_id", "tree_id"]
+        value_cols = [x for x in X.columns if x not in keys + ["timestamp"]]
+        X = X[X["type_id"].isin([1, 2, 3])]
+        tree_order = pd.Index(X["tree_id"].unique())
+        X = X.assign(obs_day=X["timestamp"].dt.floor("D"))
+        groups = X.groupby(keys, sort=False, observed=True)
+        X = X.assign(series=groups.ngroup()).sort_values("timestamp", kind="stable")
+
+        # Daily calendar per series, spanning the first to the last observed day
+        bounds = groups["obs_day"].agg(["min", "max"])
+        n_days = ((bounds["max"] - bounds["min"]) // pd.Timedelta(days=1)).to_numpy(dtype="int64") + 1
+        offsets = np.arange(n_days.sum()) - np.repeat(np.cumsum(n_days) - n_days, n_days)
+        calendar = pd.DataFrame({
+            "series": np.repeat(np.arange(len(bounds)), n_days),
+            "type_id": _key_values(bounds.index, "type_id", X["type_id"].dtype).repeat(n_days),
+            "tree_id": _key_values(bounds.index, "tree_id", X["tree_id"].dtype).repeat(n_days),
+            "timestamp": pd.DatetimeIndex(bounds["min"]).repeat(n_days) + pd.to_timedelta(offsets, unit="D"),
+        })
+        calendar = calendar[calendar["timestamp"].dt.month.isin(range(4, 10))].sort_values("timestamp", kind="stable")
+
+        # Take the last observation per calendar day and drop it if it is more than limit days old
+        X_filled = pd.merge_asof(calendar, X.drop(columns=keys), on="timestamp", by="series", direction="backward")
+        stale = ~((X_filled["timestamp"] - X_filled["obs_day"]) <= pd.Timedelta(days=limit))
+        if stale.any():
+            X_filled.loc[stale, value_cols] = np.nan
+
+        X_filled = X_filled.assign(tree_rank=tree_order.get_indexer(X_filled["tree_id"]))
+        X_filled = X_filled.sort_values(["type_id", "tree_rank", "timestamp"])
+        return X_filled[["timestamp"] + value_cols + keys].reset_index(drop=True)
+
+    def _add_autoregressive_features(self, X):
+        '''Nowcast models use no autoregressive features'''
+        return X
 
     def _transform_features(self, X):
         for col in ["baumscheibe_m2", "baumscheibe_surface", "water_sga", "water_gdk"]:
@@ -421,6 +577,10 @@ class PreprocessorForecast(Preprocessor):
         All numerical features that we want to keep from the data.
     ordinal_encoder:
         Sklearn.preprocessing.OrdinalEncoder object for ordinal encoding of the categorical features
+    autoreg_lags : list of int
+        Lags of the sensor values used as autoregressive features. Taken from PREPROCESSING_HYPERPARAMS['autoreg_lag'] by default
+    autoreg_windows : list of int
+        Window sizes for rolling means of the previous sensor values used as additional autoregressive features
 
     Methods
     -------
@@ -432,8 +592,11 @@ class PreprocessorForecast(Preprocessor):
         Fills NAs of less important columns so we dont lose this data. Then transforms categorical features. Does not drop NAs. Autoregressive features are generated iteratively during inference.
     """
     def __init__(self,
-                 weather_features=["wind_max_ms", "wind_avg_ms", "rainfall_mm", "temp_max_c", "temp_avg_c", "ghi_sum_whm2"]):
+                 weather_features=["wind_max_ms", "wind_avg_ms", "rainfall_mm", "temp_max_c", "temp_avg_c", "ghi_sum_whm2"],
+                 autoreg_lag=PREPROCESSING_HYPERPARAMS['autoreg_lag'], autoreg_windows=PREPROCESSING_HYPERPARAMS['autoreg_windows']):
         super().__init__(weather_features)
+        self.autoreg_lags = get_autoreg_lags(autoreg_lag)
+        self.autoreg_windows = list(autoreg_windows)
 
     def transform_inference(self, X):
         '''Transforms some columns from numeric to categorical features by binning. Then transforms categorical features ordinally.
@@ -441,18 +604,66 @@ class PreprocessorForecast(Preprocessor):
         return super().transform_inference(X, nc=False)
 
     def _add_autoregressive_features(self, X):
-        X.set_index(["tree_id", "type_id", "timestamp"], inplace=True)
-        X.sort_index(inplace=True)
-        for i in range(1, PREPROCESSING_HYPERPARAMS['autoreg_lag']+1):
-            X.insert(0, f"shift_{i}", 0)
-            for tree_id in X.index.get_level_values(0).unique():
-                for type_id in [1, 2, 3]:
-                    try:
-                        X.loc[(tree_id, type_id, slice(None)), f"shift_{i}"] = X.loc[(tree_id, type_id, slice(None)), "value"].shift(i)
-                    except:
-                        continue
-        X.reset_index(inplace=True)
-        return X
-    
+        '''Adds the lagged sensor values shift_i per tree and sensor depth and, if configured, rolling means over the values before each day.'''
+        return add_lag_features(X, lags=self.autoreg_lags, windows=self.autoreg_windows)
+
+    @property
+    def autoreg_columns(self):
+        '''Names of the autoregressive feature columns in the order they are used by the forecast models'''
+        return [f"shift_{i}" for i in self.autoreg_lags] + [f"rolling_mean_{w}" for w in self.autoreg_windows]
+
+
+def _key_values(index, level, dtype):
+    '''Values of a level of a group index in the dtype of the key, including the order of categories, which the group index does not keep'''
+    values = index.get_level_values(level)
+    if isinstance(dtype, pd.CategoricalDtype):
+        return values.reorder_categories(dtype.categories, ordered=dtype.ordered)
+    return values.to_numpy().astype(dtype)
+
 
+def get_autoreg_lags(autoreg_lag=PREPROCESSING_HYPERPARAMS['autoreg_lag']):
+    '''Returns the lag set for autoregressive features. An int n stands for the lags 1 to n, a list gives the lags explicitly.'''
+    if isinstance(autoreg_lag, int):
+        return list(range(1, autoreg_lag + 1))
+    return sorted(set(autoreg_lag))
 
+
+def add_lag_features(X, lags, windows=(), value_col="value", keys=("tree_id", "type_id"), time_col="timestamp"):
+    """
+    Adds autoregressive features to the data
+
+    Sorts the data once by series and time and computes all lags with grouped shifts, so the runtime does not depend on the number
+    of trees. Lags are counted in rows, i.e. in days for gap filled data.
+
+    Parameters
+    ----------
+    X : pandas.DataFrame
+        Data with one row per series and timestamp
+    lags : list of int
+        Adds a column shift_i with the value of i rows before for every lag i
+    windows : list of int, optional
+        Adds a column rolling_mean_w with the mean of the last w values before each row for every window w
+    value_col : str, optional
+        Column the features are computed from
+    keys : tuple of str, optional
+        Columns identifying a series
+    time_col : str, optional
+        Column to sort each series by
+
+    Returns
+    -------
+    pandas.DataFrame
+        Data sorted by keys and time_col with the key columns first, followed by the new feature columns
+    """
+    keys = list(keys)
+    X = X.sort_values(keys + [time_col], kind="stable").reset_index(drop=True)
+    grouped = X.groupby(keys, sort=False, observed=True)[value_col]
+    features = {f"shift_{i}": grouped.shift(i) for i in sorted(lags, reverse=True)}
+    if len(windows) > 0:
+        previous = grouped.shift(1).groupby([X[k] for k in keys], sort=False, observed=True)
+        for w in windows:
+            rolling = previous.rolling(w, min_periods=1).mean()
+            features[f"rolling_mean_{w}"] = rolling.reset_index(level=list(range(len(keys))), drop=True)
+    features = pd.DataFrame(features, index=X.index)
+    other_cols = [x for x in X.columns if x not in keys + [time_col] + list(features.columns)]
+    return pd.concat([X[keys + [time_col]], features, X[other_cols]], axis=1)
@@ -0,0 +1,318 @@
+import io
+import uuid
+import pandas as pd
+import shapely
+from psycopg2 import sql
+
+from qtrees.helper import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_CHUNKSIZE = 100000
+
+
+class BulkWriter:
+    """
+    Streams DataFrames into a Postgres table with COPY FROM STDIN
+
+    Every DataFrame is split into chunks of chunksize rows which are CSV encoded in memory and sent with one COPY per chunk, all
+    chunks of a write in one transaction. NULL is sent as \\N, so empty strings stay empty strings. Float columns written to
+    integer columns of the table, e.g. after a merge introduced NaN, are sent as integers. Geometry columns of GeoDataFrames
+    are sent as hex EWKB with the SRID of their CRS, so GeoDataFrames can be appended to PostGIS tables as well.
+
+    With staging=True, the rows are copied into a new table of the same columns, without indexes, named with a suffix of its
+    own per writer, so overlapping runs never touch each other's rows. On leaving the context, the indexes, constraints and
+    grants of the target table are built on the staging table, and the staging table then replaces the target table by renaming
+    both in one transaction. Views and materialized views depending on the target table are recreated on the new table in the
+    same transaction. The live table is never rewritten row by row, so no dead rows are left behind, and readers keep reading the
+    previous rows until the commit and never see an empty or partial table. If the context is left with an exception, the
+    staging table is dropped and the target table is left untouched.
+
+    Attributes
+    ----------
+    engine : sqlalchemy.engine.Engine
+        Engine of the database to write to
+    table : str
+        Name of the target table
+    schema : str
+        Schema of the target table
+    chunksize : int
+        Number of rows per COPY
+    staging : bool
+        Collect rows in a staging table and swap them into the target table on exit?
+    rows_written : int
+        Number of rows written so far
+    rebuilt_views : list of str
+        Views and materialized views recreated by the last swap, materialized views are recreated with data
+
+    Methods
+    -------
+    write(df):
+        Copies all rows of the DataFrame into the target or staging table.
+    swap():
+        Replaces the target table by the staging table.
+    discard():
+        Drops the staging table without touching the target table.
+    """
+
+    def __init__(self, engine, table, schema="public", chunksize=DEFAULT_CHUNKSIZE, staging=False):
+        self.engine = engine
+        self.table = table
+        self.schema = schema
+        self.chunksize = chunksize
+        self.staging = staging
+        self.rows_written = 0
+        self.rebuilt_views = []
+        self._columns = None
+        self._integer_columns = None
+        self._suffix = uuid.uuid4().hex[:8]
+
+    @property
+    def target(self):
+        return sql.Identifier(self.schema, self.table)
+
+    @property
+    def staging_table(self):
+        return sql.Identifier(self.schema, f"{self.table}_staging_{self._suffix}")
+
+    def __enter__(self):
+        if self.staging:
+            # defaults, e.g. of serial ids, NOT NULL and CHECK constraints are needed while copying, indexes only on the swap
+            self._execute(sql.SQL("CREATE TABLE {staging} (LIKE {target} INCLUDING DEFAULTS INCLUDING CONSTRAINTS "
+                                  "INCLUDING IDENTITY INCLUDING GENERATED)").format(staging=self.staging_table, target=self.target))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.staging:
+            return False
+        if exc_type is not None:
+            self.discard()
+            return False
+        try:
+            self.swap()
+        except Exception:
+            self.discard()
+            raise
+        return False
+
+    def write(self, df):
+        columns = list(df.columns)
+        if self.staging:
+            if self._columns is None:
+                self._columns = columns
+            elif columns != self._columns:
+                raise ValueError(f"Columns {columns} do not match the staged columns {self._columns}")
+        table = self.staging_table if self.staging else self.target
+        statement = sql.SQL("COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')").format(
+            table=table, columns=sql.SQL(", ").join(map(sql.Identifier, columns)))
+
+        connection = self.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                statement = statement.as_string(cursor)
+                # timezone aware columns are sent as naive UTC, formatting them with offsets is several times slower
+                cursor.execute("SET LOCAL TIME ZONE 'UTC'")
+                if self._integer_columns is None:
+                    cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s "
+                                   "AND data_type IN ('smallint', 'integer', 'bigint')", (self.schema, self.table))
+                    self._integer_columns = [row[0] for row in cursor.fetchall()]
+                for start in range(0, len(df), self.chunksize):
+                    buffer = io.StringIO()
+                    _encode(df.iloc[start:start + self.chunksize], self._integer_columns).to_csv(buffer, index=False, header=False,
+                                                                                                  na_rep="\\N")
+                    buffer.seek(0)
+                    cursor.copy_expert(statement, buffer)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        self.rows_written += len(df)
+        logger.debug("Copied %s rows into %s.%s.", len(df), self.schema, self.table)
+
+    def swap(self):
+        if self._columns is None:
+            logger.warning("Nothing staged for %s.%s, keeping the current content.", self.schema, self.table)
+            self.discard()
+            return
+        connection = self.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                renames = self._prepare_staging(cursor)
+                connection.commit()
+                # the renames lock the target table until the commit, readers wait for the commit instead of seeing partial data
+                cursor.execute(sql.SQL("LOCK TABLE {target} IN ACCESS EXCLUSIVE MODE").format(target=self.target))
+                views = _dependent_views(cursor, self.schema, self.table)
+                for view in reversed(views):
+                    cursor.execute(sql.SQL("DROP {kind} {view}").format(kind=sql.SQL(view["kind"]), view=view["name"]))
+                old = f"{self.table}_old_{self._suffix}"
+                cursor.execute(sql.SQL("ALTER TABLE {target} RENAME TO {old}; ALTER TABLE {staging} RENAME TO {table}").format(
+                    target=self.target, old=sql.Identifier(old), staging=self.staging_table, table=sql.Identifier(self.table)))
+                # sequences of serial columns belong to the old table and would be dropped with it
+                cursor.execute("SELECT s.oid::regclass::text, a.attname FROM pg_depend d JOIN pg_class s ON s.oid = d.objid "
+                               "JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid "
+                               "WHERE d.classid = 'pg_class'::regclass AND d.refobjid = %s::regclass AND d.deptype = 'a' "
+                               "AND s.relkind = 'S'", (f"{self.schema}.{old}",))
+                for sequence, column in cursor.fetchall():
+                    cursor.execute(sql.SQL("ALTER SEQUENCE {sequence} OWNED BY {target}.{column}").format(
+                        sequence=sql.SQL(sequence), target=self.target, column=sql.Identifier(column)))
+                cursor.execute(sql.SQL("DROP TABLE {old}").format(old=sql.Identifier(self.schema, old)))
+                for statement in renames:
+                    cursor.execute(statement)
+                for view in views:
+                    for statement in view["statements"]:
+                        cursor.execute(statement)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        self.rebuilt_views = [view["label"] for view in views]
+        logger.info("Replaced %s.%s by %s staged rows, recreated %s.", self.schema, self.table, self.rows_written,
+                    ", ".join(self.rebuilt_views) or "no views")
+
+    def _prepare_staging(self, cursor):
+        '''Builds the indexes and constraints of the target table on the staging table under temporary names, copies owner and
+        grants and analyzes it. Returns the statements giving the indexes and constraints their original names after the swap.'''
+        cursor.execute("SELECT conrelid::regclass::text FROM pg_constraint WHERE confrelid = %s::regclass AND contype = 'f'",
+                       (f"{self.schema}.{self.table}",))
+        referencing = [row[0] for row in cursor.fetchall()]
+        if len(referencing) > 0:
+            raise ValueError(f"{self.schema}.{self.table} is referenced by foreign keys of {referencing} and cannot be swapped")
+        renames = []
+        cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass "
+                       "AND contype IN ('p', 'u', 'x', 'f') ORDER BY contype = 'f', conname", (f"{self.schema}.{self.table}",))
+        for i, (name, definition) in enumerate(cursor.fetchall()):
+            tmp_name = f"{self.table}_c{i}_{self._suffix}"
+            cursor.execute(sql.SQL("ALTER TABLE {staging} ADD CONSTRAINT {name} {definition}").format(
+                staging=self.staging_table, name=sql.Identifier(tmp_name), definition=sql.SQL(definition)))
+            renames.append(sql.SQL("ALTER TABLE {target} RENAME CONSTRAINT {name} TO {original}").format(
+                target=self.target, name=sql.Identifier(tmp_name), original=sql.Identifier(name)))
+        cursor.execute("SELECT i.relname, pg_get_indexdef(i.oid) FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid "
+                       "WHERE x.indrelid = %s::regclass AND NOT EXISTS "
+                       "(SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid AND c.conrelid = x.indrelid) "
+                       "ORDER BY i.relname", (f"{self.schema}.{self.table}",))
+        for i, (name, definition) in enumerate(cursor.fetchall()):
+            tmp_name = f"{self.table}_i{i}_{self._suffix}"
+            cursor.execute(sql.SQL("CREATE {unique}INDEX {name} ON {staging} USING {definition}").format(
+                unique=sql.SQL("UNIQUE " if definition.startswith("CREATE UNIQUE") else ""), name=sql.Identifier(tmp_name),
+                staging=self.staging_table, definition=sql.SQL(definition.split(" USING ", 1)[1])))
+            renames.append(sql.SQL("ALTER INDEX {name} RENAME TO {original}").format(
+                name=sql.Identifier(self.schema, tmp_name), original=sql.Identifier(name)))
+        cursor.execute("SELECT pg_get_userbyid(relowner) FROM pg_class WHERE oid = %s::regclass", (f"{self.schema}.{self.table}",))
+        cursor.execute(sql.SQL("ALTER TABLE {staging} OWNER TO {owner}").format(staging=self.staging_table,
+                                                                             owner=sql.Identifier(cursor.fetchone()[0])))
+        for statement in _grant_statements(cursor, f"{self.schema}.{self.table}", "TABLE", self.staging_table):
+            cursor.execute(statement)
+        cursor.execute(sql.SQL("ANALYZE {staging}").format(staging=self.staging_table))
+        return renames
+
+    def discard(self):
+        self._execute(sql.SQL("DROP TABLE IF EXISTS {staging}").format(staging=self.staging_table))
+
+    def _execute(self, statement):
+        connection = self.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(statement)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+
+def _dependent_views(cursor, schema, table):
+    '''Views and materialized views depending on the table, directly or through other views, in the order they can be created.
+    Every view comes with the statements recreating it with its options, indexes, owner and grants.'''
+    cursor.execute("""
+        WITH RECURSIVE dependent(oid, level) AS (
+            SELECT %s::regclass::oid, 0
+            UNION
+            SELECT r.ev_class, dependent.level + 1 FROM dependent
+            JOIN pg_depend d ON d.refobjid = dependent.oid AND d.classid = 'pg_rewrite'::regclass
+            JOIN pg_rewrite r ON r.oid = d.objid
+            WHERE r.ev_class <> dependent.oid
+        )
+        SELECT c.oid, n.nspname, c.relname, c.relkind, c.reloptions, pg_get_viewdef(c.oid), pg_get_userbyid(c.relowner)
+        FROM dependent JOIN pg_class c ON c.oid = dependent.oid JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE dependent.level > 0
+        GROUP BY c.oid, n.nspname, c.relname, c.relkind, c.reloptions
+        ORDER BY MAX(dependent.level), c.oid""", (f"{schema}.{table}",))
+    views = []
+    for oid, view_schema, name, relkind, options, definition, owner in cursor.fetchall():
+        kind = "MATERIALIZED VIEW" if relkind == "m" else "VIEW"
+        identifier = sql.Identifier(view_schema, name)
+        with_options = sql.SQL(" WITH ({})".format(", ".join(options))) if options else sql.SQL("")
+        statements = [sql.SQL("CREATE {kind} {view}{options} AS {definition}").format(
+            kind=sql.SQL(kind), view=identifier, options=with_options, definition=sql.SQL(definition.rstrip().rstrip(";")))]
+        statements.append(sql.SQL("ALTER {kind} {view} OWNER TO {owner}").format(kind=sql.SQL(kind), view=identifier,
+                                                                             owner=sql.Identifier(owner)))
+        cursor.execute("SELECT indexdef FROM pg_indexes WHERE schemaname = %s AND tablename = %s ORDER BY indexname",
+                       (view_schema, name))
+        statements += [sql.SQL(row[0]) for row in cursor.fetchall()]
+        statements += _grant_statements(cursor, oid, "TABLE", identifier)
+        views.append(dict(name=identifier, kind=kind, label=f"{view_schema}.{name}",
+                          statements=[statement.as_string(cursor) for statement in statements]))
+    return views
+
+
+def _grant_statements(cursor, relation, kind, target):
+    '''GRANT statements giving target the privileges granted on relation'''
+    cursor.execute("SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE pg_get_userbyid(a.grantee) END, a.privilege_type, "
+                   "a.is_grantable FROM pg_class c, aclexplode(c.relacl) a WHERE c.oid = %s::regclass "
+                   "AND a.grantee <> c.relowner ORDER BY 1, 2", (relation,))
+    return [sql.SQL("GRANT {privilege} ON {kind} {target} TO {grantee}{option}").format(
+        privilege=sql.SQL(privilege), kind=sql.SQL(kind), target=target,
+        grantee=sql.SQL("PUBLIC") if grantee == "PUBLIC" else sql.Identifier(grantee),
+        option=sql.SQL(" WITH GRANT OPTION" if grantable else "")) for grantee, privilege, grantable in cursor.fetchall()]
+
+
+def _encode(df, integer_columns=()):
+    '''Converts timezone aware columns to naive UTC, geometry columns to hex EWKB, which PostGIS reads from CSV, and float columns
+    among integer_columns to nullable integers, which are written without a decimal point.'''
+    tz_columns = [col for col, dtype in df.dtypes.items() if isinstance(dtype, pd.DatetimeTZDtype)]
+    geometry_columns = [col for col, dtype in df.dtypes.items() if dtype.name == "geometry"]
+    float_columns = [col for col in integer_columns if col in df.columns and df[col].dtype.kind == "f"]
+    if len(tz_columns) == 0 and len(geometry_columns) == 0 and len(float_columns) == 0:
+        return df
+    columns = {col: df[col].dt.tz_convert("UTC").dt.tz_localize(None) for col in tz_columns}
+    for col in float_columns:
+        columns[col] = df[col].astype("Int64")
+    for col in geometry_columns:
+        geometries = df[col].to_numpy()
+        if df[col].crs is not None:
+            geometries = shapely.set_srid(geometries, df[col].crs.to_epsg() or 0)
+        columns[col] = shapely.to_wkb(geometries, hex=True, include_srid=True)
+    return pd.DataFrame(df).assign(**columns)
+
+
+def copy_to_db(df, table, engine, schema="public", chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Appends a DataFrame to a table with COPY FROM STDIN
+
+    Drop-in replacement for DataFrame.to_sql(table, engine, if_exists="append", schema=schema, index=False) and
+    GeoDataFrame.to_postgis(table, engine, if_exists="append", schema=schema) for existing tables.
+
+    Parameters
+    ----------
+    df: pandas.DataFrame
+        Rows to write, the column names have to match the columns of the table
+    table: str
+        Name of the table
+    engine: db engine object
+    schema: str
+        Schema of the table
+    chunksize: int
+        Number of rows per COPY
+
+    Returns
+    -------
+        int, number of rows written
+    """
+    writer = BulkWriter(engine, table, schema=schema, chunksize=chunksize)
+    writer.write(df)
+    return writer.rows_written
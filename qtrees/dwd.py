@@ -1,16 +1,30 @@
 import geopandas as gpd
 import pandas as pd
+import numpy as np
 import io
 import requests
 import gzip
-import wradlib as wrl
-from shapely.geometry import Polygon
+import shapely
 import datetime
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from zipfile import ZipFile
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 import pytz
+from qtrees.helper import get_logger
 
-def get_radolan_data(nowcast_date=None, aggregation="hourly", mask=None, xmin=0, xmax=900, ymin=0, ymax=900):
+logger = get_logger(__name__)
+
+RADOLAN_URLS = dict(
+    hourly="https://opendata.dwd.de/climate_environment/CDC/grids_germany/hourly/radolan/recent/bin/",
+    daily="https://opendata.dwd.de/climate_environment/CDC/grids_germany/daily/radolan/recent/bin/",
+)
+RADOLAN_PRODUCTS = dict(hourly="raa01-rw", daily="raa01-sf")
+
+def get_radolan_data(nowcast_date=None, aggregation="hourly", mask=None, xmin=0, xmax=900, ymin=0, ymax=900, fetcher=None):
     """Gets the RADOLAN (Radar-Online-Aneichung) data of DWD
 
     Parameters
@@ -29,6 +43,9 @@ def get_radolan_data(nowcast_date=None, aggregation="hourly", mask=None, xmin=0,
     xmin, xmax, ymin, ymax : int, optional
         indices within the 900x900 grid to only take a subset and save computation
 
+    fetcher : RadolanFetcher, optional
+        Fetcher to download the file with, e.g. to use its disk cache (default is None, plain request)
+
     Returns
     -------
     grid_gdf
@@ -47,50 +64,274 @@ def get_radolan_data(nowcast_date=None, aggregation="hourly", mask=None, xmin=0,
     if nowcast_date is None:
         nowcast_date = datetime.datetime.now(tz=pytz.timezone("UTC"))
 
+    url = get_radolan_url(nowcast_date, aggregation=aggregation)
+    if fetcher is None:
+        resp = requests.get(url)
+        content = resp.content if resp.ok else None
+    else:
+        content = fetcher.get(url)
+    if content is None:
+        return
+
+    return read_radolan_data(content, mask=mask, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax)
+
+
+def get_radolan_url(nowcast_date, aggregation="hourly", base_url=None):
+    """Returns the url of the RADOLAN file of the last observation before nowcast_date. Raises a ValueError if wrong
+    aggregation is passed."""
     if nowcast_date.minute >= 50:
         normalized_date = nowcast_date - datetime.timedelta(minutes=nowcast_date.minute - 50)
     else:
         normalized_date = nowcast_date - datetime.timedelta(minutes=nowcast_date.minute + 50)
 
-    if aggregation == "hourly":
-        url = f"https://opendata.dwd.de/climate_environment/CDC/grids_germany/hourly/radolan/recent/bin/" \
-              f"raa01-rw_10000-{normalized_date:%y%m%d%H%M}-dwd---bin.gz"
-    elif aggregation == "daily":
-        url = f"https://opendata.dwd.de/climate_environment/CDC/grids_germany/daily/radolan/recent/bin/" \
-              f"raa01-sf_10000-{normalized_date:%y%m%d%H%M}-dwd---bin.gz"
-    else:
+    if aggregation not in RADOLAN_URLS:
         raise ValueError("aggregation must be hourly or daily")
+    base_url = base_url or RADOLAN_URLS[aggregation]
+    return f"{base_url}{RADOLAN_PRODUCTS[aggregation]}_10000-{normalized_date:%y%m%d%H%M}-dwd---bin.gz"
 
-    resp = requests.get(url)
-    if not resp.ok:
-        return
 
-    radolan_file = gzip.open(io.BytesIO(resp.content), "rb")
-    radolan_data, meta_data = wrl.io.read_radolan_composite(radolan_file)
+def read_radolan_composite(content):
+    """Reads a gzipped RADOLAN composite and returns the 900x900 data array and the meta data of the composite."""
+    import wradlib as wrl
+    radolan_file = gzip.open(io.BytesIO(content), "rb")
+    return wrl.io.read_radolan_composite(radolan_file)
 
-    radolan_grid = wrl.georef.get_radolan_grid(900, 900, wgs84=True)
 
-    grid_values, grid_geo = [], []
+def read_radolan_data(content, mask=None, xmin=0, xmax=900, ymin=0, ymax=900):
+    """Reads a gzipped RADOLAN composite and returns the grid cells within the window and mask as geodataframe together
+    with the meta data of the composite. See get_radolan_data."""
+    radolan_data, meta_data = read_radolan_composite(content)
+    grid_window = get_radolan_grid_window(xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax, mask=mask)
+    return grid_window.to_geodataframe(radolan_data), meta_data
 
-    for x in range(xmin, xmax - 1):
-        for y in range(ymin, ymax - 1):
-            grid_coords = list()
-            grid_coords.append(radolan_grid[x, y, :])
-            grid_coords.append(radolan_grid[x, y + 1, :])
-            grid_coords.append(radolan_grid[x + 1, y + 1, :])
-            grid_coords.append(radolan_grid[x + 1, y, :])
-            grid_coords.append(radolan_grid[x, y, :])
-            grid_geo.append(Polygon(grid_coords))
-            grid_values.append(radolan_data[x, y])
 
-    grid_gdf = gpd.GeoDataFrame(
-        pd.DataFrame(grid_values, columns=["rainfall_mm"]), geometry=grid_geo, crs="EPSG:4326"
-    )
+class RadolanFetcher:
+    """
+    Downloads RADOLAN files concurrently with an on-disk cache
 
-    if mask is None:
-        return grid_gdf, meta_data
-    else:
-        return gpd.sjoin(grid_gdf, mask), meta_data
+    Files are downloaded by a bounded pool of workers sharing one HTTP session, so connections are reused. Downloaded files
+    are stored content-addressed under cache_dir/objects by their sha256, with a reference per file name under
+    cache_dir/refs. Files that are in the cache are never downloaded again, missing files (e.g. the current hour) are not
+    cached.
+
+    Attributes
+    ----------
+    cache_dir : str
+        Directory of the cache, None disables caching
+    aggregation : str
+        "hourly" or "daily", see get_radolan_data
+    max_workers : int
+        Maximal number of concurrent downloads
+    base_url : str
+        Directory url of the RADOLAN files, defaults to the DWD open data server
+    timeout : float
+        Timeout of a single request in seconds
+
+    Methods
+    -------
+    fetch(dates):
+        Returns a dictionary with the content of the RADOLAN file for every date, None if not available.
+    get(url):
+        Returns the content of a single RADOLAN file, None if not available.
+    """
+
+    def __init__(self, cache_dir=None, aggregation="hourly", max_workers=8, base_url=None, timeout=60):
+        self.cache_dir = cache_dir
+        self.aggregation = aggregation
+        self.max_workers = max_workers
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def fetch(self, dates):
+        dates = list(dates)
+        urls = [get_radolan_url(date, aggregation=self.aggregation, base_url=self.base_url) for date in dates]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            contents = list(pool.map(self.get, urls))
+        return dict(zip(dates, contents))
+
+    def get(self, url):
+        name = url.rsplit("/", 1)[-1]
+        content = self._read_cache(name)
+        if content is not None:
+            return content
+        try:
+            resp = self.session.get(url, timeout=self.timeout)
+        except RequestException as e:
+            logger.warning("Request for %s failed: %s", url, e)
+            return None
+        if not resp.ok:
+            return None
+        self._write_cache(name, resp.content)
+        return resp.content
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[:2], digest + ".bin.gz")
+
+    def _read_cache(self, name):
+        if self.cache_dir is None:
+            return None
+        ref_path = os.path.join(self.cache_dir, "refs", name)
+        if not os.path.exists(ref_path):
+            return None
+        with open(ref_path) as f:
+            object_path = self._object_path(f.read().strip())
+        if not os.path.exists(object_path):
+            return None
+        with open(object_path, "rb") as f:
+            return f.read()
+
+    def _write_cache(self, name, content):
+        if self.cache_dir is None:
+            return
+        digest = hashlib.sha256(content).hexdigest()
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            _write_atomic(object_path, content)
+        _write_atomic(os.path.join(self.cache_dir, "refs", name), digest.encode())
+
+
+def _write_atomic(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+class RadolanGridWindow:
+    """
+    Grid cells of a window of the RADOLAN composite
+
+    The polygons of all cells are built at once from the grid corners, and cells outside of the mask are dropped once by their
+    index. Reading the rainfall of an hour then only takes the values of the remaining cells from the radar array.
+    Cell ids are numbered row-wise within the window, as used for public.radolan_tiles.
+
+    Attributes
+    ----------
+    xmin, xmax, ymin, ymax : int
+        Indices of the window within the 900x900 grid
+    tile_ids : numpy.ndarray
+        Ids of the cells within the mask
+    geometry : geopandas.GeoSeries
+        Polygons of the cells within the mask, indexed by tile_id
+
+    Methods
+    -------
+    values(radolan_data):
+        Returns the values of all cells within the mask from a 900x900 radar array.
+    to_geodataframe(radolan_data):
+        Returns the cells within the mask with geometry and rainfall_mm.
+    """
+
+    def __init__(self, radolan_grid, xmin=0, xmax=900, ymin=0, ymax=900, mask=None):
+        self.xmin, self.xmax, self.ymin, self.ymax = xmin, xmax, ymin, ymax
+        corners = [radolan_grid[xmin:xmax - 1, ymin:ymax - 1], radolan_grid[xmin:xmax - 1, ymin + 1:ymax],
+                   radolan_grid[xmin + 1:xmax, ymin + 1:ymax], radolan_grid[xmin + 1:xmax, ymin:ymax - 1]]
+        corners.append(corners[0])
+        polygons = shapely.polygons(np.stack(corners, axis=2).reshape(-1, 5, 2))
+        tile_ids = np.arange(len(polygons))
+        if mask is not None:
+            mask_geometry = mask.unary_union
+            shapely.prepare(mask_geometry)
+            inside = shapely.intersects(polygons, mask_geometry)
+            polygons, tile_ids = polygons[inside], tile_ids[inside]
+        self.tile_ids = tile_ids
+        self.geometry = gpd.GeoSeries(polygons, index=tile_ids, crs="EPSG:4326")
+
+    def values(self, radolan_data):
+        return radolan_data[self.xmin:self.xmax - 1, self.ymin:self.ymax - 1].ravel()[self.tile_ids]
+
+    def to_geodataframe(self, radolan_data):
+        return gpd.GeoDataFrame({"rainfall_mm": self.values(radolan_data)}, index=self.tile_ids, geometry=self.geometry)
+
+
+_grid_windows = {}
+
+
+def get_radolan_grid_window(xmin=0, xmax=900, ymin=0, ymax=900, mask=None):
+    """Returns the RadolanGridWindow for the given indices and mask. Windows are built once per process and reused."""
+    key = (xmin, xmax, ymin, ymax, None if mask is None else b"".join(shapely.to_wkb(np.asarray(mask.geometry))))
+    if key not in _grid_windows:
+        import wradlib as wrl
+        radolan_grid = wrl.georef.get_radolan_grid(900, 900, wgs84=True)
+        _grid_windows[key] = RadolanGridWindow(radolan_grid, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax, mask=mask)
+    return _grid_windows[key]
+
+
+class RadolanStack:
+    """
+    Hourly RADOLAN values of the cells of a grid window, stacked into a (hours x tiles) array
+
+    Only the values of the cells are kept, the geometry stays with the RadolanGridWindow. For long backfills the array can
+    be memory-mapped to a file.
+
+    Attributes
+    ----------
+    tile_ids : numpy.ndarray
+        Ids of the cells, i.e. the columns of the array
+    values : numpy.ndarray
+        Rainfall per added hour and cell
+    timestamps : list of datetime.datetime
+        Timestamp of each added hour
+
+    Methods
+    -------
+    add(timestamp, values):
+        Adds the values of all cells for one hour.
+    aggregate_daily():
+        Returns the daily mean, max and sum of the rainfall per cell.
+    """
+
+    def __init__(self, tile_ids, max_hours, path=None):
+        self.tile_ids = np.asarray(tile_ids)
+        shape = (max_hours, len(self.tile_ids))
+        if path is None:
+            self._values = np.empty(shape, dtype=np.float32)
+        else:
+            self._values = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+        self.timestamps = []
+
+    @property
+    def values(self):
+        return self._values[:len(self.timestamps)]
+
+    def add(self, timestamp, values):
+        self._values[len(self.timestamps)] = values
+        self.timestamps.append(timestamp)
+
+    def aggregate_daily(self):
+        """
+        Aggregates the hourly rainfall per UTC day and cell in a single pass. Missing values are skipped.
+
+        Returns
+        -------
+            pandas.DataFrame with columns tile_id, date, rainfall_mm (mean), rainfall_max_mm and rainfall_sum_mm, sorted by
+            tile_id and date
+        """
+        dates = pd.DatetimeIndex(self.timestamps).floor("D")
+        order = np.argsort(dates.asi8, kind="stable")
+        values = self.values if np.all(order == np.arange(len(order))) else self.values[order]
+        dates = dates[order]
+        days, starts = np.unique(dates.asi8, return_index=True)
+
+        missing = np.isnan(values)
+        sums = np.add.reduceat(np.where(missing, 0, values), starts, axis=0, dtype=np.float64)
+        counts = np.add.reduceat(~missing, starts, axis=0)
+        maxs = np.fmax.reduceat(values, starts, axis=0).astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts
+
+        return pd.DataFrame({
+            "tile_id": np.repeat(self.tile_ids, len(days)),
+            "date": np.tile(pd.DatetimeIndex(days).date, len(self.tile_ids)),
+            "rainfall_mm": means.T.ravel(),
+            "rainfall_max_mm": maxs.T.ravel(),
+            "rainfall_sum_mm": sums.T.ravel(),
+        })
 
 
 def get_weather_stations(station_ids, measurement):
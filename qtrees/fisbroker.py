@@ -1,15 +1,28 @@
 import os
+import re
+import json
+import math
+import shutil
+import itertools
 import requests
+import fiona
 import geopandas as gpd
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from requests import Request
+from requests.adapters import HTTPAdapter
 from owslib.wfs import WebFeatureService
 from datetime import datetime
 import pytz
 from qtrees.helper import get_logger
+from qtrees.db_writer import copy_to_db
+from qtrees.geo_cache import GeoParquetCache, DEFAULT_MAX_AGE, iter_parquet_batches
 
 logger = get_logger(__name__)
 
+FIS_BROKER_WFS_URL = "http://fbinter.stadt-berlin.de/fb/wfs/data/senstadt/"
+DEFAULT_PAGE_SIZE = 50000
+
 
 def _prepare_tree_data(gdf, street_tree):
     gdf = gdf.to_crs(4326)
@@ -28,10 +41,48 @@ def _prepare_tree_data(gdf, street_tree):
     gdf.drop_duplicates(subset=['id'], keep='first', inplace=True)
     return gdf, duplicates_in_batch
 
+def read_file_batchwise(file_path, batch_size):
+    """
+    read a GML, GeoJSON or GeoParquet file once from start to end, batch by batch
+
+    Same columns, crs and datetime handling as gpd.read_file, but the file is parsed a single time instead of once per
+    gpd.read_file(file_path, rows=slice(start, stop)) call.
+
+    Parameters
+    ----------
+    file_path: str
+        filename of a vector file readable by fiona or of a GeoParquet file
+    batch_size: int
+        number of features per batch
+
+    Returns
+    -------
+        generator of GeoDataFrames with at most batch_size rows, the last one may be empty
+    """
+    if file_path.endswith(".parquet"):
+        yield from iter_parquet_batches(file_path, batch_size)
+        return
+    with fiona.open(file_path) as features:
+        crs = features.crs.to_epsg(confidence_threshold=100) or features.crs_wkt or None
+        columns = list(features.schema["properties"])
+        datetime_fields = [k for (k, v) in features.schema["properties"].items() if v == "datetime"]
+        features = iter(features)
+        while True:
+            batch = list(itertools.islice(features, batch_size))
+            gdf = gpd.GeoDataFrame.from_features(batch, crs=crs, columns=columns + ["geometry"])
+            for k in datetime_fields:
+                gdf[k] = pd.to_datetime(gdf[k], errors="ignore")
+            yield gdf
+            if len(batch) < batch_size:
+                break
+
+
 def store_trees_batchwise_to_db(trees_file, street_tree, engine, lu_ids=None, n_batch_size=100000):
     """
     load tree file, process data, remove duplicates and stored it into a db - all batchwise
 
+    The file is read in a single pass and every batch is appended to public.trees with COPY.
+
     Parameters
     ----------
     trees_file: str
@@ -48,14 +99,13 @@ def store_trees_batchwise_to_db(trees_file, street_tree, engine, lu_ids=None, n_
     -------
         set, with tree ids so far
     """
-    n_start = 0
     n_round = 0
     lu_ids = lu_ids or set()
 
-    while True:
-        n_end = n_start + n_batch_size
-        gdf = gpd.read_file(trees_file, rows=slice(n_start, n_end))
+    for gdf in read_file_batchwise(trees_file, n_batch_size):
         n_rows = len(gdf)
+        if n_rows == 0:
+            break
         # prepare data and remove patch-internal duplicates
         gdf, duplicates_in_batch = _prepare_tree_data(gdf, street_tree=street_tree)
         duplicates_between_batches = lu_ids.intersection(gdf["id"])
@@ -71,25 +121,233 @@ def store_trees_batchwise_to_db(trees_file, street_tree, engine, lu_ids=None, n_
 
         n_round += 1
         logger.info("Writing into db - batch %s (%s)", n_round, len(gdf))
-        n_start = n_end
 
         try:
-            gdf.to_postgis("trees", engine, if_exists="append", schema="public")
+            copy_to_db(gdf, "trees", engine, schema="public")
         except Exception as e:
             logger.error("Cannot write to db: %s", e)
             exit(121)
 
-        # running out of data
-        if len(gdf) < n_batch_size - n_duplicates:
-            break
-
     return lu_ids
 
 
-def download_tree_file(dir_data, type, use_cached=True):
+class WfsDownloader:
+    """
+    Downloads a WFS layer page by page
+
+    The layer is requested in pages of page_size features with startIndex and count, sorted by the property sort_by, since WFS 2.0
+    does not guarantee the same order of the features across requests without sortBy. Pages are downloaded by a bounded
+    pool of workers sharing one HTTP session and every response is streamed to its own file in target_dir, so no page is
+    held in memory. A page is written to a temporary file first and renamed once complete. Pages already on disk are not
+    requested again, so a download interrupted by a failure resumes with the missing pages. The number of matched
+    features is stored with the pages, pages of an earlier download with a different number are discarded.
+
+    Attributes
+    ----------
+    url : str
+        Url of the WFS
+    type_name : str
+        Name of the feature type, e.g. fis:s_wfs_baumbestand
+    target_dir : str
+        Directory of the downloaded pages
+    page_size : int
+        Number of features per page
+    max_workers : int
+        Maximal number of concurrent requests
+    srs_name : str
+        CRS of the returned features
+    timeout : float
+        Timeout of a single request in seconds
+    sort_by : str
+        Property with a unique value per feature the pages are sorted by, None to keep the order of the server
+    number_matched : int
+        Number of features of the layer reported by the server during the last download, None if it did not tell
+
+    Methods
+    -------
+    download():
+        Downloads all missing pages and returns the paths of all pages in order.
+    hits():
+        Returns the number of features of the layer, None if the server does not tell.
+    """
+
+    def __init__(self, url, type_name, target_dir, page_size=DEFAULT_PAGE_SIZE, max_workers=4, srs_name="EPSG:25833",
+                 timeout=300, sort_by="gisid"):
+        self.url = url
+        self.type_name = type_name
+        self.target_dir = target_dir
+        self.page_size = page_size
+        self.max_workers = max_workers
+        self.srs_name = srs_name
+        self.timeout = timeout
+        self.sort_by = sort_by
+        self.number_matched = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.target_dir, "manifest.json")
+
+    def page_path(self, page):
+        return os.path.join(self.target_dir, f"page_{page:05d}.xml")
+
+    def params(self, **kwargs):
+        return dict(service="WFS", version="2.0.0", request="GetFeature", typeNames=self.type_name, srsName=self.srs_name,
+                    **kwargs)
+
+    def hits(self):
+        resp = self.session.get(self.url, params=self.params(resultType="hits"), timeout=self.timeout)
+        resp.raise_for_status()
+        match = re.search(r'numberMatched="(\d+)"', resp.text)
+        return int(match.group(1)) if match else None
+
+    def download(self):
+        os.makedirs(self.target_dir, exist_ok=True)
+        n_features = self.hits()
+        self.number_matched = n_features
+        self._check_manifest(n_features)
+        if n_features is not None:
+            n_pages = max(math.ceil(n_features / self.page_size), 1)
+            logger.info("Downloading %s features of %s in %s pages.", n_features, self.type_name, n_pages)
+            return self._download_pages(range(n_pages))
+
+        # unknown size, request max_workers pages at a time until a page is not full
+        paths = []
+        while True:
+            pages = range(len(paths), len(paths) + self.max_workers)
+            paths += self._download_pages(pages)
+            if any(_number_returned(path) < self.page_size for path in paths[-len(pages):]):
+                return paths
+
+    def _check_manifest(self, n_features):
+        manifest = dict(type_name=self.type_name, page_size=self.page_size, number_matched=n_features, sort_by=self.sort_by)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                if json.load(f) == manifest:
+                    return
+        for f in os.listdir(self.target_dir):
+            if f.startswith("page_"):
+                os.remove(os.path.join(self.target_dir, f))
+        with open(self.manifest_path, "w") as f:
+            json.dump(manifest, f)
+
+    def _download_pages(self, pages):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(self._download_page, pages))
+
+    def _download_page(self, page):
+        path = self.page_path(page)
+        if os.path.exists(path):
+            return path
+        tmp_path = path + ".part"
+        params = self.params(startIndex=page * self.page_size, count=self.page_size)
+        if self.sort_by is not None:
+            params["sortBy"] = f"{self.sort_by} ASC"
+        with self.session.get(self.url, params=params, stream=True, timeout=self.timeout) as resp:
+            resp.raise_for_status()
+            with open(tmp_path, "wb") as f:
+                for chunk in resp.iter_content(chunk_size=2**20):
+                    f.write(chunk)
+        with open(tmp_path, "rb") as f:
+            if b"ExceptionReport" in f.read(2048):
+                os.remove(tmp_path)
+                raise RuntimeError(f"WFS exception for page {page} of {self.type_name}")
+        os.replace(tmp_path, path)
+        logger.debug("Downloaded page %s of %s.", page, self.type_name)
+        return path
+
+
+def _number_returned(path):
+    with open(path, "rb") as f:
+        match = re.search(rb'numberReturned="(\d+)"', f.read(4096))
+    return int(match.group(1)) if match else len(gpd.read_file(path))
+
+
+def iter_wfs_layer(type, target_dir, url=None, page_size=DEFAULT_PAGE_SIZE, max_workers=4, sort_by="gisid"):
+    """
+    download a FIS-Broker layer page by page and read it page by page
+
+    Only the page being read is held in memory. The pages are checked against the number of features reported by the server
+    and for duplicated values of sort_by while they are read, a failed check raises after the last page. The pages are deleted
+    once all of them are read, also if a check failed, so the next attempt downloads them again. If reading stops before the
+    last page, e.g. because the consumer of the pages failed, the pages are kept and the next attempt resumes from them.
+
+    Parameters
+    ----------
+    type: str
+        layer name without the 's_' prefix, e.g. 'wfs_baumbestand'
+    target_dir: str
+        directory for the pages, kept if the download fails so that it can be resumed
+    url: str | None
+        url of the WFS, defaults to the FIS-Broker url of the layer
+    page_size: int
+        number of features per page
+    max_workers: int
+        maximal number of concurrent requests
+    sort_by: str | None
+        property with a unique value per feature, used to order the pages, None to keep the order of the server
+
+    Returns
+    -------
+        generator of GeoDataFrames in EPSG:25833, one per page
+    """
+    url = url or FIS_BROKER_WFS_URL + f"s_{type}"
+    downloader = WfsDownloader(url, f"fis:s_{type}", target_dir, page_size=page_size, max_workers=max_workers, sort_by=sort_by)
+    paths = downloader.download()
+    n_features, n_duplicates, ids = 0, 0, set()
+    for path in paths:
+        gdf = gpd.read_file(path)
+        n_features += len(gdf)
+        if sort_by is not None:
+            n_duplicates += len(gdf) - gdf[sort_by].nunique() + len(ids.intersection(gdf[sort_by]))
+            ids.update(gdf[sort_by])
+        yield gdf
+    shutil.rmtree(target_dir)
+    if downloader.number_matched is not None and n_features != downloader.number_matched:
+        raise RuntimeError(f"Downloaded {n_features} features of {type}, but the server matched {downloader.number_matched}")
+    if n_duplicates > 0:
+        raise RuntimeError(f"Downloaded {n_duplicates} features of {type} more than once, the pages are not in a stable order")
+
+
+def download_wfs_layer(type, target_dir, url=None, page_size=DEFAULT_PAGE_SIZE, max_workers=4, sort_by="gisid"):
+    """
+    download a FIS-Broker layer page by page and read it
+
+    Same as iter_wfs_layer, but returns all pages as one GeoDataFrame.
+
+    Parameters
+    ----------
+    type: str
+        layer name without the 's_' prefix, e.g. 'wfs_baumbestand'
+    target_dir: str
+        directory for the pages, kept if the download fails so that it can be resumed
+    url: str | None
+        url of the WFS, defaults to the FIS-Broker url of the layer
+    page_size: int
+        number of features per page
+    max_workers: int
+        maximal number of concurrent requests
+    sort_by: str | None
+        property with a unique value per feature, used to order the pages, None to keep the order of the server
+
+    Returns
+    -------
+        GeoDataFrame of all features in EPSG:25833
+    """
+    return pd.concat(list(iter_wfs_layer(type, target_dir, url=url, page_size=page_size, max_workers=max_workers,
+                                         sort_by=sort_by)), ignore_index=True)
+
+
+def download_tree_file(dir_data, type, use_cached=True, max_age=DEFAULT_MAX_AGE):
     """
     download and store raw tree data
 
+    The WFS response is parsed once and cached as GeoParquet in dir_data, which is much faster to read than the raw XML. The
+    pages of the response are appended to the cache one by one, so the layer is never held in memory as a whole.
+
     Parameters
     ----------
     dir_data: str
@@ -98,84 +356,86 @@ def download_tree_file(dir_data, type, use_cached=True):
         defines tree dataset - currently 'wfs_baumbestand' or 'wfs_baumbestand_an'
     use_cached: bool
         defines if cached data is used or data should be downloaded again
+    max_age: datetime.timedelta | None
+        age after which cached data is downloaded again, None to use cached data regardless of its age
 
     Returns
     -------
         str, filename for raw tree data
 
     """
-    trees_file = os.path.join(dir_data, f"{type}.xml")
-    if os.path.exists(trees_file) and use_cached:
-        return trees_file
+    cache = GeoParquetCache(dir_data, max_age=max_age)
+    if use_cached and not cache.is_stale(type):
+        return cache.latest(type)[1]
 
     logger.info("Downloading '%s' data", type)
-    params = dict(service="WFS", version="2.0.0", request='GetFeature', typeNames=f"fis:s_{type}",
-                  srsName="EPSG:25833")
-    url = f"http://fbinter.stadt-berlin.de/fb/wfs/data/senstadt/s_{type}"
+    return cache.write_batches(type, iter_wfs_layer(type, os.path.join(dir_data, f"{type}_pages")))
+
 
-    r = requests.get(url, params=params)
-    with open(trees_file, 'wb') as f:
-        f.write(r.content)
-    return trees_file
+def _download_trees(dir_data):
+    trees_gdf_an = download_wfs_layer("wfs_baumbestand_an", os.path.join(dir_data, "wfs_baumbestand_an_pages")).to_crs(4326)
+    trees_gdf_an["street_tree"] = False
 
+    trees_gdf_street = download_wfs_layer("wfs_baumbestand", os.path.join(dir_data, "wfs_baumbestand_pages")).to_crs(4326)
+    trees_gdf_street["street_tree"] = True
 
-def get_trees(trees_file):
+    trees_gdf = pd.concat([trees_gdf_street, trees_gdf_an])
+
+    trees_gdf['lat'] = trees_gdf.geometry.y
+    trees_gdf['lng'] = trees_gdf.geometry.x
+    now = datetime.now(pytz.timezone("UTC"))
+    trees_gdf['created_at'] = now
+    trees_gdf['updated_at'] = now
+    trees_gdf = trees_gdf.rename(columns={"baumid": "id"})
+    trees_gdf = trees_gdf.drop('gml_id', axis=1)
+    return trees_gdf
+
+
+def get_trees(trees_file, columns=None, max_age=DEFAULT_MAX_AGE):
+    """
+    street and anlagen trees, downloaded from the WFS if the cache is missing or stale
+
+    Parameters
+    ----------
+    trees_file: str
+        cache file, the trees are cached as GeoParquet in its directory under its name without extension
+    columns: list | None
+        columns to read besides the geometry, all if None
+    max_age: datetime.timedelta | None
+        age after which the trees are downloaded again, None to use cached trees regardless of their age
+
+    Returns
+    -------
+        GeoDataFrame of trees
+    """
     if os.path.isdir(trees_file):
         logger.warning("%s is not a valid file.", trees_file)
         return None
 
-    if not os.path.exists(os.path.dirname(trees_file)):
-        os.makedirs(os.path.dirname(trees_file))
-
-    if os.path.exists(trees_file):
-        trees_gdf = gpd.read_file(trees_file, driver='GeoJSON')
-        logger.debug("Reading trees geo data frames from %s.", trees_file)
-    else:
-        params = dict(service="WFS", version="2.0.0", request='GetFeature', typeNames="fis:s_wfs_baumbestand_an",
-                      srsName="EPSG:25833")
-        url = "http://fbinter.stadt-berlin.de/fb/wfs/data/senstadt/s_wfs_baumbestand_an"
-        q = requests.Request('GET', url, params=params).prepare().url
-        trees_gdf_an = gpd.read_file(q).to_crs(4326)
-        trees_gdf_an["street_tree"] = False
-
-        params = dict(service="WFS", version="2.0.0", request='GetFeature', typeNames="fis:s_wfs_baumbestand",
-                      srsName="EPSG:25833")
-        url = "http://fbinter.stadt-berlin.de/fb/wfs/data/senstadt/s_wfs_baumbestand"
-        q = requests.Request('GET', url, params=params).prepare().url
-        trees_gdf_street = gpd.read_file(q).to_crs(4326)
-        trees_gdf_street["street_tree"] = True
-
-        trees_gdf = pd.concat([trees_gdf_street, trees_gdf_an])
-
-        trees_gdf['lat'] = trees_gdf.geometry.y
-        trees_gdf['lng'] = trees_gdf.geometry.x
-        # geopandas.to_file has problems with datetime
-        now = datetime.now(pytz.timezone("UTC"))
-        trees_gdf['created_at'] = now
-        trees_gdf['updated_at'] = now
-        trees_gdf = trees_gdf.rename(columns={"baumid": "id"})
-        trees_gdf = trees_gdf.drop('gml_id', axis=1)
-
-        logger.debug("Saving trees geo data frames to %s.", trees_file)
-        trees_gdf.to_file(trees_file, driver='GeoJSON')
-
-    trees_gdf['created_at'] = pd.to_datetime(trees_gdf['created_at'])
-    trees_gdf['updated_at'] = pd.to_datetime(trees_gdf['updated_at'])
+    dir_data = os.path.dirname(trees_file) or "."
+    cache = GeoParquetCache(dir_data, max_age=max_age)
+    layer = os.path.splitext(os.path.basename(trees_file))[0]
+    trees_gdf = cache.get(layer, lambda: _download_trees(dir_data), columns=columns)
+    logger.debug("Reading trees geo data frames from %s.", cache.latest(layer)[1])
+
+    for column in ['created_at', 'updated_at']:
+        if column in trees_gdf.columns:
+            trees_gdf[column] = pd.to_datetime(trees_gdf[column])
     return trees_gdf
 
 
 # request wfs
-def get_gdf(url, crs, geojson_file):
-    if not os.path.isfile(geojson_file):
+def get_gdf(url, crs, geojson_file, columns=None, max_age=None):
+    def fetch():
         logger.debug("Gdf doesn't exist, making a wfs request.")
         wfs = WebFeatureService(url=url)
         layer = list(wfs.contents)[-1]
         params = dict(service="wfs", version="2.0.0", request='GetFeature', TYPENAMES=layer, crs=crs)
         q = Request('GET', url, params=params).prepare().url
         gdf = gpd.read_file(q).set_crs(epsg=25833)
-        gdf = gdf.to_crs(4326)
-        logger.debug("Saving geojson...")
-        gdf.to_file(geojson_file, driver='GeoJSON')
-    logger.debug("Reading geojson file...")
-    gdf = gpd.read_file(geojson_file, driver='GeoJSON')
-    return gdf
+        return gdf.to_crs(4326)
+
+    # the gdf is cached as GeoParquet next to geojson_file under its name without extension
+    cache = GeoParquetCache(os.path.dirname(geojson_file) or ".", max_age=max_age)
+    logger.debug("Reading cached gdf...")
+    return cache.get(os.path.splitext(os.path.basename(geojson_file))[0], fetch, columns=columns)
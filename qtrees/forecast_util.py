@@ -1,6 +1,9 @@
-from qtrees.helper import get_logger
+from qtrees.helper import get_logger, read_sql
+from qtrees.constants import PREPROCESSING_HYPERPARAMS
 import datetime
+import warnings
 import pytz
+import numpy as np
 import pandas as pd
 
 logger = get_logger(__name__)
@@ -48,4 +51,224 @@ def check_last_data(engine):
         nowcast_date = yesterday
         logger.info("Creating nowcast for yesterday: %s.", nowcast_date)
 
-    return nowcast_date
\ No newline at end of file
+    return nowcast_date
+
+
+def predict_depths(models, X):
+    """
+    Scores the models of all sensor depths on the same feature matrix
+
+    Parameters
+    ----------
+    models: dict
+        Fitted model per type_id
+    X: pandas.DataFrame
+        Features indexed by tree_id
+
+    Returns
+    -------
+        pandas.DataFrame with columns tree_id, type_id and value. The mean over all depths is added as type_id 4.
+    """
+    y_hat = pd.DataFrame({type_id: model.predict(X) for type_id, model in models.items()}, index=X.index)
+    y_hat[4] = y_hat.mean(axis=1)
+    y_hat.columns.name = "type_id"
+    return y_hat.stack().rename("value").reset_index()
+
+
+WEATHER_CONTEXT_QUERY = """
+SELECT DISTINCT ON (date) date, {columns}
+FROM (
+    SELECT date, NULL::timestamptz AS created_at, {columns}
+    FROM private.weather_tile_measurement
+    WHERE tile_id = %(tile_id)s AND date > %(start)s AND date <= %(last_date)s
+    UNION ALL
+    SELECT date, created_at, {columns}
+    FROM private.weather_tile_forecast
+    WHERE tile_id = %(tile_id)s AND date > %(last_date)s AND date <= %(end)s
+) weather
+ORDER BY date, created_at DESC
+"""
+
+
+class WeatherContext:
+    """
+    Weather of one forecast run
+
+    Loads the measured weather of the lag window up to last_date and the latest weather forecast for the forecast horizon
+    after last_date in a single query. The result is kept in memory, indexed by date, and shared by all batches and depths.
+
+    Attributes
+    ----------
+    last_date : pandas.Timestamp
+        Last day with measured weather, the forecast starts the day after
+    columns : list of strings
+        Weather features to load
+    history_days : int
+        Number of measured days up to and including last_date
+    horizon : int
+        Number of forecast days after last_date
+    tile_id : int
+        Weather tile to use
+    weather : pandas.DataFrame
+        Weather features indexed by date
+
+    Methods
+    -------
+    load(engine):
+        Downloads the weather of the whole window.
+    get(date):
+        Returns the weather features of a day as a pandas.Series.
+    """
+
+    def __init__(self, last_date, columns, history_days=PREPROCESSING_HYPERPARAMS["autoreg_lag"],
+                 horizon=PREPROCESSING_HYPERPARAMS["fc_horizon"], tile_id=PREPROCESSING_HYPERPARAMS["tile_id"]):
+        self.last_date = pd.Timestamp(last_date)
+        self.columns = list(columns)
+        self.history_days = history_days
+        self.horizon = horizon
+        self.tile_id = tile_id
+        self.weather = None
+
+    @property
+    def dates(self):
+        return pd.date_range(end=self.last_date, periods=self.history_days).append(
+            pd.date_range(start=self.last_date + pd.Timedelta(days=1), periods=self.horizon))
+
+    def load(self, engine):
+        params = dict(tile_id=self.tile_id, last_date=self.last_date.date(),
+                      start=(self.last_date - pd.Timedelta(days=self.history_days)).date(),
+                      end=(self.last_date + pd.Timedelta(days=self.horizon)).date())
+        try:
+            weather = read_sql(engine, WEATHER_CONTEXT_QUERY.format(columns=", ".join(self.columns)), params=params, index_col="date")
+        except Exception as e:
+            logger.error("Failed to get weather data from DB: %s", e)
+            exit(121)
+        weather.index = pd.DatetimeIndex(weather.index).tz_localize(self.last_date.tz)
+        missing = self.dates.difference(weather.index)
+        if len(missing) > 0:
+            logger.error("No weather data for tile %s on %s.", self.tile_id, ", ".join(str(x.date()) for x in missing))
+            exit(121)
+        self.weather = weather
+        return self
+
+    def get(self, date):
+        return self.weather.loc[pd.Timestamp(date)]
+
+
+class RecursiveForecaster:
+    """
+    Recursive multi-day forecast for one sensor depth
+
+    The features of all trees of a batch are kept in a preallocated float32 array with one row per tree. The weather and
+    autoregressive columns are updated in place for every forecast day, so each day is a single predict call on a contiguous
+    buffer without intermediate DataFrames. The history of the autoregressive features is initialized with the auxiliary
+    nowcast model for the days up to the last measured day.
+
+    Attributes
+    ----------
+    model :
+        Fitted forecast model using features + autoreg_columns
+    aux_model :
+        Fitted auxiliary nowcast model using features only
+    features : list of strings
+        Features of the auxiliary model, in training order
+    weather_columns : list of strings
+        Features that are taken from the weather of the predicted day
+    lags : list of int
+        Lags of the shift_i features
+    windows : list of int
+        Windows of the rolling_mean_w features
+
+    Methods
+    -------
+    predict(base_X, weather):
+        Forecasts every tree of base_X for all days of the forecast horizon of weather.
+    """
+
+    def __init__(self, model, aux_model, features, weather_columns, lags, windows=()):
+        self.model = model
+        self.aux_model = aux_model
+        self.features = list(features)
+        self.weather_columns = [x for x in self.features if x in weather_columns]
+        self.lags = list(lags)
+        self.windows = list(windows)
+        self.history_days = max(self.lags + self.windows)
+
+    @property
+    def autoreg_columns(self):
+        return [f"shift_{i}" for i in self.lags] + [f"rolling_mean_{w}" for w in self.windows]
+
+    def predict(self, base_X, weather):
+        """
+        Forecasts every tree of base_X for all days of the forecast horizon
+
+        Parameters
+        ----------
+        base_X: pandas.DataFrame
+            Static features indexed by tree_id
+        weather: WeatherContext
+            Loaded weather covering at least history_days days up to the last measured day
+
+        Returns
+        -------
+            pandas.DataFrame indexed by tree_id with one column of predictions per forecast day
+        """
+        n_trees, n_features = len(base_X), len(self.features)
+        weather_idx = [self.features.index(x) for x in self.weather_columns]
+        X = np.empty((n_trees, n_features + len(self.autoreg_columns)), dtype=np.float32)
+        for j, col in enumerate(self.features):
+            if col not in self.weather_columns:
+                X[:, j] = base_X[col].to_numpy(dtype=np.float32)
+        X_aux = np.array(X[:, :n_features])
+
+        # history[:, k] holds the value k+1 days before the predicted day
+        history = np.empty((n_trees, self.history_days))
+        for k in range(self.history_days):
+            X_aux[:, weather_idx] = self._weather(weather, weather.last_date - pd.Timedelta(days=k))
+            history[:, k] = _predict(self.aux_model, X_aux)
+
+        dates = pd.date_range(weather.last_date + pd.Timedelta(days=1), periods=weather.horizon, name="timestamp")
+        y_hat = np.empty((n_trees, len(dates)))
+        lag_idx = n_features + np.arange(len(self.lags))
+        for h, date in enumerate(dates):
+            X[:, weather_idx] = self._weather(weather, date)
+            X[:, lag_idx] = history[:, [i - 1 for i in self.lags]]
+            for j, w in enumerate(self.windows):
+                X[:, n_features + len(self.lags) + j] = history[:, :w].mean(axis=1)
+            y_hat[:, h] = _predict(self.model, X)
+            history[:, 1:] = history[:, :-1]
+            history[:, 0] = y_hat[:, h]
+        return pd.DataFrame(y_hat, index=base_X.index, columns=dates)
+
+    def _weather(self, weather, date):
+        return weather.get(date)[self.weather_columns].to_numpy(dtype=np.float32)
+
+
+def forecast_depths(forecasters, base_X, weather):
+    """
+    Forecasts all sensor depths for the same batch of trees
+
+    Parameters
+    ----------
+    forecasters: dict
+        RecursiveForecaster per type_id
+    base_X: pandas.DataFrame
+        Static features indexed by tree_id
+    weather: WeatherContext
+        Loaded weather of the forecast run
+
+    Returns
+    -------
+        pandas.DataFrame with columns type_id, tree_id, timestamp and value. The mean over all depths is added as type_id 4.
+    """
+    y_hat = pd.concat({type_id: forecaster.predict(base_X, weather) for type_id, forecaster in forecasters.items()},
+                      names=["type_id"])
+    y_hat = pd.concat([y_hat, pd.concat({4: y_hat.groupby(level=1, sort=False, observed=True).mean()}, names=["type_id"])])
+    return y_hat.stack().rename("value").reset_index()
+
+
+def _predict(model, X):
+    # The models are fitted on DataFrames, the feature order is guaranteed by the caller
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="X does not have valid feature names")
+        return model.predict(X)
@@ -0,0 +1,185 @@
+import os
+import re
+import json
+import shutil
+import datetime
+import tempfile
+import pytz
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyproj import CRS
+
+from qtrees.helper import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_MAX_AGE = datetime.timedelta(days=30)
+TIMESTAMP_FORMAT = "%Y%m%dT%H%M%SZ"
+
+
+class GeoParquetCache:
+    """
+    Caches downloaded layers as GeoParquet files
+
+    Every layer is stored as <cache_dir>/<layer>/<download timestamp>.parquet, only the latest download of a layer is kept.
+    GeoParquet is read column by column, so reading a subset of the columns only decodes those columns, and reading it is an
+    order of magnitude faster than parsing the GML or GeoJSON responses of the WFS.
+
+    Attributes
+    ----------
+    cache_dir : str
+        Root directory of the cache
+    max_age : datetime.timedelta
+        Age after which a cached layer is fetched again, None if cached layers never expire
+
+    Methods
+    -------
+    get(layer, fetch, columns):
+        Returns the cached layer, calling fetch to download it if it is missing or stale.
+    read(layer, columns):
+        Returns the cached layer, None if it is not cached.
+    write(layer, gdf):
+        Stores a new download of the layer.
+    write_batches(layer, batches):
+        Stores a new download of the layer that is passed batch by batch, holding a single batch in memory.
+    latest(layer):
+        Returns timestamp and path of the latest download of the layer.
+    """
+
+    def __init__(self, cache_dir, max_age=DEFAULT_MAX_AGE):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+
+    def path(self, layer, timestamp):
+        return os.path.join(self.cache_dir, layer, timestamp.astimezone(pytz.utc).strftime(TIMESTAMP_FORMAT) + ".parquet")
+
+    def latest(self, layer):
+        layer_dir = os.path.join(self.cache_dir, layer)
+        if not os.path.isdir(layer_dir):
+            return None, None
+        files = sorted(f for f in os.listdir(layer_dir) if re.fullmatch(r"\d{8}T\d{6}Z\.parquet", f))
+        if len(files) == 0:
+            return None, None
+        timestamp = pytz.utc.localize(datetime.datetime.strptime(files[-1][:-len(".parquet")], TIMESTAMP_FORMAT))
+        return timestamp, os.path.join(layer_dir, files[-1])
+
+    def is_stale(self, layer, max_age=None):
+        max_age = max_age or self.max_age
+        timestamp, _ = self.latest(layer)
+        if timestamp is None:
+            return True
+        return max_age is not None and datetime.datetime.now(pytz.utc) - timestamp > max_age
+
+    def read(self, layer, columns=None):
+        _, file_path = self.latest(layer)
+        if file_path is None:
+            return None
+        if columns is not None:
+            geometry_column = json.loads(pq.read_schema(file_path).metadata[b"geo"])["primary_column"]
+            columns = list(columns) + ([geometry_column] if geometry_column not in columns else [])
+        logger.debug("Reading %s from %s.", layer, file_path)
+        return gpd.read_parquet(file_path, columns=columns)
+
+    def write(self, layer, gdf, timestamp=None):
+        timestamp = timestamp or datetime.datetime.now(pytz.utc)
+        file_path = self.path(layer, timestamp)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = file_path + ".tmp"
+        gdf.to_parquet(tmp_path, index=False)
+        self._replace(tmp_path, file_path)
+        logger.debug("Cached %s rows of %s in %s.", len(gdf), layer, file_path)
+        return file_path
+
+    def write_batches(self, layer, batches, timestamp=None):
+        timestamp = timestamp or datetime.datetime.now(pytz.utc)
+        file_path = self.path(layer, timestamp)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = file_path + ".tmp"
+        parts_dir = tempfile.mkdtemp(dir=os.path.dirname(file_path))
+        try:
+            # every batch is written on its own first, the columns and types of all batches are only known at the end
+            parts = []
+            for gdf in batches:
+                parts.append(os.path.join(parts_dir, f"part_{len(parts):05d}.parquet"))
+                gdf.to_parquet(parts[-1], index=False)
+            if len(parts) == 0:
+                raise ValueError(f"No batches to cache for {layer}")
+            n_rows = _concat_parquet_files(parts, tmp_path)
+            self._replace(tmp_path, file_path)
+        finally:
+            shutil.rmtree(parts_dir)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        logger.debug("Cached %s rows of %s in %s batches in %s.", n_rows, layer, len(parts), file_path)
+        return file_path
+
+    def _replace(self, tmp_path, file_path):
+        '''Moves the new download into place and removes all older downloads of the layer'''
+        os.replace(tmp_path, file_path)
+        for f in os.listdir(os.path.dirname(file_path)):
+            if f.endswith(".parquet") and f != os.path.basename(file_path):
+                os.remove(os.path.join(os.path.dirname(file_path), f))
+
+    def get(self, layer, fetch, columns=None, max_age=None):
+        if self.is_stale(layer, max_age=max_age):
+            logger.info("Cache of %s is missing or stale, downloading.", layer)
+            self.write(layer, fetch())
+        return self.read(layer, columns=columns)
+
+
+def _concat_parquet_files(parts, file_path):
+    '''Copies GeoParquet files into one file part by part. Columns missing in a part are filled with nulls, types are promoted
+    across parts, e.g. a column without values in one part and strings in another, and the bounding boxes and geometry types of
+    the geo metadata are merged.'''
+    schemas = [pq.read_schema(part) for part in parts]
+    geo = json.loads(schemas[0].metadata[b"geo"])
+    for schema in schemas[1:]:
+        for name, column in json.loads(schema.metadata[b"geo"])["columns"].items():
+            merged = geo["columns"][name]
+            merged["geometry_types"] = sorted(set(merged["geometry_types"]) | set(column["geometry_types"]))
+            if "bbox" in merged and "bbox" in column:
+                merged["bbox"] = [min(merged["bbox"][0], column["bbox"][0]), min(merged["bbox"][1], column["bbox"][1]),
+                                  max(merged["bbox"][2], column["bbox"][2]), max(merged["bbox"][3], column["bbox"][3])]
+    schema = pa.unify_schemas([schema.remove_metadata() for schema in schemas], promote_options="permissive")
+    # the pandas metadata of a part does not describe the unified columns, the arrow types are enough to read the file back
+    schema = schema.with_metadata({b"geo": json.dumps(geo).encode()})
+    n_rows = 0
+    with pq.ParquetWriter(file_path, schema) as writer:
+        for part in parts:
+            table = pq.read_table(part)
+            columns = [table[name].cast(field.type) if name in table.column_names else pa.nulls(len(table), field.type)
+                       for name, field in zip(schema.names, schema)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            n_rows += len(table)
+    return n_rows
+
+
+def iter_parquet_batches(file_path, batch_size, columns=None):
+    """
+    read a GeoParquet file batch by batch
+
+    Parameters
+    ----------
+    file_path: str
+        filename of a GeoParquet file
+    batch_size: int
+        number of rows per batch
+    columns: list | None
+        columns to read, all if None
+
+    Returns
+    -------
+        generator of GeoDataFrames with at most batch_size rows
+    """
+    parquet_file = pq.ParquetFile(file_path)
+    geo = json.loads(parquet_file.schema_arrow.metadata[b"geo"])
+    geometry_column = geo["primary_column"]
+    crs = geo["columns"][geometry_column].get("crs", "OGC:CRS84")
+    crs = CRS.from_json_dict(crs) if isinstance(crs, dict) else CRS.from_user_input(crs) if crs is not None else None
+    if columns is not None and geometry_column not in columns:
+        columns = list(columns) + [geometry_column]
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        df = batch.to_pandas()
+        df[geometry_column] = gpd.GeoSeries.from_wkb(df[geometry_column], crs=crs)
+        yield gpd.GeoDataFrame(df, geometry=geometry_column, crs=crs)
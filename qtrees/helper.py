@@ -1,13 +1,24 @@
+import atexit
 import logging
 import os
+import time
 import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 
 
 _db_lookup_env = {
-    "qtrees": {"db": "DB_QTREES", "passwd": "POSTGRES_PASSWD"},
-    "gdk": {"db": "DB_GDK", "passwd": "GDK_PASSWD"},
+    "qtrees": {"db": "DB_QTREES", "passwd": "POSTGRES_PASSWD", "user": "postgres", "database": "qtrees"},
+    "gdk": {"db": "DB_GDK", "passwd": "GDK_PASSWD", "user": "qtrees_readonly", "database": "postgres"},
 }
 
+# Connections kept open per process, plus overflow connections opened on demand
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 5
+# Queries running longer are cancelled by Postgres, training reads the full sensor tables
+DB_STATEMENT_TIMEOUT_MS = 30 * 60 * 1000
+
 
 def init_db_args(db, db_type, logger):
     db_conf = _db_lookup_env.get(db_type)
@@ -28,6 +39,160 @@ def init_db_args(db, db_type, logger):
     return db, passwd
 
 
+def read_sql(engine, sql, params=None, **kwargs):
+    '''pandas.read_sql on a pooled connection that is returned to the pool afterwards'''
+    with engine.connect() as con:
+        return pd.read_sql(sql, con, params=params, **kwargs)
+
+
+class QueryMetrics:
+    """
+    Collects the execution time of every query of an engine
+
+    Attributes
+    ----------
+    logger : Logger
+        Logs every query at debug level and the summary at info level
+    count : int
+        Number of executed queries
+    total_s : float
+        Total execution time in seconds
+    slowest_s : float
+        Execution time of the slowest query in seconds
+    slowest_statement : str
+        Slowest query
+
+    Methods
+    -------
+    register(engine):
+        Starts timing the queries of engine.
+    log_summary():
+        Logs the number and duration of all queries so far.
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger or get_logger(__name__)
+        self.count = 0
+        self.total_s = 0.
+        self.slowest_s = 0.
+        self.slowest_statement = None
+
+    def register(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        self.count += 1
+        self.total_s += elapsed
+        if elapsed >= self.slowest_s:
+            self.slowest_s, self.slowest_statement = elapsed, statement
+        self.logger.debug("Query took %.3fs: %s", elapsed, " ".join(statement.split())[:200])
+
+    def _handle_error(self, context):
+        # failed queries, e.g. cancelled by the statement timeout, are not timed
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
+
+    def log_summary(self):
+        if self.count > 0:
+            self.logger.info("%s queries took %.1fs, slowest %.1fs: %s", self.count, self.total_s, self.slowest_s,
+                             " ".join(self.slowest_statement.split())[:200])
+
+
+class DBSession:
+    """
+    Shared, pooled access to a DB for a whole script run
+
+    All queries of a run go through one engine with a connection pool of bounded size, so connections are reused and the
+    number of open connections never exceeds pool_size + max_overflow. Postgres cancels statements that run longer than
+    statement_timeout_ms, every query is timed and a summary is logged when the session is closed, at the latest when the
+    process exits.
+
+    Attributes
+    ----------
+    engine : sqlalchemy.engine.Engine
+        Pooled engine, to be used with context-managed connections only
+    metrics : QueryMetrics
+        Timing of all queries of the session
+    logger : Logger
+        Logger for errors and metrics
+
+    Methods
+    -------
+    connect():
+        Returns a pooled connection, to be used as context manager.
+    begin():
+        Returns a pooled connection within a transaction, to be used as context manager.
+    read_sql(sql, params, **kwargs):
+        Runs pandas.read_sql on a pooled connection.
+    close():
+        Logs the query metrics and closes all pooled connections.
+    """
+
+    def __init__(self, db=None, db_type="qtrees", logger=None, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                 statement_timeout_ms=DB_STATEMENT_TIMEOUT_MS, url=None):
+        """
+        Parameters
+        ----------
+            db : str, optional
+                Host of the DB, read from the environment as in init_db_args if not given
+            db_type : str
+                Key of the DB config, "qtrees" or "gdk"
+            logger : Logger, optional
+                A logger for writing error messages. If none is provided, the function creates one
+            pool_size : int
+                Number of connections kept open
+            max_overflow : int
+                Number of additional connections opened under load
+            statement_timeout_ms : int
+                Maximal duration of a statement in milliseconds, None for no timeout
+            url : str, optional
+                Connection URL overriding db and db_type
+        """
+        self.logger = logger or get_logger(__name__)
+        if url is None:
+            db, passwd = init_db_args(db=db, db_type=db_type, logger=self.logger)
+            db_conf = _db_lookup_env[db_type]
+            url = f"postgresql://{db_conf['user']}:{passwd}@{db}:5432/{db_conf['database']}"
+        connect_args = {}
+        if statement_timeout_ms is not None and url.startswith("postgresql"):
+            connect_args["options"] = f"-c statement_timeout={int(statement_timeout_ms)}"
+        self.engine = create_engine(url, poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                                    pool_pre_ping=True, connect_args=connect_args)
+        self.metrics = QueryMetrics(self.logger)
+        self.metrics.register(self.engine)
+        self._closed = False
+        atexit.register(self.close)
+
+    def connect(self):
+        return self.engine.connect()
+
+    def begin(self):
+        return self.engine.begin()
+
+    def read_sql(self, sql, params=None, **kwargs):
+        return read_sql(self.engine, sql, params=params, **kwargs)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self.metrics.log_summary()
+        self.engine.dispose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 def get_logger(name, log_level=logging.DEBUG):
     logger = logging.getLogger(name)
     logger.setLevel(log_level)
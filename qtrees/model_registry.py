@@ -0,0 +1,90 @@
+import os
+import resource
+import time
+import joblib
+
+from qtrees.helper import get_logger
+from qtrees.constants import PATH_TO_MODELS, MODEL_TYPE, MODEL_PREFIX
+
+logger = get_logger(__name__)
+
+
+class ModelRegistry:
+    """
+    Loads model artifacts once per process
+
+    Every artifact is loaded on first use and the same object is handed out on later requests, so scripts and batches share a
+    single copy of each model. Artifacts are read with joblib, which also reads plain pickle files. For artifacts written with
+    dump, numpy arrays are memory-mapped read-only instead of being read into memory.
+
+    Attributes
+    ----------
+    path : str
+        Root directory of the model artifacts
+    prefix : str
+        Prefix of the model file names
+    mmap_mode : str
+        Memory-mapping mode passed to joblib.load, None disables memory-mapping
+
+    Methods
+    -------
+    load(file_path):
+        Returns the artifact stored at file_path, loading it on first use.
+    model(model_type, type_id):
+        Returns the model of the given type for a sensor depth.
+    preprocessor(model_type):
+        Returns the preprocessor of a nowcast or forecast model.
+    dump(obj, file_path):
+        Stores an artifact in a format that can be memory-mapped.
+    """
+
+    def __init__(self, path=PATH_TO_MODELS, prefix=MODEL_PREFIX, mmap_mode="r"):
+        self.path = path
+        self.prefix = prefix
+        self.mmap_mode = mmap_mode
+        self._artifacts = {}
+
+    def model_path(self, model_type, type_id):
+        return os.path.join(self.path, MODEL_TYPE[model_type], self.prefix + f"model_{type_id}.m")
+
+    def preprocessor_path(self, model_type):
+        return os.path.join(self.path, MODEL_TYPE["preprocessor"], f"{MODEL_TYPE['preprocessor']}_{MODEL_TYPE[model_type]}.pkl")
+
+    def model(self, model_type, type_id):
+        return self.load(self.model_path(model_type, type_id))
+
+    def preprocessor(self, model_type):
+        return self.load(self.preprocessor_path(model_type))
+
+    def load(self, file_path):
+        key = os.path.abspath(file_path)
+        if key not in self._artifacts:
+            start = time.perf_counter()
+            try:
+                self._artifacts[key] = joblib.load(key, mmap_mode=self.mmap_mode)
+            except Exception as e:
+                logger.error("Failed to load model artifact %s: %s", key, e)
+                exit(121)
+            logger.info("Loaded %s in %.2fs, peak RSS %.0f MB.", file_path, time.perf_counter() - start, peak_rss_mb())
+        return self._artifacts[key]
+
+    def dump(self, obj, file_path):
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        joblib.dump(obj, file_path)
+        self._artifacts.pop(os.path.abspath(file_path), None)
+
+
+def peak_rss_mb():
+    '''Peak resident set size of the current process in MB'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+_registries = {}
+
+
+def get_registry(path=PATH_TO_MODELS, prefix=MODEL_PREFIX):
+    '''Returns the registry shared by all callers in this process for the given model directory and prefix.'''
+    key = (os.path.abspath(path), prefix)
+    if key not in _registries:
+        _registries[key] = ModelRegistry(path, prefix)
+    return _registries[key]
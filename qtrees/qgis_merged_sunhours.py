@@ -1,8 +1,7 @@
 from qgis import processing
 import os
 from osgeo import gdal
-import rasterio
-from rasterio.merge import merge
+from qtrees.raster import build_mosaic
 """
 This script computes sun hour maps based on merged elevation tile file. It first merges all the 
 elevation tiles with 'merge_elevation_maps' and then calculates the slope and aspect of the 
@@ -22,31 +21,10 @@ selected_dates = [80, 172, 266, 355]
 def merge_elevation_maps(tiles_folder, target_file):
 
     # List all GeoTIFF files in the directory
-    tiff_files = [os.path.join(tiles_folder, f) for f in os.listdir(tiles_folder) if f.endswith('.tiff')]
+    tiff_files = sorted(os.path.join(tiles_folder, f) for f in os.listdir(tiles_folder) if f.endswith('.tiff'))
 
-    # Initialize an empty list to hold the data arrays
-    src_files_to_mosaic = []
-
-    # Loop through all the GeoTIFF files and add them to the list
-    for tiff_file in tiff_files:
-        src = rasterio.open(tiff_file)
-        src_files_to_mosaic.append(src)
-
-    # Merge all the individual GeoTIFF files into a single mosaic
-    mosaic, out_trans = merge(src_files_to_mosaic)
-
-    # Update the metadata for the mosaic file
-    out_meta = src.meta.copy()
-    out_meta.update({
-        "driver": "GTiff",
-        "height": mosaic.shape[1],
-        "width": mosaic.shape[2],
-        "transform": out_trans,
-        "compress": "None"
-    })
-
-    with rasterio.open(target_file, "w", **out_meta) as dest:
-        dest.write(mosaic)
+    # Merge the tiles block by block into a tiled, compressed GeoTIFF with overviews
+    build_mosaic(tiff_files, target_file, overviews=True)
     
 def run_slope_aspect_processing(elevation_map, slope_path, aspect_path):
     
@@ -0,0 +1,242 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import ExitStack
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.merge import merge
+from rasterio.transform import from_origin
+from rasterio.windows import Window, bounds as window_bounds
+from pyproj import Transformer
+
+from qtrees.helper import get_logger
+
+logger = get_logger(__name__)
+
+# Rows of the raster read at once while sampling, bounds the memory for full-city rasters
+DEFAULT_BLOCK_ROWS = 2048
+# Edge length of the blocks filtered at once, a multiple of the tile size of the filtered rasters
+DEFAULT_FILTER_BLOCK_SIZE = 2048
+TILE_SIZE = 256
+# Edge length of the blocks of a mosaic assembled at once
+DEFAULT_MOSAIC_BLOCK_SIZE = 4096
+OVERVIEW_LEVELS = [2, 4, 8, 16, 32]
+
+
+def pixel_indices(transform, height, width, x, y):
+    """Row and column of the pixel whose center is nearest to each point
+
+    Same pixels as DataArray.sel(x=..., y=..., method="nearest") on the pixel centers of a north-up raster, points outside the
+    raster are snapped to the nearest border pixel.
+
+    Parameters
+    ----------
+    transform: affine.Affine
+        Affine transform of the raster
+    height: int
+        Number of rows of the raster
+    width: int
+        Number of columns of the raster
+    x, y: array-like
+        Coordinates of the points in the CRS of the raster
+
+    Returns
+    -------
+        tuple of two int arrays, rows and columns
+    """
+    cols, rows = ~transform * (np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+    rows = np.clip(np.floor(rows), 0, height - 1).astype(np.int64)
+    cols = np.clip(np.floor(cols), 0, width - 1).astype(np.int64)
+    return rows, cols
+
+
+def sample_raster(file_path, x, y, crs=None, band=1, block_rows=DEFAULT_BLOCK_ROWS):
+    """Values of the pixels nearest to a batch of points
+
+    The points are projected with one vectorized transform and mapped to pixel indices with the inverse affine transform of
+    the raster. The raster is read in blocks of block_rows rows, each restricted to the columns containing points, and the
+    values of all points within a block are gathered with a single indexing operation.
+
+    Parameters
+    ----------
+    file_path: str
+        Path to a raster file readable by rasterio, e.g. a GeoTIFF
+    x, y: array-like
+        Coordinates of the points
+    crs: str or pyproj.CRS
+        CRS of the points, None if they are given in the CRS of the raster
+    band: int
+        Band to sample
+    block_rows: int
+        Number of raster rows read at once
+
+    Returns
+    -------
+        numpy array with one value per point, in the dtype of the raster
+    """
+    with rasterio.open(file_path) as src:
+        if crs is not None:
+            transformer = Transformer.from_crs(crs_from=crs, crs_to=src.crs, always_xy=True)
+            x, y = transformer.transform(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        rows, cols = pixel_indices(src.transform, src.height, src.width, x, y)
+        values = np.empty(len(rows), dtype=src.dtypes[band - 1])
+        order = np.argsort(rows, kind="stable")
+        blocks = rows[order] // block_rows
+        starts = np.flatnonzero(np.r_[True, np.diff(blocks) > 0])
+        for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+            idx = order[start:end]
+            row_off = int(blocks[start]) * block_rows
+            col_off = int(cols[idx].min())
+            window = Window(col_off, row_off, int(cols[idx].max()) - col_off + 1, min(block_rows, src.height - row_off))
+            data = src.read(band, window=window)
+            values[idx] = data[rows[idx] - row_off, cols[idx] - col_off]
+    logger.debug("Sampled %s points from %s.", len(values), file_path)
+    return values
+
+
+def iter_blocks(height, width, block_size):
+    '''Yields windows of at most block_size x block_size pixels covering the raster row by row.'''
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            yield Window(col_off, row_off, min(block_size, width - col_off), min(block_size, height - row_off))
+
+
+def _filter_block(file_path, window, filter_func, halo, band):
+    '''Reads the window grown by halo pixels, clipped to the raster, filters it and crops the result back to the window.'''
+    with rasterio.open(file_path) as src:
+        row_start = max(window.row_off - halo, 0)
+        col_start = max(window.col_off - halo, 0)
+        row_stop = min(window.row_off + window.height + halo, src.height)
+        col_stop = min(window.col_off + window.width + halo, src.width)
+        data = src.read(band, window=Window(col_start, row_start, col_stop - col_start, row_stop - row_start))
+    filtered = filter_func(data)
+    row_off = window.row_off - row_start
+    col_off = window.col_off - col_start
+    return window, filtered[row_off:row_off + window.height, col_off:col_off + window.width]
+
+
+def filter_raster(file_path, target_path, filter_func, halo, band=1, block_size=DEFAULT_FILTER_BLOCK_SIZE, workers=None,
+                  compress="deflate"):
+    """Applies a local filter to a raster block by block
+
+    Every block is read with a margin of halo pixels on each side, so pixels near block borders see the same neighbourhood
+    as in the full raster. At the raster borders the margin is clipped, which makes the filter's own border handling apply
+    exactly where it applies for the full raster. For filters whose footprint does not exceed halo pixels, such as
+    cv2.filter2D or cv2.GaussianBlur with a kernel of size 2 * halo + 1, the result is bit-identical to filtering the
+    whole raster in memory, while at most 2 * workers blocks are held in memory at once.
+
+    Blocks are filtered in a thread pool, opencv and rasterio release the GIL, and written in the main thread to a tiled,
+    compressed GeoTIFF with the profile of the source raster.
+
+    Parameters
+    ----------
+    file_path: str
+        Path to the source raster
+    target_path: str
+        Path of the GeoTIFF to write
+    filter_func: callable
+        Maps a 2D array to a filtered 2D array of the same shape and dtype
+    halo: int
+        Number of neighbouring pixels the filter reads in each direction, kernel_size // 2 for square kernels
+    band: int
+        Band to filter
+    block_size: int
+        Edge length of the blocks in pixels, a multiple of TILE_SIZE so that blocks are written as whole tiles
+    workers: int
+        Number of threads, None for the number of cores
+    compress: str
+        Compression of the output GeoTIFF
+
+    Returns
+    -------
+        str, target_path
+    """
+    if block_size % TILE_SIZE != 0:
+        raise ValueError(f"block_size has to be a multiple of {TILE_SIZE}, got {block_size}")
+    workers = workers or os.cpu_count() or 1
+    with rasterio.open(file_path) as src:
+        profile = src.profile.copy()
+        height, width = src.height, src.width
+    profile.update(driver="GTiff", count=1, tiled=True, blockxsize=TILE_SIZE, blockysize=TILE_SIZE, compress=compress,
+                   BIGTIFF="IF_SAFER")
+    with rasterio.open(target_path, "w", **profile) as dst, ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for window in iter_blocks(height, width, block_size):
+            pending.add(executor.submit(_filter_block, file_path, window, filter_func, halo, band))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _write_block(dst, future)
+        for future in pending:
+            _write_block(dst, future)
+    logger.info("Filtered %s into %s.", file_path, target_path)
+    return target_path
+
+
+def _write_block(dst, future):
+    window, data = future.result()
+    dst.write(data, 1, window=window)
+
+
+def build_mosaic(file_paths, target_path, block_size=DEFAULT_MOSAIC_BLOCK_SIZE, compress="deflate", overviews=False):
+    """Merges raster tiles into one tiled, compressed GeoTIFF with bounded memory
+
+    The output is pre-sized to the union of all tiles and assembled block by block. For each block only the tiles
+    intersecting it are opened and merged with rasterio.merge.merge restricted to the block, so the result is identical to
+    merging all tiles in memory, where overlapping tiles are resolved in the order of file_paths, while only one block of
+    block_size x block_size pixels is held in memory. All tiles are expected to share CRS, resolution, bands and dtype.
+
+    Parameters
+    ----------
+    file_paths: list of str
+        Paths to the tiles
+    target_path: str
+        Path of the GeoTIFF to write
+    block_size: int
+        Edge length of the blocks in pixels, a multiple of TILE_SIZE
+    compress: str
+        Compression of the output GeoTIFF
+    overviews: bool
+        Add an overview pyramid to the output?
+
+    Returns
+    -------
+        str, target_path
+    """
+    if len(file_paths) == 0:
+        raise ValueError("No tiles to merge")
+    if block_size % TILE_SIZE != 0:
+        raise ValueError(f"block_size has to be a multiple of {TILE_SIZE}, got {block_size}")
+    tile_bounds = []
+    for file_path in file_paths:
+        with rasterio.open(file_path) as src:
+            tile_bounds.append(tuple(src.bounds))
+            if len(tile_bounds) == 1:
+                profile = src.profile.copy()
+                res = src.res
+    tile_bounds = np.array(tile_bounds)
+    left, bottom = tile_bounds[:, 0].min(), tile_bounds[:, 1].min()
+    right, top = tile_bounds[:, 2].max(), tile_bounds[:, 3].max()
+    # same output grid as rasterio.merge.merge
+    transform = from_origin(left, top, res[0], res[1])
+    width = int(round((right - left) / res[0]))
+    height = int(round((top - bottom) / res[1]))
+    profile.update(driver="GTiff", width=width, height=height, transform=transform, tiled=True, blockxsize=TILE_SIZE,
+                   blockysize=TILE_SIZE, compress=compress, BIGTIFF="IF_SAFER")
+
+    with rasterio.open(target_path, "w", **profile) as dst:
+        for window in iter_blocks(height, width, block_size):
+            w, s, e, n = window_bounds(window, transform)
+            intersecting = np.flatnonzero((tile_bounds[:, 0] < e) & (tile_bounds[:, 2] > w) &
+                                          (tile_bounds[:, 1] < n) & (tile_bounds[:, 3] > s))
+            if len(intersecting) == 0:
+                continue
+            with ExitStack() as stack:
+                datasets = [stack.enter_context(rasterio.open(file_paths[i])) for i in intersecting]
+                data, _ = merge(datasets, bounds=(w, s, e, n), res=res, nodata=profile["nodata"], dtype=profile["dtype"])
+            dst.write(data, window=window)
+    if overviews:
+        with rasterio.open(target_path, "r+") as dst:
+            dst.build_overviews([level for level in OVERVIEW_LEVELS if level < max(width, height)], Resampling.average)
+    logger.info("Merged %s tiles into %s.", len(file_paths), target_path)
+    return target_path
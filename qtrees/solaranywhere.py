@@ -1,7 +1,12 @@
-import requests
-import pandas as pd
-import time
+import asyncio
 import json
+import time
+import aiohttp
+import pandas as pd
+
+from qtrees.helper import get_logger
+
+logger = get_logger(__name__)
 
 VARIABLE_MAP = {
     'GlobalHorizontalIrradiance_WattsPerMeterSquared': 'ghi',
@@ -10,30 +15,42 @@ VARIABLE_MAP = {
     'AmbientTemperature_DegreesC': 'temp',
     'WindSpeed_MetersPerSecond': 'wind'
 }
+# not available for hindcasts
+RAINFALL_VARIABLE_MAP = {'LiquidPrecipitation_KilogramsPerMeterSquared': 'rainfall_mm'}
 
-
+# daily column: (hourly column, aggregation)
+DAILY_AGGREGATIONS = {
+    "ghi_max_wm2": ("ghi", "max"),
+    "dni_max_wm2": ("dni", "max"),
+    "dhi_max_wm2": ("dhi", "max"),
+    "temp_max_c": ("temp", "max"),
+    "wind_max_ms": ("wind", "max"),
+    "ghi_sum_whm2": ("ghi", "sum"),
+    "dni_sum_whm2": ("dni", "sum"),
+    "dhi_sum_whm2": ("dhi", "sum"),
+    "rainfall_mm": ("rainfall_mm", "sum"),
+    "temp_avg_c": ("temp", "mean"),
+    "wind_avg_ms": ("wind", "mean"),
+}
 
 URL = 'https://service.solaranywhere.com/api/v2'
+MAX_SITES_PER_REQUEST = 50
+
 
-def get_weather(latitude, longitude, api_key, start=None, end=None, hindcast=False, max_response_time=300):
-    header = {'content-type': "application/json; charset=utf-8",
-               'X-Api-Key': api_key,
-               'Accept': "application/json"}
-    
-    if not hindcast:
-        VARIABLE_MAP["LiquidPrecipitation_KilogramsPerMeterSquared"] = 'rainfall_mm'
+def get_variable_map(hindcast=False):
+    return VARIABLE_MAP if hindcast else {**VARIABLE_MAP, **RAINFALL_VARIABLE_MAP}
 
+
+def build_payload(sites, start=None, end=None, hindcast=False):
+    '''Request body of a WeatherData request for sites, a DataFrame with columns lat and lng.'''
     payload = {
-        "Sites": [{
-            "Latitude": latitude,
-            "Longitude": longitude
-        }],
+        "Sites": [{"Latitude": lat, "Longitude": lng} for lat, lng in zip(sites["lat"], sites["lng"])],
         "Options": {
-            "OutputFields": ['StartTime'] + list(VARIABLE_MAP.keys()),
+            "OutputFields": ['StartTime'] + list(get_variable_map(hindcast).keys()),
             "SummaryOutputFields": [],
-            "SpatialResolution_Degrees": 0.1, # as per our license
-            "TimeResolution_Minutes": 60, # as per our license
-            "WeatherDataSource": 'SolarAnywhereLatest' if not hindcast else "SolarAnywhereHindcast", 
+            "SpatialResolution_Degrees": 0.1,  # as per our license
+            "TimeResolution_Minutes": 60,  # as per our license
+            "WeatherDataSource": 'SolarAnywhereLatest' if not hindcast else "SolarAnywhereHindcast",
             "MissingDataHandling": "FillAverage",
         }
     }
@@ -41,40 +58,132 @@ def get_weather(latitude, longitude, api_key, start=None, end=None, hindcast=Fal
     if hindcast:
         payload['Options']["ForecastHorizon_Hours"] = 24 * 7
 
-    if (start is not None) or (end is not None):
+    if pd.notna(start):
         payload['Options']["StartTime"] = pd.to_datetime(start).tz_localize('CET').isoformat()
+    if pd.notna(end):
         payload['Options']["EndTime"] = pd.to_datetime(end).tz_localize('CET').isoformat()
+    return payload
+
+
+def aggregate_daily(hourly, hindcast=False):
+    """
+    Aggregates hourly SolarAnywhere data of all tiles to daily values in one pass
+
+    Parameters
+    ----------
+    hourly: pandas.DataFrame
+        Weather data periods as returned by the API with an additional tile_id column
+    hindcast: bool
+        Data of a hindcast, i.e. without rainfall?
+
+    Returns
+    -------
+        pandas.DataFrame with columns tile_id, date and the daily maximum, sum and mean columns of the weather tables, days
+        are local days in CET
+    """
+    hourly = hourly.rename(columns=get_variable_map(hindcast))
+    date = pd.to_datetime(hourly["StartTime"], utc=True).dt.tz_convert("CET").dt.date.rename("date")
+    aggregations = {column: aggregation for column, aggregation in DAILY_AGGREGATIONS.items() if aggregation[0] in hourly}
+    return hourly.groupby([hourly["tile_id"], date]).agg(**aggregations).reset_index()
+
+
+class SolarAnywhereClient:
+    """
+    Asynchronous client of the SolarAnywhere weather data API
+
+    Tiles sharing the same time range are requested together, up to max_sites sites per WeatherData request, and all
+    requests are submitted concurrently. Results are polled with exponential backoff, starting at poll_interval seconds,
+    and the hourly data of all tiles is aggregated to daily values at once.
+
+    Attributes
+    ----------
+    api_key : str
+        SolarAnywhere API key
+    url : str
+        Base url of the API
+    max_sites : int
+        Maximal number of sites per request
+    max_concurrency : int
+        Maximal number of requests in flight
+    max_response_time : float
+        Seconds to wait for the result of a request before giving up
+    poll_interval : float
+        Seconds before the first poll of a result
+    max_poll_interval : float
+        Maximal seconds between two polls of a result
+
+    Methods
+    -------
+    get_weather(tiles, hindcast):
+        Returns the daily weather data of all tiles.
+    """
+
+    def __init__(self, api_key, url=URL, max_sites=MAX_SITES_PER_REQUEST, max_concurrency=4, max_response_time=300,
+                 poll_interval=1, max_poll_interval=30):
+        self.api_key = api_key
+        self.url = url
+        self.max_sites = max_sites
+        self.max_concurrency = max_concurrency
+        self.max_response_time = max_response_time
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+
+    @property
+    def headers(self):
+        return {'content-type': "application/json; charset=utf-8",
+                'X-Api-Key': self.api_key,
+                'Accept': "application/json"}
+
+    def get_weather(self, tiles, hindcast=False):
+        '''Daily weather of tiles, a DataFrame with columns tile_id, lat, lng and optionally start and end.'''
+        return asyncio.run(self.get_weather_async(tiles, hindcast=hindcast))
+
+    async def get_weather_async(self, tiles, hindcast=False):
+        tiles = tiles.assign(start=tiles.get("start"), end=tiles.get("end"))
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with aiohttp.ClientSession(headers=self.headers) as session:
+            requests = []
+            for (start, end), sites in tiles.groupby(["start", "end"], sort=False, dropna=False):
+                for i in range(0, len(sites), self.max_sites):
+                    requests.append(self._fetch(session, semaphore, sites.iloc[i:i + self.max_sites], start, end, hindcast))
+            hourly = await asyncio.gather(*requests)
+        logger.debug("Retrieved data for %s tiles in %s requests.", len(tiles), len(requests))
+        return aggregate_daily(pd.concat(hourly, ignore_index=True), hindcast=hindcast)
+
+    async def _fetch(self, session, semaphore, sites, start, end, hindcast):
+        async with semaphore:
+            payload = build_payload(sites, start=start, end=end, hindcast=hindcast)
+            async with session.post(self.url + '/WeatherData', data=json.dumps(payload)) as resp:
+                body = await resp.json(content_type=None)
+                if not resp.ok:
+                    raise ValueError(body['Message'])
+            results = await self._poll(session, body["WeatherRequestId"])
+
+        frames = []
+        for tile_id, result in zip(sites["tile_id"], results['WeatherDataResults']):
+            if result['Status'] == 'Failure':
+                raise RuntimeError(result['ErrorMessages'][0]['Message'])
+            data = pd.DataFrame(result['WeatherDataPeriods']['WeatherDataPeriods'])
+            data["tile_id"] = tile_id
+            frames.append(data)
+        return pd.concat(frames, ignore_index=True)
+
+    async def _poll(self, session, weather_request_id):
+        start_time = time.monotonic()
+        interval = self.poll_interval
+        while True:
+            await asyncio.sleep(interval)
+            async with session.get(self.url + '/WeatherDataResult/' + weather_request_id) as resp:
+                results = await resp.json(content_type=None)
+            if results.get('Status') == 'Done':
+                return results
+            if (time.monotonic() - start_time) > self.max_response_time:
+                raise TimeoutError('Time exceeded the `max_response_time`.')
+            interval = min(interval * 2, self.max_poll_interval)
+
 
-    payload = json.dumps(payload)
-
-    request = requests.post(URL+'/WeatherData', data=payload, headers=header)
-    
-    if request.ok is False:
-        raise ValueError(request.json()['Message'])
-    weather_request_id = request.json()["WeatherRequestId"]
-
-    # Second request, to get the data async
-    start_time = time.time()  
-    while True:
-        results = requests.get(URL + '/WeatherDataResult/' + weather_request_id, headers=header)
-        results_json = results.json()
-        if results_json.get('Status') == 'Done':
-            if results_json['WeatherDataResults'][0]['Status'] == 'Failure':
-                raise RuntimeError(results_json['WeatherDataResults'][0]['ErrorMessages'][0]['Message'])
-            break
-        elif (time.time()-start_time) > max_response_time:
-            raise TimeoutError('Time exceeded the `max_response_time`.')
-        time.sleep(5)  # Sleep for 5 seconds before each data retrieval attempt
-
-
-    data = pd.DataFrame(results_json['WeatherDataResults'][0]['WeatherDataPeriods']['WeatherDataPeriods'])
-    data.index = pd.to_datetime(data['StartTime'])
-    data.index = data.index.tz_convert("CET")
-    data = data.drop(["StartTime"], axis=1).rename(columns=VARIABLE_MAP)
-
-    daily_frames = []
-    daily_frames.append(data.groupby(data.index.date).max().rename(columns={"ghi": "ghi_max_wm2", "dni": "dni_max_wm2", "dhi": "dhi_max_wm2", "temp": "temp_max_c", "wind": "wind_max_ms"}))
-    daily_frames.append(data[["ghi", "dni", "dhi", "rainfall_mm"]].groupby(data.index.date).sum().rename(columns={"ghi": "ghi_sum_whm2", "dni": "dni_sum_whm2", "dhi": "dhi_sum_whm2"}))
-    daily_frames.append(data[["temp", "wind"]].groupby(data.index.date).mean().rename(columns={"temp": "temp_avg_c", "wind": "wind_avg_ms"}))
-    data_daily = pd.concat(daily_frames, axis=1).reset_index().rename(columns={"index": "date"})
-    return data_daily
\ No newline at end of file
+def get_weather(latitude, longitude, api_key, start=None, end=None, hindcast=False, max_response_time=300, url=URL):
+    '''Daily weather of a single site, see SolarAnywhereClient for several tiles.'''
+    client = SolarAnywhereClient(api_key, url=url, max_response_time=max_response_time)
+    tiles = pd.DataFrame({"tile_id": [0], "lat": [latitude], "lng": [longitude], "start": [start], "end": [end]})
+    return client.get_weather(tiles, hindcast=hindcast).drop(columns="tile_id")
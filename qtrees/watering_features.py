@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+from qtrees.constants import PREPROCESSING_HYPERPARAMS
+
+WATERING_SOURCES = {"water_sga": "private.watering_sga", "water_gdk": "private.watering_gdk"}
+
+
+def rolling_event_sums(event_keys, event_positions, event_values, keys, positions,
+                       window=PREPROCESSING_HYPERPARAMS['rolling_window']):
+    """
+    Sums of sparse events over the last window positions, looked up for arbitrary (key, position) pairs
+
+    Events are sorted once by key and position and cumulated. The sum over the positions p - window + 1 to p of a key is the
+    difference of two cumulative sums found by binary search, so neither a dense key x position grid nor a per-key loop is
+    needed.
+
+    Parameters
+    ----------
+    event_keys: array-like of int
+        Non-negative key of every event, e.g. the code of the tree
+    event_positions: array-like of int
+        Non-negative position of every event, e.g. the index of the day in a calendar
+    event_values: array-like of float
+        Value of every event, events sharing key and position are added up
+    keys, positions: array-like of int
+        Pairs to look up
+    window: int
+        Number of positions summed up
+
+    Returns
+    -------
+        numpy array of float with one sum per pair
+    """
+    span = int(max(np.max(event_positions, initial=-1), np.max(positions, initial=-1))) + 1 + window
+    codes = np.asarray(event_keys, dtype=np.int64) * span + np.asarray(event_positions, dtype=np.int64) + window
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    cumulated = np.concatenate([[0.], np.cumsum(np.asarray(event_values, dtype=float)[order])])
+    lookup = np.asarray(keys, dtype=np.int64) * span + np.asarray(positions, dtype=np.int64) + window
+    upper = np.searchsorted(codes, lookup, side="right")
+    lower = np.searchsorted(codes, lookup - window, side="right")
+    return cumulated[upper] - cumulated[lower]
+
+
+def add_watering_features(rows, waterings, dates, window=PREPROCESSING_HYPERPARAMS['rolling_window']):
+    """
+    Adds the rolling sums of the waterings of each source to tree days
+
+    The sums run over the last window days of the calendar dates, so gaps in the calendar, e.g. the winters between
+    growing seasons, are skipped. Rows of watered trees on calendar days get the sum, 0 without waterings in the window,
+    rows of trees without any watering or on days outside the calendar get NaN.
+
+    Parameters
+    ----------
+    rows: pandas.DataFrame
+        Tree days with columns tree_id and timestamp
+    waterings: dict
+        Watering events of each source, column name of the feature: DataFrame with columns tree_id, date and amount_liters
+    dates: pandas.DatetimeIndex
+        Calendar of the rolling sums, sorted, in the timezone of rows.timestamp
+    window: int
+        Number of calendar days summed up
+
+    Returns
+    -------
+        rows with an additional column per source
+    """
+    watered_trees = pd.Index(pd.concat([events["tree_id"] for events in waterings.values()]).unique())
+    keys = watered_trees.get_indexer(rows["tree_id"])
+    positions = dates.get_indexer(rows["timestamp"])
+    valid = (keys >= 0) & (positions >= 0)
+    features = {}
+    for name, events in waterings.items():
+        event_positions = dates.get_indexer(pd.to_datetime(events["date"]).dt.tz_localize(dates.tz))
+        in_calendar = event_positions >= 0
+        values = np.full(len(rows), np.nan)
+        values[valid] = rolling_event_sums(watered_trees.get_indexer(events["tree_id"])[in_calendar],
+                                           event_positions[in_calendar], events["amount_liters"].fillna(0).to_numpy()[in_calendar],
+                                           keys[valid], positions[valid], window=window)
+        features[name] = values
+    return rows.assign(**features)
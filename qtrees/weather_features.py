@@ -0,0 +1,187 @@
+import os
+import re
+import datetime
+import tempfile
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from qtrees.constants import PREPROCESSING_HYPERPARAMS, PATH_TO_WEATHER_FEATURES
+from qtrees.helper import get_logger
+
+logger = get_logger(__name__)
+
+WEATHER_COLUMNS = ["wind_max_ms", "wind_avg_ms", "rainfall_mm", "temp_max_c", "temp_avg_c", "upm"]
+SOLAR_COLUMNS = [x for x in WEATHER_COLUMNS if x != "upm"] + ["ghi_sum_whm2"]
+# public: DWD weather only, solar: DWD weather and solar irradiance for private nowcasts, forecast: SolarAnywhere tiles only
+SOURCES = ("public", "solar", "forecast")
+RAW_PREFIX = "raw_"
+
+
+def weather_source(public_run, forecast):
+    '''Source of the weather features of a run'''
+    if public_run:
+        return "public"
+    return "forecast" if forecast else "solar"
+
+
+def rolling_features(raw, window=PREPROCESSING_HYPERPARAMS['rolling_window']):
+    """
+    Rolling sum of the rainfall and rolling means of all other columns over the last window rows
+
+    Same as rolling(window, min_periods=1).sum() and .mean() up to rounding, but every value is computed from the rows of
+    its window only, so computing the features of new rows with window - 1 rows of context gives exactly the same values as
+    computing them over the full history.
+
+    Parameters
+    ----------
+    raw: pandas.DataFrame
+        Daily weather, one row per date in ascending order
+    window: int
+        Number of rows per window
+
+    Returns
+    -------
+        pandas.DataFrame with the same index and columns as raw
+    """
+    values = raw.to_numpy(dtype=float)
+    padded = np.vstack([np.full((window - 1, values.shape[1]), np.nan), values])
+    windows = sliding_window_view(padded, window, axis=0)
+    count = (~np.isnan(windows)).sum(axis=-1)
+    total = np.nansum(windows, axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        features = np.where(count > 0, total / count, np.nan)
+    if "rainfall_mm" in raw.columns:
+        i = raw.columns.get_loc("rainfall_mm")
+        features[:, i] = np.where(count[:, i] > 0, total[:, i], np.nan)
+    return pd.DataFrame(features, index=raw.index, columns=raw.columns)
+
+
+def database_key(engine):
+    '''Name of the engine's database usable as a directory name, e.g. localhost_5432_qtrees'''
+    url = engine.url
+    host = url.host or url.query.get("host") or "local"
+    return re.sub(r"[^A-Za-z0-9.-]+", "_", f"{host}_{url.port or 5432}_{url.database}").strip("_")
+
+
+def _naive_utc(timestamp):
+    if timestamp is None:
+        return None
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp.tz_convert("UTC").tz_localize(None) if timestamp.tz is not None else timestamp
+
+
+class WeatherFeatureStore:
+    """
+    Persistent store of the rolling weather features per source
+
+    The daily weather and its rolling features are stored in one Parquet file per source. An update only reads the dates
+    from the DB that are newer than the stored ones, plus the last refresh_days days to pick up late corrections, and only
+    computes the features of those dates, with window - 1 stored rows as context, so a daily run reads and computes a week of
+    weather instead of the full history. The features are identical to computing them over the full history. The files of every
+    database are kept in a directory of their own, named by host, port and name of the database, so runs against another
+    database never read or extend its history. Lookups only read
+    the stored file, so a script updates each source once and then looks up the features as often as it needs to. Every
+    update writes to its own temporary file, so concurrent runs on the same source do not overwrite each other's files.
+
+    Attributes
+    ----------
+    engine : sqlalchemy.engine.Engine
+        Engine of the qtrees DB
+    path : str
+        Root directory of the Parquet files
+    database_dir : str
+        Directory of the Parquet files of the engine's database
+    window : int
+        Number of rows of the rolling windows
+    refresh_days : int
+        Number of stored days that are read again on every update
+
+    Methods
+    -------
+    update(source):
+        Adds the features of new dates and returns all stored data of the source.
+    get(source, start, end):
+        Returns the stored features of the source between start and end, both inclusive, without querying the DB.
+    """
+
+    def __init__(self, engine, path=PATH_TO_WEATHER_FEATURES, window=PREPROCESSING_HYPERPARAMS['rolling_window'],
+                 refresh_days=PREPROCESSING_HYPERPARAMS['rolling_window']):
+        self.engine = engine
+        self.path = path
+        self.window = window
+        self.refresh_days = refresh_days
+        self.database_dir = os.path.join(path, database_key(engine)) if engine is not None else path
+
+    def file_path(self, source):
+        return os.path.join(self.database_dir, f"weather_features_{source}.parquet")
+
+    def load(self, source):
+        if not os.path.exists(self.file_path(source)):
+            return None
+        return pd.read_parquet(self.file_path(source))
+
+    def update(self, source):
+        if source not in SOURCES:
+            raise ValueError(f"Unknown weather source {source}, use one of {SOURCES}")
+        stored = self.load(source)
+        since = None
+        if stored is not None and len(stored) > 0:
+            since = (stored.index.max() - datetime.timedelta(days=self.refresh_days)).date()
+        new_raw = self._read_raw(source, since)
+
+        raw_columns = [RAW_PREFIX + col for col in new_raw.columns]
+        kept = None
+        if since is not None:
+            if list(stored.columns[:len(raw_columns)]) != raw_columns:
+                raise ValueError(f"Stored weather features of {source} have different columns, delete {self.file_path(source)}")
+            kept = stored[stored.index < pd.Timestamp(since)]
+        n_kept = 0 if kept is None else len(kept)
+        raw = new_raw if kept is None else pd.concat([kept[raw_columns].set_axis(new_raw.columns, axis=1), new_raw])
+
+        # features of the new rows only need the window - 1 rows before them
+        context = max(n_kept - (self.window - 1), 0)
+        features = rolling_features(raw.iloc[context:], self.window).iloc[n_kept - context:]
+        new = pd.concat([new_raw.add_prefix(RAW_PREFIX), features], axis=1)
+        data = new if kept is None else pd.concat([kept, new])
+
+        os.makedirs(self.database_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.database_dir, prefix=f"weather_features_{source}.", suffix=".tmp")
+        os.close(fd)
+        try:
+            data.to_parquet(tmp_path)
+            os.replace(tmp_path, self.file_path(source))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        logger.info("Computed weather features of %s for %s dates, %s dates stored.", source, len(new), len(data))
+        return data
+
+    def get(self, source, start=None, end=None):
+        data = self.load(source)
+        if data is None:
+            raise ValueError(f"No weather features of {source} stored in {self.database_dir}, update the source first")
+        # the stored dates are naive UTC dates
+        data = data.loc[_naive_utc(start):_naive_utc(end)]
+        features = data[[col for col in data.columns if not col.startswith(RAW_PREFIX)]]
+        features.index = features.index.tz_localize("UTC")
+        return features
+
+    def _read_raw(self, source, since=None):
+        '''Daily weather of the source from the DB, restricted to dates from since on.'''
+        where = "" if since is None else " WHERE date >= %(since)s"
+        params = dict(since=since)
+        with self.engine.connect() as con:
+            if source == "forecast":
+                raw = pd.read_sql(f"SELECT date, tile_id, {', '.join(SOLAR_COLUMNS)} FROM private.weather_tile_measurement{where}",
+                                  con, params=params, parse_dates=["date"], index_col="date")
+                raw = raw.groupby(level=0).mean().drop(columns="tile_id")
+            else:
+                raw = pd.read_sql(f"SELECT date, {', '.join(WEATHER_COLUMNS)} FROM public.weather{where}",
+                                  con, params=params, parse_dates=["date"], index_col="date").sort_index()
+                if source == "solar":
+                    solar = pd.read_sql(f"SELECT date, tile_id, ghi_sum_whm2 FROM private.weather_tile_measurement{where}",
+                                        con, params=params, parse_dates=["date"], index_col="date")
+                    solar = solar.groupby(level=0).mean().drop(columns="tile_id")
+                    raw = raw.merge(solar, how="left", left_index=True, right_index=True)
+        return raw.astype(float)
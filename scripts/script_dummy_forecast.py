@@ -8,10 +8,9 @@ Options:
   --db_qtrees=DB_QTREES                        Database name [default:]
 """
 import os
-from sqlalchemy import create_engine
 import sqlalchemy
 from docopt import docopt, DocoptExit
-from qtrees.helper import get_logger, init_db_args
+from qtrees.helper import get_logger, DBSession
 import sys
 import pandas as pd
 from datetime import datetime
@@ -25,11 +24,9 @@ def main():
     logger.info("Args: %s", sys.argv[1:])
     # Parse arguments
     args = docopt(__doc__)
-    db_qtrees, postgres_passwd = init_db_args(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
+    session = DBSession(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
 
-    engine = create_engine(
-        f"postgresql://postgres:{postgres_passwd}@{db_qtrees}:5432/qtrees"
-    )
+    engine = session.engine
 
     with engine.connect() as con:
         result = con.execute(
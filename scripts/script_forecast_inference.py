@@ -11,18 +11,16 @@ Options:
   --model_name                        Decided which trained model to use
 """
 import sys
-import os
-import pickle
 import datetime
 import pytz
-import pandas as pd
-import numpy as np
-from sqlalchemy import create_engine
 from docopt import docopt, DocoptExit
 
-from qtrees.helper import get_logger, init_db_args
-from qtrees.constants import FORECAST_FEATURES, PREPROCESSING_HYPERPARAMS, MODEL_PREFIX, MODEL_TYPE, PATH_TO_MODELS
-from qtrees.data_processor import DataLoader
+from qtrees.helper import get_logger, DBSession
+from qtrees.constants import FORECAST_FEATURES, MODEL_PREFIX
+from qtrees.data_processor import DataLoader, get_autoreg_lags
+from qtrees.model_registry import get_registry
+from qtrees.forecast_util import WeatherContext, RecursiveForecaster, forecast_depths
+from qtrees.db_writer import BulkWriter
 
 
 logger = get_logger(__name__)
@@ -32,95 +30,53 @@ def main():
     # Parse arguments
     args = docopt(__doc__)
     batch_size = int(args["--batch_size"])
-    db_qtrees, postgres_passwd = init_db_args(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
+    session = DBSession(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
 
-    engine = create_engine(
-        f"postgresql://postgres:{postgres_passwd}@{db_qtrees}:5432/qtrees"
-    )
+    engine = session.engine
     if args["--model_name"] is not None:
         prefix = args["--model_name"]
     else:
         prefix = MODEL_PREFIX
 
-    last_date = pd.read_sql("SELECT MAX(date) FROM private.weather_tile_measurement", con=engine.connect()).astype('datetime64[ns, UTC]').iloc[0, 0]
-    num_trees = pd.read_sql("SELECT COUNT(*) FROM public.trees WHERE street_tree = true", con=engine.connect()).iloc[0, 0]
-    # TODO something smarter here?
-    with engine.connect() as con:
-        con.execute("TRUNCATE public.forecast")
-
+    last_date = session.read_sql("SELECT MAX(date) FROM private.weather_tile_measurement").astype('datetime64[ns, UTC]').iloc[0, 0]
     created_at = datetime.datetime.now(pytz.timezone('UTC'))
     weather_cols = [x for x in ["wind_avg_ms", "wind_max_ms", "temp_avg_c", "temp_max_c", "rainfall_mm", "ghi_sum_whm2"] if x in FORECAST_FEATURES]
     loader = DataLoader(engine, logger)
-    model_path = os.path.join(PATH_TO_MODELS, MODEL_TYPE["forecast"], "")
-    prep_path = os.path.join(PATH_TO_MODELS, MODEL_TYPE["preprocessor"], "")
-    aux_path = aux_path = os.path.join(PATH_TO_MODELS, MODEL_TYPE["auxiliary"], "")
-
-    preprocessor = pickle.load(open(prep_path + f"{MODEL_TYPE['preprocessor']}_{MODEL_TYPE['forecast']}.pkl", 'rb'))
+    registry = get_registry(prefix=prefix)
+    preprocessor = registry.preprocessor("forecast")
+    # preprocessors pickled before the autoregressive features were configurable use the default lags and no windows
+    autoreg_lags = getattr(preprocessor, "autoreg_lags", get_autoreg_lags())
+    autoreg_windows = getattr(preprocessor, "autoreg_windows", [])
+    forecasters = {}
+    for type_id in [1, 2, 3]:
+        forecasters[type_id] = RecursiveForecaster(registry.model("forecast", type_id), registry.model("auxiliary", type_id),
+                                                   FORECAST_FEATURES, weather_cols, lags=autoreg_lags, windows=autoreg_windows)
+    history_days = max(forecaster.history_days for forecaster in forecasters.values())
+    weather = WeatherContext(last_date, weather_cols, history_days=history_days).load(engine)
 
     logger.info("Start prediction for each depth")
-    for batch_number in range(int(np.ceil(num_trees/batch_size))):
-        input_chunk = loader.download_forecast_inference_data(date=last_date, batch_size=batch_size, batch_num=batch_number)
-        input_chunk = preprocessor.transform_inference(input_chunk)
-        base_X = input_chunk.reset_index(level=1, drop=True)  # Drop date index (this is only one value anyway)
-        base_X = base_X[[x for x in base_X.columns if x in FORECAST_FEATURES]]
-        base_X = base_X.dropna()
-        for type_id in [1, 2, 3]:
-            aux_model = pickle.load(open(aux_path + prefix + f"model_{type_id}.m", 'rb'))
-            model = pickle.load(open(model_path + prefix + f"model_{type_id}.m", 'rb'))
-            # generate autoregressive features for the last 3 days
+    # Readers keep seeing the previous forecast until all batches are written
+    with BulkWriter(engine, "forecast", schema="public", staging=True) as writer:
+        for batch_number, input_chunk in enumerate(loader.iter_inference_batches(date=last_date, batch_size=batch_size, forecast=True)):
+            input_chunk = preprocessor.transform_inference(input_chunk)
+            base_X = input_chunk.reset_index(level=1, drop=True)  # Drop date index (this is only one value anyway)
+            base_X = base_X[[x for x in base_X.columns if x in FORECAST_FEATURES]]
+            base_X = base_X.dropna()
             if base_X.shape[0] == 0:
                 continue
-            autoreg_features = None
-            for i in range(PREPROCESSING_HYPERPARAMS["autoreg_lag"]):
-                X = base_X.copy()
-                hist_date = last_date - pd.Timedelta(days=i)
-                current_weather = pd.read_sql("SELECT * FROM private.weather_tile_measurement WHERE date = %s AND tile_id = %s ORDER BY date DESC", 
-                                              engine, params=(hist_date, PREPROCESSING_HYPERPARAMS['tile_id']))
-                current_weather = current_weather[weather_cols]
-                for col in weather_cols:
-                    X.loc[:, col] = current_weather.loc[:, col].values[0]
-                if autoreg_features is None:
-                    autoreg_features = pd.DataFrame(aux_model.predict(X), index=X.index)
-                    autoreg_features.columns = [f"shift_{i+1}"]
-                else:
-                    autoreg_features.loc[:, f"shift_{i+1}"] = aux_model.predict(X)
-
-            logger.info(f"Inference for depth {type_id}, batch {batch_number+1}/{int(np.ceil(num_trees/batch_size))}.")
-            for h in range(1, PREPROCESSING_HYPERPARAMS["fc_horizon"]+1):
-                forecast_date = last_date + pd.Timedelta(days=h)
-                current_weather = pd.read_sql("SELECT * FROM private.weather_tile_forecast WHERE date = %s AND tile_id = %s ORDER BY date, created_at DESC", 
-                                              engine, params=(forecast_date, PREPROCESSING_HYPERPARAMS['tile_id']))
-                current_weather = current_weather[weather_cols]
-                X = base_X.copy()
-                X = X.merge(autoreg_features, how="left", left_index=True, right_index=True)
-                for col in weather_cols:
-                    X.loc[:, col] = current_weather.loc[:, col].values[0]
-                X = X[FORECAST_FEATURES + ["shift_1", "shift_2", "shift_3"]]
-                y_hat = pd.DataFrame(model.predict(X), index=X.index).reset_index()
-                y_hat.columns = ["tree_id", "value"]
-                y_hat["type_id"] = type_id
-                y_hat["timestamp"] = forecast_date
-                y_hat["created_at"] = created_at
-                y_hat["model_id"] = "Random Forest (full)" # TODO id from file?
-                temp = pd.DataFrame({"shift_1": y_hat.set_index("tree_id")["value"], "shift_2": autoreg_features["shift_1"], "shift_3": autoreg_features["shift_2"]}, index=y_hat["tree_id"])
-                autoreg_features = temp
-                try:
-                    y_hat.to_sql("forecast", engine, if_exists="append", schema="public", index=False, method=None)
-                except Exception as e:
-                    logger.error(f"Forecast failed for chunk. Trying to continue for next chunk. Error: %s", e)
-
+            logger.info(f"Inference for all depths, batch {batch_number+1}.")
+            y_hat = forecast_depths(forecasters, base_X, weather)
+            y_hat["created_at"] = created_at
+            y_hat["model_id"] = "Random Forest (full)" # TODO id from file?
+            # a failed write leaves the context with the exception, the staged rows are dropped and public.forecast is kept
+            writer.write(y_hat)
 
     logger.info("Made all predictions all models.")
 
-    logger.info("Calculating Mean Prediction.")
-    with engine.connect() as con:
-        con.execute("INSERT INTO public.forecast SELECT nextval('forecast_id_seq'), tree_id, 4 as type_id, timestamp, avg(value), created_at, model_id " +
-                    "FROM public.forecast " +
-                    "WHERE created_at = %(created)s GROUP BY tree_id, timestamp, created_at, model_id;", created=created_at)
-
     with engine.connect() as con:
-        con.execute('REFRESH MATERIALIZED VIEW public.expert_dashboard')
-        con.execute("REFRESH MATERIALIZED VIEW public.vector_tiles;")
+        for view in ["public.expert_dashboard", "public.vector_tiles"]:
+            if view not in writer.rebuilt_views:
+                con.execute(f"REFRESH MATERIALIZED VIEW {view}")
 
     logger.info("Updated materialized view public.expert_dashboard.")
 
@@ -10,15 +10,14 @@ Options:
   --model_name                        Decided which trained model to use
 """
 import pandas as pd
-from sqlalchemy import create_engine
 import sys
 from docopt import docopt, DocoptExit
 from sklearn.ensemble import RandomForestRegressor
-import pickle
-from qtrees.helper import get_logger, init_db_args
+from qtrees.helper import get_logger, DBSession
 import os
 from qtrees.constants import FORECAST_FEATURES, HYPER_PARAMETERS_FC, HYPER_PARAMETERS_NC, MODEL_PREFIX, MODEL_TYPE, PATH_TO_MODELS
 from qtrees.data_processor import DataLoader, PreprocessorForecast
+from qtrees.model_registry import get_registry
 
 logger = get_logger(__name__)
 
@@ -26,11 +25,9 @@ def main():
     logger.info("Args: %s", sys.argv[1:])
     # Parse arguments
     args = docopt(__doc__)
-    db_qtrees, postgres_passwd = init_db_args(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
+    session = DBSession(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
 
-    engine = create_engine(
-        f"postgresql://postgres:{postgres_passwd}@{db_qtrees}:5432/qtrees"
-    )
+    engine = session.engine
     if args["--model_name"] is not None:
         prefix = args["--model_name"]
     else:
@@ -48,15 +45,16 @@ def main():
     aux_path = aux_path = os.path.join(PATH_TO_MODELS, MODEL_TYPE["auxiliary"], "")
     create_folders([model_path, prep_path, aux_path])
 
-    pickle.dump(preprocessor_forecast, open(prep_path + f"{MODEL_TYPE['preprocessor']}_{MODEL_TYPE['forecast']}.pkl", 'wb'))
+    registry = get_registry(prefix=prefix)
+    registry.dump(preprocessor_forecast, registry.preprocessor_path("forecast"))
 
     logger.info("Start model training for each depth.")
     for type_id in [1, 2, 3]:
-        X = train_data.loc[train_data.type_id == type_id, FORECAST_FEATURES + ["shift_1", "shift_2", "shift_3"]]
+        X = train_data.loc[train_data.type_id == type_id, FORECAST_FEATURES + preprocessor_forecast.autoreg_columns]
         y = train_data.loc[train_data.type_id == type_id, "target"]
         model = RandomForestRegressor(**HYPER_PARAMETERS_FC)
         model.fit(X, y)
-        pickle.dump(model, open(model_path + prefix + f"model_{type_id}.m", 'wb'))
+        registry.dump(model, registry.model_path("forecast", type_id))
     logger.info("Trained forecast models.")
 
     logger.info("Start model training for auxiliary nowcast model.")
@@ -65,7 +63,7 @@ def main():
         y = train_data.loc[train_data.type_id == type_id, "target"]
         model_nc = RandomForestRegressor(**HYPER_PARAMETERS_NC)
         model_nc.fit(X, y)
-        pickle.dump(model_nc, open(aux_path + prefix + f"model_{type_id}.m", 'wb'))
+        registry.dump(model_nc, registry.model_path("auxiliary", type_id))
     logger.info("Trained all models")
 
 
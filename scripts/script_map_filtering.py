@@ -2,27 +2,30 @@
 """
 Create filtered maps from the sun hour maps.
 Usage:
-  script_map_filtering.py [--data_path=DATA_PATH] [--kernel_size=KERNEL_SIZE] [--filter_method=FILTER_METHOD]
+  script_map_filtering.py [--data_path=DATA_PATH] [--kernel_size=KERNEL_SIZE] [--filter_method=FILTER_METHOD] [--block_size=BLOCK_SIZE] [--workers=WORKERS]
   script_map_filtering.py (-h | --help)
 Options:
   --data_path=DATA_PATH                    Data path [default: ../data]
   --kernel_size=KERNEL_SIZE                Kernel size of filter [default: 5]
   --filter_method=FILTER_METHOD            Method for filtering [default: box]
+  --block_size=BLOCK_SIZE                  Edge length in pixels of the blocks filtered at once, bounds the memory [default: 2048]
+  --workers=WORKERS                        Number of blocks filtered in parallel, 0 for the number of cores [default: 0]
 """
 import os
 import numpy as np
-import rioxarray
 import cv2  # todo: add pip install opencv-python to requirement?
 import sys
+from functools import partial
 from docopt import docopt, DocoptExit
 
 from qtrees.helper import get_logger
+from qtrees.raster import filter_raster, DEFAULT_FILTER_BLOCK_SIZE
 
 
 logger = get_logger(__name__)
 
 
-def create_box_filter_maps(maps_directory, kernel_size):
+def create_box_filter_maps(maps_directory, kernel_size, block_size=DEFAULT_FILTER_BLOCK_SIZE, workers=None):
     if not os.path.exists(target_filepath):
         logger.info("creating target directory")
         os.makedirs(target_filepath, exist_ok=True)
@@ -39,10 +42,12 @@ def create_box_filter_maps(maps_directory, kernel_size):
                 map_name=filename,
                 filepath=f_path,
                 target_filepath=target_filepath,
+                block_size=block_size,
+                workers=workers,
             )
 
 
-def create_gaussian_filter_maps(maps_directory, kernel_size):
+def create_gaussian_filter_maps(maps_directory, kernel_size, block_size=DEFAULT_FILTER_BLOCK_SIZE, workers=None):
     logger.info(target_filepath)
     if not os.path.exists(target_filepath):
         logger.info("creating target directory")
@@ -58,34 +63,34 @@ def create_gaussian_filter_maps(maps_directory, kernel_size):
                 map_name=filename,
                 filepath=f_path,
                 target_filepath=target_filepath,
+                block_size=block_size,
+                workers=workers,
             )
 
 
-def apply_box_filter(kernel_size, map_name, filepath, target_filepath):
-    map = rioxarray.open_rasterio(filepath)
-    logger.info(f"processing map: {map_name}")
+def box_filter(data, kernel_size):
     kernel_div = kernel_size * kernel_size
     kernel = np.ones((kernel_size, kernel_size), np.float32) / kernel_div
-    map_np = map[0].to_numpy()
+    return cv2.filter2D(data, -1, kernel)
 
-    # apply the box filtering
-    dst = cv2.filter2D(map_np, -1, kernel)
 
-    map[0] = dst
-    map_name = "box_k" + str(kernel_size) + "_" + map_name
-    map.rio.to_raster(os.path.join(target_filepath, map_name))
+def gaussian_filter(data, kernel_size):
+    return cv2.GaussianBlur(data, (kernel_size, kernel_size), 0)
 
 
-def apply_gaussian_filter(kernel_size, map_name, filepath, target_filepath):
-    map = rioxarray.open_rasterio(filepath)
-    print(f"processing map: {map_name}")
-    map_np = map[0].to_numpy()
+def apply_box_filter(kernel_size, map_name, filepath, target_filepath, block_size=DEFAULT_FILTER_BLOCK_SIZE, workers=None):
+    logger.info(f"processing map: {map_name}")
+    map_name = "box_k" + str(kernel_size) + "_" + map_name
+    # the map is filtered in overlapping blocks, the result is identical to filtering the whole map at once
+    filter_raster(filepath, os.path.join(target_filepath, map_name), partial(box_filter, kernel_size=kernel_size),
+                  halo=kernel_size // 2, block_size=block_size, workers=workers)
 
-    dst = cv2.GaussianBlur(map_np, (kernel_size, kernel_size), 0)
 
-    map[0] = dst
+def apply_gaussian_filter(kernel_size, map_name, filepath, target_filepath, block_size=DEFAULT_FILTER_BLOCK_SIZE, workers=None):
+    logger.info(f"processing map: {map_name}")
     map_name = "gaussian_k" + str(kernel_size) + "_" + map_name
-    map.rio.to_raster(os.path.join(target_filepath, map_name))
+    filter_raster(filepath, os.path.join(target_filepath, map_name), partial(gaussian_filter, kernel_size=kernel_size),
+                  halo=kernel_size // 2, block_size=block_size, workers=workers)
 
 
 if __name__ == "__main__":
@@ -96,11 +101,13 @@ if __name__ == "__main__":
     sun_hour_map_folder = os.path.join(data_path, "sun_hour_maps")
     target_filepath = os.path.join(data_path, "berlin_maps_filtered")
     kernel_size = int(args["--kernel_size"])
+    block_size = int(args["--block_size"])
+    workers = int(args["--workers"]) or None
 
     if args["--filter_method"] == "box":
-        create_box_filter_maps(sun_hour_map_folder, kernel_size)
+        create_box_filter_maps(sun_hour_map_folder, kernel_size, block_size=block_size, workers=workers)
     elif args["--filter_method"] == "gaussian":
-        create_gaussian_filter_maps(sun_hour_map_folder, kernel_size)
+        create_gaussian_filter_maps(sun_hour_map_folder, kernel_size, block_size=block_size, workers=workers)
     else:
         logger.error("Invalid filter method. Please use either box or gaussian.")
         sys.exit(1)
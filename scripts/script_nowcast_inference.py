@@ -2,28 +2,25 @@
 """
 Download tree data and store into db.
 Usage:
-  script_nowcast_inference.py [--config_file=CONFIG_FILE] [--db_qtrees=DB_QTREES] [--batch_size=BATCH_SIZE] [--model_prefix=MODEL_PREFIX]
+  script_nowcast_inference.py [--config_file=CONFIG_FILE] [--db_qtrees=DB_QTREES] [--batch_size=BATCH_SIZE] [--model_name=MODEL_NAME]
   script_nowcast_inference.py (-h | --help)
 Options:
   --config_file=CONFIG_FILE           Directory for config file [default: models/model.yml]
   --db_qtrees=DB_QTREES               Database name [default:]
   --batch_size=BATCH_SiZE             Batch size [default: 100000]
-  --model_name                        Decided which trained model to use
+  --model_name=MODEL_NAME             Decided which trained model to use
 """
 import sys
-import os
 import datetime
 import pytz
-import pickle
 from docopt import docopt, DocoptExit
-from sqlalchemy import create_engine
-import pandas as pd
-import numpy as np
 
-from qtrees.helper import get_logger, init_db_args
-from qtrees.forecast_util import check_last_data
-from qtrees.constants import NOWCAST_FEATURES, PATH_TO_MODELS, MODEL_TYPE, MODEL_PREFIX
+from qtrees.helper import get_logger, DBSession
+from qtrees.forecast_util import check_last_data, predict_depths
+from qtrees.constants import NOWCAST_FEATURES, MODEL_PREFIX
 from qtrees.data_processor import DataLoader
+from qtrees.model_registry import get_registry
+from qtrees.db_writer import BulkWriter
 
 logger = get_logger(__name__)
 
@@ -32,30 +29,22 @@ def main():
     # Parse arguments
     args = docopt(__doc__)
     batch_size = int(args["--batch_size"])
-    db_qtrees, postgres_passwd = init_db_args(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
+    session = DBSession(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
     if args["--model_name"] is not None:
         prefix = args["--model_name"]
     else:
         prefix = MODEL_PREFIX
-    engine = create_engine(
-        f"postgresql://postgres:{postgres_passwd}@{db_qtrees}:5432/qtrees"
-    )
-    num_trees = pd.read_sql("SELECT COUNT(*) FROM public.trees WHERE street_tree = true", con=engine.connect()).iloc[0, 0]
-    nowcast_date = pd.read_sql("SELECT MAX(date) FROM public.weather", con=engine.connect()).astype('datetime64[ns, UTC]').iloc[0, 0]
+    engine = session.engine
+    nowcast_date = session.read_sql("SELECT MAX(date) FROM public.weather").astype('datetime64[ns, UTC]').iloc[0, 0]
     loader = DataLoader(engine, logger)
-    prep_path = os.path.join(PATH_TO_MODELS, MODEL_TYPE["preprocessor"], f"{MODEL_TYPE['preprocessor']}_{MODEL_TYPE['nowcast']}.pkl")
-    preprocessor = pickle.load(open(prep_path, 'rb'))
-    # TODO something smarter here?
-    with engine.connect() as con:
-        con.execute("TRUNCATE public.nowcast")
-
+    registry = get_registry(prefix=prefix)
+    preprocessor = registry.preprocessor("nowcast")
     logger.info("Start prediction for each depth.")
     created_at = datetime.datetime.now(pytz.timezone('UTC'))
-    for type_id in [1, 2, 3]:
-        model_path = os.path.join(PATH_TO_MODELS, MODEL_TYPE["nowcast"], prefix + f"model_{type_id}.m")
-        model = pickle.load(open(model_path, 'rb'))
-        for batch_number in range(int(np.ceil(num_trees/batch_size))):
-            input_chunk = loader.download_nowcast_inference_data(date=nowcast_date, batch_size=batch_size, batch_num=batch_number)
+    models = {type_id: registry.model("nowcast", type_id) for type_id in [1, 2, 3]}
+    # Readers keep seeing the previous nowcast until all batches are written
+    with BulkWriter(engine, "nowcast", schema="public", staging=True) as writer:
+        for batch_number, input_chunk in enumerate(loader.iter_inference_batches(date=nowcast_date, batch_size=batch_size)):
             input_chunk = preprocessor.transform_inference(input_chunk)
             X = input_chunk[NOWCAST_FEATURES].reset_index(level=1, drop=True)  #Drop date index (this is only one value anyway)
             X = X.dropna()
@@ -63,30 +52,23 @@ def main():
             # TODO filter valid targets
             if X.shape[0] == 0:
                 continue
-            y_hat = pd.DataFrame(model.predict(X), index=X.index).reset_index()
-            y_hat.columns = ["tree_id", "value"]
-            y_hat["type_id"] = type_id
+            logger.info(f"Inference for all depths, batch {batch_number+1}.")
+            y_hat = predict_depths(models, X)
             y_hat["timestamp"] = nowcast_date
             y_hat["created_at"] = created_at
             y_hat["model_id"] = "Random Forest (full)"
             # TODO id from file?
-            try:
-                y_hat.to_sql("nowcast", engine, if_exists="append", schema="public", index=False, method=None)
-            except Exception as e:
-                logger.error(f"Nowcast failed for chunk. Trying to continue for next chunk. Error: %s", e)
+            # a failed write leaves the context with the exception, the staged rows are dropped and public.nowcast is kept
+            writer.write(y_hat)
 
     logger.info("Made all predictions all models.")
 
-    logger.info("Calculating Mean Prediction.")
-    with engine.connect() as con:
-        con.execute("INSERT INTO public.nowcast SELECT nextval('nowcast_id_seq'), tree_id, 4 as type_id, timestamp, avg(value), created_at, model_id " + \
-                    "FROM public.nowcast " + \
-                    "WHERE created_at = %(created)s GROUP BY tree_id, timestamp, created_at, model_id;", created=created_at)
-        
     logger.info("Updating materialized views.")
     with engine.connect() as con:
-        con.execute('REFRESH MATERIALIZED VIEW public.expert_dashboard')
-        con.execute("REFRESH MATERIALIZED VIEW public.vector_tiles;")
+        for view in ["public.expert_dashboard", "public.vector_tiles"]:
+            # views depending on public.nowcast were already recreated with the new rows by the swap
+            if view not in writer.rebuilt_views:
+                con.execute(f"REFRESH MATERIALIZED VIEW {view}")
     logger.info("Updated materialized view public.expert_dashboard.")
 
 if __name__ == "__main__":
@@ -10,15 +10,14 @@ Options:
   --model_name                        Decided which trained model to use
 """
 import pandas as pd
-from sqlalchemy import create_engine
 import sys
 from docopt import docopt, DocoptExit
 from sklearn.ensemble import RandomForestRegressor
-import pickle
-from qtrees.helper import get_logger, init_db_args
+from qtrees.helper import get_logger, DBSession
 import os
 from qtrees.constants import NOWCAST_FEATURES, HYPER_PARAMETERS_NC, PATH_TO_MODELS, MODEL_PREFIX, MODEL_TYPE
 from qtrees.data_processor import PreprocessorNowcast, DataLoader
+from qtrees.model_registry import get_registry
 
 logger = get_logger(__name__)
 
@@ -26,11 +25,9 @@ def main():
     logger.info("Args: %s", sys.argv[1:])
     # Parse arguments
     args = docopt(__doc__)
-    db_qtrees, postgres_passwd = init_db_args(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
+    session = DBSession(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
 
-    engine = create_engine(
-        f"postgresql://postgres:{postgres_passwd}@{db_qtrees}:5432/qtrees"
-    )
+    engine = session.engine
     if args["--model_name"] is not None:
         prefix = args["--model_name"]
     else:
@@ -55,14 +52,15 @@ def main():
     if not os.path.exists(prep_path):
         os.makedirs(prep_path)
 
+    registry = get_registry(prefix=prefix)
     logger.info("Start model training for each depth.")
     for type_id in [1, 2, 3]:
         X = train_data.loc[train_data.type_id == type_id, NOWCAST_FEATURES]
         y = train_data.loc[train_data.type_id == type_id, "target"]
         model = RandomForestRegressor(**HYPER_PARAMETERS_NC)
         model.fit(X, y)
-        pickle.dump(model, open(path + prefix + f'model_{type_id}.m', 'wb'))
-    pickle.dump(prep_nowcast, open(prep_path + f"{MODEL_TYPE['preprocessor']}_{MODEL_TYPE['nowcast']}.pkl", 'wb'))
+        registry.dump(model, registry.model_path("nowcast", type_id))
+    registry.dump(prep_nowcast, registry.preprocessor_path("nowcast"))
     logger.info("Trained all models.")
 
 if __name__ == "__main__":
@@ -1,8 +1,7 @@
 import os
 from qgis import processing
 import glob
-import rasterio
-from rasterio.merge import merge
+from qtrees.raster import build_mosaic
 
 """
 This script computes sun hour maps based on elevation tile files. It first calculates 
@@ -96,37 +95,15 @@ def merge_sunhour_maps(sunhours_folder, target_file):
         if not os.path.isdir(sunhour_maps_subdir):
             continue
 
-        tiff_files = [
+        tiff_files = sorted(
             os.path.join(sunhour_maps_subdir, f)
             for f in os.listdir(sunhour_maps_subdir)
             if f.endswith(".tiff")
-        ]
+        )
         target_file = os.path.join(sunhours_folder, subdir + "_merged.tiff")
 
-        # Initialize an empty list to hold the data arrays
-        src_files_to_mosaic = []
-
-        # Loop through all the GeoTIFF files and add them to the list
-        for tiff_file in tiff_files:
-            src = rasterio.open(tiff_file)
-            src_files_to_mosaic.append(src)
-
-        # Merge all the individual GeoTIFF files into a single mosaic
-        mosaic, out_trans = merge(src_files_to_mosaic)
-
-        # Update the metadata for the mosaic file
-        out_meta = src.meta.copy()
-        out_meta.update(
-            {
-                "driver": "GTiff",
-                "height": mosaic.shape[1],
-                "width": mosaic.shape[2],
-                "transform": out_trans,
-                "compress": "None",
-            }
-        )
-        with rasterio.open(target_file, "w", **out_meta) as dest:
-            dest.write(mosaic)
+        # Merge the tiles block by block into a tiled, compressed GeoTIFF with overviews
+        build_mosaic(tiff_files, target_file, overviews=True)
 
 
 def process_all_tiles(tiles_folder, slope_aspect_folder, selected_dates):
@@ -11,16 +11,16 @@ Options:
 from astral import LocationInfo
 from astral.sun import sun
 import datetime
-import rioxarray
 import os
+import numpy as np
 import pandas as pd
-import json
-from pyproj import CRS, Transformer
 import sys
 from docopt import docopt, DocoptExit
 
 from qtrees.helper import get_logger
 from qtrees.fisbroker import get_trees
+from qtrees.raster import sample_raster
+from qtrees.data_processor import MONTH_COLUMNS
 
 logger = get_logger(__name__)
 
@@ -55,44 +55,35 @@ def calc_theoretical_daylight(dates, city):
     return total_sun_seconds
 
 
-def calculate_sun_index(
-    seasons_theoretical_daylight, sun_hours_map_directory, tree_json
-):
-    # transform tree coordinates to the crs of sun hours map
-    out_proj = CRS("EPSG:25833")
-    in_proj = CRS("EPSG:4326")
-    transformer = Transformer.from_crs(
-        crs_from=in_proj, crs_to=out_proj, always_xy=True
-    )
-    actual_sun_hours = {}
-    """ goes through the trees & calculates the sun&shadow index per tree for
-        every season based on the ratio of actual sun hours obtained from sun
+def calculate_sun_index(seasons_theoretical_daylight, sun_hours_map_directory, tree_ids, lat, lon):
+    """ samples the sun hours maps at all trees & calculates the sun index per tree
+        for every season as the ratio of actual sun hours obtained from the sun
         map divided by theoretical daylight calculated based on sunrise and
         sunset hours of the selected representative dates for seasons
     """
+    sun_index = pd.DataFrame(index=pd.Index(tree_ids))
     for season, theoretical_daylight in seasons_theoretical_daylight.items():
-        seasonal_values = {}
-        # TODO: what happens if the file does not exist?
         # season must be in the file name
-        for filename in os.listdir(sun_hours_map_directory):
-            f = os.path.join(sun_hours_map_directory, filename)
-            if os.path.isfile(f) and season in filename:
-                qgis_sun_hours_map = rioxarray.open_rasterio(f)
-                logger.info(f"calculating {season}...")
-                for tree in list(tree_json.items()):
-                    baum_id = tree[0]
-                    lat, lon = tree[1]
-                    lon, lat = transformer.transform(lon, lat)
-                    tree_marked = qgis_sun_hours_map.sel(
-                        x=[lon], y=[lat], method="nearest"
-                    )
-                    tree_actual_sun_hours = float(tree_marked.values)
-                    shading_index = tree_actual_sun_hours * 3600 / theoretical_daylight
-                    seasonal_values[baum_id] = round(shading_index, 2)
-        actual_sun_hours[season] = seasonal_values
-        with open("temp_shading.json", "w") as fp:
-            json.dump(actual_sun_hours, fp)
-    return actual_sun_hours
+        map_files = [os.path.join(sun_hours_map_directory, filename) for filename in sorted(os.listdir(sun_hours_map_directory))
+                     if os.path.isfile(os.path.join(sun_hours_map_directory, filename)) and season in filename]
+        if len(map_files) == 0:
+            logger.warning("No sun hours map for %s in %s", season, sun_hours_map_directory)
+            continue
+        logger.info(f"calculating {season}...")
+        # the maps are in EPSG:25833, the tree coordinates are projected in one go
+        actual_sun_hours = sample_raster(map_files[-1], lon, lat, crs="EPSG:4326").astype(float)
+        sun_index[season] = np.round(actual_sun_hours * 3600 / theoretical_daylight, 2)
+    return sun_index
+
+
+def interpolate_monthly(sun_index, dates):
+    """ interpolates the seasonal indices linearly over the year to the middle of each month """
+    seasons = list(sun_index.columns)
+    day_of_year = np.array([dates[season].timetuple().tm_yday for season in seasons])
+    mid_month = np.array([datetime.date(2022, month, 15).timetuple().tm_yday for month in range(1, 13)])
+    weights = np.stack([np.interp(mid_month, day_of_year, np.eye(len(seasons))[i], period=365) for i in range(len(seasons))])
+    monthly = sun_index[seasons].to_numpy() @ weights
+    return pd.DataFrame(monthly, index=sun_index.index, columns=MONTH_COLUMNS).round(2)
 
 
 def get_sunindex_df(
@@ -103,23 +94,20 @@ def get_sunindex_df(
     # TODO: the shadow index file may exist but it may not be complete. How to check it?
     if not os.path.isfile(shadow_index_file):
         logger.warning("%s not found", shadow_index_file)
-        # create json with id as key and coordinates as value
-        trees_df = get_trees(trees_file)
-        simplified_df = trees_df[["id", "geometry"]]
-        logger.info("simplified_df: %s", simplified_df)
-        trees_dict = {}
-        for baumid, coordinate in simplified_df.itertuples(index=False):
-            trees_dict[baumid] = (coordinate.y, coordinate.x)
+        trees_df = get_trees(trees_file, columns=["id"])
+        logger.info("trees: %s", len(trees_df))
         seasons_theoretical_daylight = calc_theoretical_daylight(selected_dates, city)
         logger.info(
             f"seasons_theoretical_daylight: {seasons_theoretical_daylight} qgis_sun_hours_folder: {qgis_sun_hours_folder}"
         )
-        sun_index = calculate_sun_index(
-            seasons_theoretical_daylight, qgis_sun_hours_folder, trees_dict
+        sun_index_df = calculate_sun_index(
+            seasons_theoretical_daylight, qgis_sun_hours_folder, trees_df["id"].to_numpy(),
+            trees_df.geometry.y.to_numpy(), trees_df.geometry.x.to_numpy()
         )
-        sun_index_df = pd.DataFrame(sun_index)
         shadow_index_df = (1.0 - sun_index_df).round(2)
         shadow_index_df.to_csv(shadow_index_file)
+        shadow_index_monthly_df = (1.0 - interpolate_monthly(sun_index_df, selected_dates)).round(2)
+        shadow_index_monthly_df.to_csv(os.path.splitext(shadow_index_file)[0] + "_interpolated.csv")
 
     else:
         logger.warning("The shading index file %s already exist", shadow_index_file)
@@ -10,9 +10,9 @@ Options:
 """
 import pandas as pd
 import sqlalchemy
-from sqlalchemy import create_engine
 from docopt import docopt, DocoptExit
-from qtrees.helper import get_logger, init_db_args
+from qtrees.helper import get_logger, DBSession
+from qtrees.db_writer import copy_to_db
 import sys
 
 logger = get_logger(__name__)
@@ -26,10 +26,8 @@ def main():
     # default start date (if not data is available)
     last_date = '2021-12-31'
     try:
-        db_qtrees, passwd_qtrees = init_db_args(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
-        engine_qtrees = create_engine(
-            f"postgresql://postgres:{passwd_qtrees}@{db_qtrees}:5432/qtrees"
-        )
+        session = DBSession(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
+        engine_qtrees = session.engine
 
         if sqlalchemy.inspect(engine_qtrees).has_table("watering_gdk", schema="private"):
             with engine_qtrees.connect() as con:
@@ -49,10 +47,8 @@ def main():
         exit(121)
 
     try:
-        db_gdk, passwd_gdk = init_db_args(db=args["--db_gdk"], db_type="gdk", logger=logger)
-        engine_gdk = create_engine(
-            f"postgresql://qtrees_readonly:{passwd_gdk}@{db_gdk}:5432/postgres"
-        )
+        session_gdk = DBSession(db=args["--db_gdk"], db_type="gdk", logger=logger)
+        engine_gdk = session_gdk.engine
 
         with engine_gdk.connect() as con:
             # get watering data from GdK
@@ -69,7 +65,7 @@ def main():
                 numeric_only=True).reset_index()
             # write aggregated data to qtrees db
             logger.info("Writing/updating %s new watering data", len(pd_watering))
-            pd_agg.to_sql("watering_gdk", engine_qtrees, if_exists="append", schema="private", index=False)
+            copy_to_db(pd_agg, "watering_gdk", engine_qtrees, schema="private")
             # update MATERIALIZED VIEW
             with engine_qtrees.connect() as con:
                 con.execute("REFRESH MATERIALIZED VIEW public.watering;")
@@ -2,30 +2,38 @@
 """
 Download radolan data and store into db.
 Usage:
-  script_store_radolan_in_db.py [--db_qtrees=DB_QTREES] [--days=DAYS] [--path_to_bezirke=PATH_TO_BEZIRKE]
+  script_store_radolan_in_db.py [--db_qtrees=DB_QTREES] [--days=DAYS] [--path_to_bezirke=PATH_TO_BEZIRKE] [--cache_dir=CACHE_DIR] [--workers=WORKERS]
   script_store_radolan_in_db.py (-h | --help)
 Options:
   --db_qtrees=DB_QTREES                    Database name [default:]
   --days=DAYS                              Number of days to retrieve if no data in db [default: 14]
   --path_to_bezirke=PATH_TO_BEZIRKE        Path to Geojson of Berlin Bezirke [default: ./data/bezirksgrenzen.geojson]
+  --cache_dir=CACHE_DIR                    Directory to cache downloaded RADOLAN files [default: ./data/radolan]
+  --workers=WORKERS                        Number of concurrent downloads [default: 8]
 """
 import warnings
 
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import inspect
 import sqlalchemy
 import datetime
 import geopandas as gpd
 import pandas as pd
+import numpy as np
 from docopt import docopt, DocoptExit
-from qtrees.helper import get_logger, init_db_args
-from qtrees.dwd import get_radolan_data
+from qtrees.helper import get_logger, DBSession
+from qtrees.dwd import RadolanFetcher, RadolanStack, get_radolan_grid_window, read_radolan_composite
+from qtrees.db_writer import copy_to_db
 import os.path
 import sys
+import tempfile
 import pytz
 
 logger = get_logger(__name__)
 warnings.filterwarnings('ignore')
 
+# Backfills longer than a month are stacked in a memory-mapped file
+MAX_HOURS_IN_MEMORY = 24 * 31
+
 
 def get_bezirksgrenzen(file_geojson):
     import requests
@@ -42,11 +50,12 @@ def main():
     logger.info("Args: %s", sys.argv[1:])
     # Parse arguments
     args = docopt(__doc__)
-    db_qtrees, postgres_passwd = init_db_args(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
+    session = DBSession(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
 
     # specific args
     days = int(args["--days"])
     path_to_bezirke = args["--path_to_bezirke"]
+    fetcher = RadolanFetcher(cache_dir=args["--cache_dir"], max_workers=int(args["--workers"]))
 
     if not os.path.exists(path_to_bezirke):
         get_bezirksgrenzen(path_to_bezirke)
@@ -56,10 +65,9 @@ def main():
     )
 
     # write data to db
+    stack_path = None
     try:
-        engine = create_engine(
-            f"postgresql://postgres:{postgres_passwd}@{db_qtrees}:5432/qtrees"
-        )
+        engine = session.engine
         delta = datetime.timedelta(hours=1)
         now = datetime.datetime.now(pytz.timezone("UTC"))
 
@@ -80,23 +88,32 @@ def main():
         with engine.connect() as con:
             rs = con.execute(f"DELETE FROM public.radolan WHERE DATE >= %s", last_date.strftime('%Y-%m-%d'))
 
-        radolan_data = []
+        hours = []
         while last_date <= now:
-            logger.info("Processing RADOLAN data for '%s'", last_date)
-            # hourly
-            radolan = get_radolan_data(
-                nowcast_date=last_date, mask=berlin_mask, xmin=600,
-                xmax=700, ymin=700, ymax=800
-            )
-            if radolan is None:
-                logger.info("Can't get radolan data for '%s'. Skipping...", last_date)
-            else:
-                radolan_gdf, meta_data = radolan
-                radolan_gdf = radolan_gdf.drop(columns=["index_right"])
-                radolan_gdf["timestamp"] = meta_data['datetime']
-                radolan_gdf = radolan_gdf.reset_index()
-                radolan_data.append(radolan_gdf.rename(columns={"index": "tile_id"}))
+            hours.append(last_date)
             last_date += delta
+        logger.info("Downloading RADOLAN data for %s hours", len(hours))
+        radolan_files = fetcher.fetch(hours)
+
+        grid_window = get_radolan_grid_window(mask=berlin_mask, xmin=600, xmax=700, ymin=700, ymax=800)
+        # memory-map the hourly values of long backfills to a file of this run only, removed at the end of the run
+        if len(hours) > MAX_HOURS_IN_MEMORY:
+            os.makedirs(args["--cache_dir"], exist_ok=True)
+            fd, stack_path = tempfile.mkstemp(dir=args["--cache_dir"], prefix="radolan_hourly_", suffix=".npy")
+            os.close(fd)
+        radolan_stack = RadolanStack(grid_window.tile_ids, max_hours=len(hours), path=stack_path)
+        for hour, content in radolan_files.items():
+            logger.info("Processing RADOLAN data for '%s'", hour)
+            if content is None:
+                logger.info("Can't get radolan data for '%s'. Skipping...", hour)
+            else:
+                # hourly
+                radolan_data, meta_data = read_radolan_composite(content)
+                radolan_stack.add(meta_data['datetime'], grid_window.values(radolan_data))
+
+        if len(radolan_stack.timestamps) == 0:
+            logger.info("No new RADOLAN data for %s hours. Nothing to store.", len(hours))
+            return
 
         # write the tiles
         with engine.connect() as con:
@@ -108,8 +125,9 @@ def main():
             rs = con.execute('select COUNT(*) from public.tree_radolan_tile')
             n_tree_radolan_tile = [idx[0] for idx in rs][0]
 
-        radolan_gdf_grid = radolan_gdf.rename(columns={"index": "id"})
-        radolan_gdf_grid = radolan_gdf_grid[~radolan_gdf_grid.id.isin(tiles)]
+        new_tiles = ~np.isin(grid_window.tile_ids, tiles)
+        radolan_gdf_grid = gpd.GeoDataFrame({"id": grid_window.tile_ids[new_tiles]},
+                                            geometry=grid_window.geometry.values[new_tiles])
         logger.debug(f"Storing {len(radolan_gdf_grid)} new tiles to the database.")
         radolan_gdf_grid[["id", "geometry"]].to_postgis("radolan_tiles", engine, if_exists="append", schema="public")
         if len(radolan_gdf_grid) > 0 or n_tree_radolan_tile == 0:
@@ -117,18 +135,10 @@ def main():
                 con.execute('REFRESH MATERIALIZED VIEW public.tree_radolan_tile')
                 logger.info(f"Updated materialized views tree_radolan_tile")
 
-        logger.debug("Storing radolan data for '%s'", meta_data['datetime'])
-        daily_data = gpd.GeoDataFrame(pd.concat(radolan_data, ignore_index=True))
+        logger.debug("Storing radolan data from '%s' to '%s'", hours[0], hours[-1])
+        daily_df = radolan_stack.aggregate_daily()[["tile_id", "date", "rainfall_mm", "rainfall_max_mm"]]
 
-        daily_data["date"] = daily_data["timestamp"].dt.date
-        daily_mean = daily_data.groupby(["tile_id", "date"]).mean(numeric_only = True).reset_index()
-        daily_max= daily_data.groupby(["tile_id", "date"]).max(numeric_only = True).reset_index()
-
-        daily_df = pd.merge(daily_mean[["tile_id", "date", "rainfall_mm"]],
-                daily_max[["tile_id", "date", "rainfall_mm"]].rename(columns={"rainfall_mm": "rainfall_max_mm"}),
-                on=["tile_id", "date"])
-
-        daily_df.to_sql("radolan", engine, if_exists="append", schema="public", index=False)
+        copy_to_db(daily_df, "radolan", engine, schema="public")
             
         logger.info(f"Updating materialized views...")
         with engine.connect() as con:
@@ -139,6 +149,9 @@ def main():
     except Exception as e:
         logger.error("Cannot write to db: %s", e)
         exit(121)
+    finally:
+        if stack_path is not None and os.path.exists(stack_path):
+            os.remove(stack_path)
 
 
 if __name__ == "__main__":
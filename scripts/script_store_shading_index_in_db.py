@@ -9,9 +9,9 @@ Options:
   --shadow_index_file_interpolated=SHADOW_INDEX_FILE_INTERPOLATED     Directory for data [default: data/shading/berlin_shadow_index_interpolated.csv]
   --db_qtrees=DB_QTREES                           Database name [default:]
 """
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import inspect
 from docopt import docopt, DocoptExit
-from qtrees.helper import get_logger, init_db_args
+from qtrees.helper import get_logger, DBSession
 from qtrees.shading_index import get_sunindex_df
 import os.path
 import pandas as pd
@@ -24,7 +24,7 @@ def main():
     logger.info("Args: %s", sys.argv[1:])
     # Parse arguments
     args = docopt(__doc__)
-    db_qtrees, postgres_passwd = init_db_args(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
+    session = DBSession(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
 
     shadow_index_file = args["--shadow_index_file"]
     if not os.path.exists(shadow_index_file):
@@ -36,9 +36,7 @@ def main():
         logger.warning("Shadow index file '%s' does not exist", shadow_index_file_interpolated)
         exit(128)
 
-    engine = create_engine(
-        f"postgresql://postgres:{postgres_passwd}@{db_qtrees}:5432/qtrees"
-    )
+    engine = session.engine
 
     logger.debug("Prepare shading index")
     sunindex_df = get_sunindex_df(shadow_index_file).reset_index().rename(columns={"index": "tree_id", "autumn": "fall"})
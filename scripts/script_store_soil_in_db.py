@@ -12,10 +12,9 @@ import os.path
 import os
 from datetime import datetime
 import pytz
-from sqlalchemy import create_engine
 import sqlalchemy
 from docopt import docopt, DocoptExit
-from qtrees.helper import get_logger, init_db_args
+from qtrees.helper import get_logger, DBSession
 import sys
 from qtrees.fisbroker import get_gdf
 
@@ -26,13 +25,11 @@ def main():
     logger.info("Args: %s", sys.argv[1:])
     # Parse arguments
     args = docopt(__doc__)
-    db_qtrees, postgres_passwd = init_db_args(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
+    session = DBSession(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
 
     data_directory = args["--data_directory"]
 
-    engine = create_engine(
-        f"postgresql://postgres:{postgres_passwd}@{db_qtrees}:5432/qtrees"
-    )
+    engine = session.engine
 
     do_update = True
     if sqlalchemy.inspect(engine).has_table("soil", schema="public"):
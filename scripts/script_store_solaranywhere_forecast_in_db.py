@@ -12,15 +12,15 @@ Options:
 """
 import warnings
 
-from sqlalchemy import create_engine
 import sqlalchemy
 import datetime
 import pandas as pd
 from docopt import docopt, DocoptExit
-from qtrees.helper import get_logger, init_db_args
+from qtrees.helper import get_logger, DBSession
 import os.path
 import sys
-from qtrees.solaranywhere import get_weather
+from qtrees.solaranywhere import SolarAnywhereClient
+from qtrees.db_writer import copy_to_db
 import pytz
 
 logger = get_logger(__name__)
@@ -30,7 +30,7 @@ def main():
     logger.info("Args: %s", sys.argv[1:])
     # Parse arguments
     args = docopt(__doc__)
-    db_qtrees, postgres_passwd = init_db_args(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
+    session = DBSession(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
 
     api_key = os.getenv("SOLARANYWHERE_API_KEY")
     if api_key is None:
@@ -49,18 +49,16 @@ def main():
     else:
         end_date = None
    
-    engine = create_engine(
-        f"postgresql://postgres:{postgres_passwd}@{db_qtrees}:5432/qtrees"
-    )
+    engine = session.engine
 
     with engine.connect() as con:
         rs = con.execute('select id, lat, lng from private.weather_tiles')
         locations = [idx for idx in rs]
         logger.debug("Retrieved data for %s locations!", len(locations))
 
+    tiles = []
     for loc in locations:
         logger.debug("Data for location with id=%s and coordinates (%s, %s)", loc[0], loc[1], loc[2])
-        # write data to db
         try:
             today_local = datetime.date.today()
 
@@ -86,24 +84,34 @@ def main():
                 else:
                     end = end_date+pd.Timedelta(days=1)
 
-                prepared_query = "DELETE FROM private.weather_tile_forecast WHERE tile_id = %(tile_id)s AND date >= %(start_date)s AND date < %(end_date)s"
-                with engine.connect() as connection:
-                    connection.execute(prepared_query, tile_id=loc[0], start_date=start, end_date=end)
-
-                logger.info("Retrieving data from %s to %s.", start, end)
-                weather_data  = get_weather(loc[1], loc[2], api_key, start=start, end=end)
-                logger.info("Inserted data from %s to %s.", weather_data.date.min(), weather_data.date.max())
-                weather_data["tile_id"] = loc[0]
-                weather_data["created_at"] = datetime.datetime.now(pytz.timezone("UTC"))
-                weather_data.to_sql("weather_tile_forecast", engine, if_exists="append", schema="private", index=False)
-                
-                # logger.info(f"Updating materialized views...")
-                # with engine.connect() as con:
-                    # TODO add views if used.   
+                logger.info("Retrieving data for tile %s from %s to %s.", loc[0], start, end)
+                tiles.append(dict(tile_id=loc[0], lat=loc[1], lng=loc[2], start=start, end=end))
         except Exception as e:
-            logger.error("Cannot write to db: %s", e)
+            logger.error("Cannot read from db: %s", e)
             exit(121)
 
+    if len(tiles) == 0:
+        return
+
+    # write data to db
+    try:
+        # all tiles are requested at once, old forecasts are only deleted once the new ones are retrieved
+        weather_data = SolarAnywhereClient(api_key).get_weather(pd.DataFrame(tiles))
+        logger.info("Inserted data from %s to %s.", weather_data.date.min(), weather_data.date.max())
+        weather_data["created_at"] = datetime.datetime.now(pytz.timezone("UTC"))
+
+        prepared_query = "DELETE FROM private.weather_tile_forecast WHERE tile_id = %(tile_id)s AND date >= %(start_date)s AND date < %(end_date)s"
+        with engine.connect() as connection:
+            for tile in tiles:
+                connection.execute(prepared_query, tile_id=tile["tile_id"], start_date=tile["start"], end_date=tile["end"])
+        copy_to_db(weather_data, "weather_tile_forecast", engine, schema="private")
+
+        # logger.info(f"Updating materialized views...")
+        # with engine.connect() as con:
+            # TODO add views if used.   
+    except Exception as e:
+        logger.error("Cannot write to db: %s", e)
+        exit(121)
 
 if __name__ == "__main__":
     try:
@@ -11,15 +11,15 @@ Options:
 """
 import warnings
 
-from sqlalchemy import create_engine
 import sqlalchemy
 import datetime
 import pandas as pd
 from docopt import docopt, DocoptExit
-from qtrees.helper import get_logger, init_db_args
+from qtrees.helper import get_logger, DBSession
 import os.path
 import sys
-from qtrees.solaranywhere import get_weather
+from qtrees.solaranywhere import SolarAnywhereClient
+from qtrees.db_writer import copy_to_db
 import pytz
 
 logger = get_logger(__name__)
@@ -29,7 +29,7 @@ def main():
     logger.info("Args: %s", sys.argv[1:])
     # Parse arguments
     args = docopt(__doc__)
-    db_qtrees, postgres_passwd = init_db_args(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
+    session = DBSession(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
 
     api_key = os.getenv("SOLARANYWHERE_API_KEY")
     if api_key is None:
@@ -44,9 +44,7 @@ def main():
     else: 
         start_date = None
 
-    engine = create_engine(
-        f"postgresql://postgres:{postgres_passwd}@{db_qtrees}:5432/qtrees"
-    )
+    engine = session.engine
 
     with engine.connect() as con:
         rs = con.execute('select id, lat, lng from private.weather_tiles')
@@ -54,9 +52,9 @@ def main():
         logger.debug("Retrieved data for %s locations!", len(locations))
 
 
+    tiles = []
     for loc in locations:
         logger.debug("Data for location with id=%s and coordinates (%s, %s)", loc[0], loc[1], loc[2])
-        # write data to db
         try:
             today_local = datetime.date.today()
 
@@ -81,18 +79,27 @@ def main():
                 else:
                     start = start_date
 
-                logger.info("Inserting data from %s to %s.", start, yesterday)
-                weather_data  = get_weather(loc[1], loc[2], api_key, start=start, end=yesterday+datetime.timedelta(days=1))
-                weather_data["tile_id"] = loc[0]
-                weather_data.to_sql("weather_tile_measurement", engine, if_exists="append", schema="private", index=False, method='multi')
-                
-                logger.info(f"Updating materialized views...")
-                with engine.connect() as con:
-                    con.execute('REFRESH MATERIALIZED VIEW private.weather_solaranywhere_14d_agg')
+                logger.info("Inserting data for tile %s from %s to %s.", loc[0], start, yesterday)
+                tiles.append(dict(tile_id=loc[0], lat=loc[1], lng=loc[2], start=start, end=yesterday+datetime.timedelta(days=1)))
         except Exception as e:
-            logger.error("Cannot write to db: %s", e)
+            logger.error("Cannot read from db: %s", e)
             exit(121)
 
+    if len(tiles) == 0:
+        return
+
+    # write data to db
+    try:
+        # all tiles are requested at once
+        weather_data = SolarAnywhereClient(api_key).get_weather(pd.DataFrame(tiles))
+        copy_to_db(weather_data, "weather_tile_measurement", engine, schema="private")
+
+        logger.info(f"Updating materialized views...")
+        with engine.connect() as con:
+            con.execute('REFRESH MATERIALIZED VIEW private.weather_solaranywhere_14d_agg')
+    except Exception as e:
+        logger.error("Cannot write to db: %s", e)
+        exit(121)
 
 if __name__ == "__main__":
     try:
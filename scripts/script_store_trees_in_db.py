@@ -12,9 +12,8 @@ Options:
 
 import sys
 import sqlalchemy
-from sqlalchemy import create_engine
 from docopt import docopt, DocoptExit
-from qtrees.helper import get_logger, init_db_args
+from qtrees.helper import get_logger, DBSession
 from qtrees.fisbroker import store_trees_batchwise_to_db, download_tree_file
 import os.path
 import pytz
@@ -27,15 +26,13 @@ def main():
     # Parse arguments
     args = docopt(__doc__)
     logger.debug("Init db args")
-    db_qtrees, postgres_passwd = init_db_args(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
+    session = DBSession(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
 
     data_directory = args["--data_directory"]
     n_batch_size = int(args["--batch_size"])
 
     logger.debug("Create db engine")
-    engine = create_engine(
-        f"postgresql://postgres:{postgres_passwd}@{db_qtrees}:5432/qtrees"
-    )
+    engine = session.engine
 
     logger.debug("Check if data already exists")
     if sqlalchemy.inspect(engine).has_table("trees", schema="public"):
@@ -12,9 +12,8 @@ Options:
 import pandas as pd
 import geopandas as gpd
 import sqlalchemy
-from sqlalchemy import create_engine
 from docopt import docopt, DocoptExit
-from qtrees.helper import get_logger, init_db_args
+from qtrees.helper import get_logger, DBSession
 from qtrees.dwd import get_weather_stations, get_observations
 import requests
 import sys
@@ -26,15 +25,13 @@ def main():
     logger.info("Args: %s", sys.argv[1:])
     # Parse arguments
     args = docopt(__doc__)
-    db_qtrees, postgres_passwd = init_db_args(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
+    session = DBSession(db=args["--db_qtrees"], db_type="qtrees", logger=logger)
 
     station_ids = args["--station_id"].rsplit(sep=',')
     station_ids = list(map(int, station_ids))
     measurement = args["--measurement"]
 
-    engine = create_engine(
-        f"postgresql://postgres:{postgres_passwd}@{db_qtrees}:5432/qtrees"
-    )
+    engine = session.engine
 
     stations = get_weather_stations(station_ids, measurement)
 
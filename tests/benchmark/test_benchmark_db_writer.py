@@ -0,0 +1,78 @@
+import os
+import time
+import datetime
+import unittest
+import numpy as np
+import pandas as pd
+import pytz
+from sqlalchemy import create_engine
+from qtrees.db_writer import BulkWriter, copy_to_db
+from qtrees.helper import get_logger
+
+# Rows of one forecast batch: trees x depths x horizon days
+N_ROWS = int(os.getenv("QTREES_BENCHMARK_ROWS", 100000 * 4 * 14 // 10))
+
+
+def make_forecast(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "tree_id": [f"00008100:{i:06d}" for i in rng.integers(0, n_rows // 56 + 1, n_rows)],
+        "type_id": rng.integers(1, 5, n_rows),
+        "timestamp": pd.Timestamp("2023-06-01", tz="UTC") + pd.to_timedelta(rng.integers(0, 14, n_rows), unit="D"),
+        "value": rng.normal(50, 10, n_rows),
+        "created_at": datetime.datetime.now(pytz.timezone("UTC")),
+        "model_id": "Random Forest (full)",
+    })
+
+
+class BenchmarkDbWriter(unittest.TestCase):
+    """Throughput of the bulk writer against a local Postgres, e.g. QTREES_BENCHMARK_DB=postgresql://postgres:<passwd>@localhost:5432/qtrees"""
+    table = "benchmark_forecast"
+
+    def setUp(self):
+        url = os.getenv("QTREES_BENCHMARK_DB")
+        if not os.getenv("QTREES_BENCHMARK") or not url:
+            self.skipTest("QTREES_BENCHMARK or QTREES_BENCHMARK_DB not set")
+        self.logger = get_logger(__name__)
+        self.engine = create_engine(url)
+        with self.engine.begin() as con:
+            con.execute(f"DROP TABLE IF EXISTS public.{self.table}")
+            con.execute(f"CREATE TABLE public.{self.table} (id SERIAL PRIMARY KEY, tree_id TEXT, type_id INTEGER, "
+                        "timestamp TIMESTAMPTZ, value REAL, created_at TIMESTAMPTZ, model_id TEXT)")
+            con.execute(f"CREATE INDEX ON public.{self.table} (tree_id)")
+
+    def tearDown(self):
+        with self.engine.begin() as con:
+            con.execute(f"DROP TABLE IF EXISTS public.{self.table}")
+
+    def _time(self, name, func, df):
+        with self.engine.begin() as con:
+            con.execute(f"TRUNCATE public.{self.table}")
+        start = time.perf_counter()
+        func(df)
+        elapsed = time.perf_counter() - start
+        with self.engine.connect() as con:
+            n_rows = con.execute(f"SELECT COUNT(*) FROM public.{self.table}").scalar()
+        self.assertEqual(n_rows, len(df))
+        self.logger.info("%s: %s rows in %.2fs, %.0f rows/s", name, len(df), elapsed, len(df) / elapsed)
+
+    def test_throughput(self):
+        df = make_forecast(N_ROWS)
+        self._time("copy_to_db", lambda x: copy_to_db(x, self.table, self.engine), df)
+
+        def staged(x):
+            with BulkWriter(self.engine, self.table, staging=True) as writer:
+                for chunk in np.array_split(x, 10):
+                    writer.write(chunk)
+        self._time("BulkWriter(staging=True)", staged, df)
+        self._time("to_sql(method='multi')",
+                   lambda x: x.to_sql(self.table, self.engine, if_exists="append", schema="public", index=False,
+                                      method="multi", chunksize=1000), df)
+        # one INSERT per row, only on a sample to keep the runtime bounded
+        sample = df.iloc[:len(df) // 10]
+        self._time("to_sql(method=None)",
+                   lambda x: x.to_sql(self.table, self.engine, if_exists="append", schema="public", index=False), sample)
+
+
+if __name__ == '__main__':
+    unittest.main()
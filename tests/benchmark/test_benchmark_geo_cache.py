@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+import geopandas as gpd
+from qtrees.geo_cache import GeoParquetCache
+from qtrees.helper import get_logger
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "unit"))
+from test_fisbroker import make_trees  # noqa: E402
+
+# Street and anlagen trees of Berlin
+N_TREES = int(os.getenv("QTREES_BENCHMARK_TREES", 900000))
+
+
+class BenchmarkGeoCache(unittest.TestCase):
+    def setUp(self):
+        if not os.getenv("QTREES_BENCHMARK"):
+            self.skipTest("QTREES_BENCHMARK not set")
+        self.logger = get_logger(__name__)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.trees = make_trees(N_TREES).to_crs(4326)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _time(self, name, func):
+        start = time.perf_counter()
+        result = func()
+        self.logger.info("%s: %.2fs", name, time.perf_counter() - start)
+        return result
+
+    def test_read_write(self):
+        geojson_file = os.path.join(self.tmp_dir.name, "all_trees_gdf.geojson")
+        gml_file = os.path.join(self.tmp_dir.name, "wfs_baumbestand.xml")
+        cache = GeoParquetCache(self.tmp_dir.name)
+        self.logger.info("%s trees", N_TREES)
+        self._time("GeoJSON write", lambda: self.trees.to_file(geojson_file, driver="GeoJSON"))
+        self._time("GML write", lambda: self.trees.to_file(gml_file, driver="GML"))
+        file_path = self._time("GeoParquet write", lambda: cache.write("all_trees_gdf", self.trees))
+        self.logger.info("sizes: GeoJSON %.0f MB, GML %.0f MB, GeoParquet %.0f MB", os.path.getsize(geojson_file) / 2**20,
+                         os.path.getsize(gml_file) / 2**20, os.path.getsize(file_path) / 2**20)
+
+        self._time("GeoJSON read", lambda: gpd.read_file(geojson_file, driver="GeoJSON"))
+        self._time("GML read", lambda: gpd.read_file(gml_file))
+        gdf = self._time("GeoParquet read", lambda: cache.read("all_trees_gdf"))
+        self.assertEqual(len(gdf), N_TREES)
+        self._time("GeoParquet read id and geometry", lambda: cache.read("all_trees_gdf", columns=["baumid"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import sys
+import resource
+import tempfile
+import unittest
+import multiprocessing
+import pandas as pd
+from qtrees.helper import get_logger
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "unit"))
+from test_data_processor import make_training_data  # noqa: E402
+
+# Sensor trees of a full-city training download, scale up to see how memory grows
+N_SENSOR_TREES = int(os.getenv("QTREES_BENCHMARK_SENSOR_TREES", 600))
+
+
+def peak_rss_mb(file_path, compact, forecast):
+    """Peak RSS in MB of loading a training download and preprocessing it, above the RSS before loading"""
+    from qtrees.data_processor import PreprocessorForecast, PreprocessorNowcast, compact_dtypes
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    X = pd.read_pickle(file_path)
+    if compact:
+        X = compact_dtypes(X)
+    preprocessor = PreprocessorForecast() if forecast else PreprocessorNowcast()
+    preprocessor.fit(X)
+    X = preprocessor.transform_train(X)
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024
+
+
+class BenchmarkMemory(unittest.TestCase):
+    def setUp(self):
+        if not os.getenv("QTREES_BENCHMARK"):
+            self.skipTest("QTREES_BENCHMARK not set")
+        self.logger = get_logger(__name__)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _peak_rss(self, file_path, compact, forecast):
+        # a fresh interpreter per run, the peak RSS of a process never goes down
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            return pool.apply(peak_rss_mb, (file_path, compact, forecast))
+
+    def test_training_download(self):
+        file_path = os.path.join(self.tmp_dir.name, "training_data.pkl")
+        X = make_training_data(n_trees=N_SENSOR_TREES)
+        self.logger.info("%s sensor trees, %s rows, %.0f MB in default dtypes", N_SENSOR_TREES, len(X),
+                         X.memory_usage(deep=True).sum() / 2**20)
+        X.to_pickle(file_path)
+        del X
+        for forecast in [False, True]:
+            default = self._peak_rss(file_path, compact=False, forecast=forecast)
+            compact = self._peak_rss(file_path, compact=True, forecast=forecast)
+            self.logger.info("%s training: peak RSS %.0f MB in default dtypes, %.0f MB compact",
+                             "forecast" if forecast else "nowcast", default, compact)
+            self.assertLess(compact, default)
+
+
+if __name__ == '__main__':
+    unittest.main()
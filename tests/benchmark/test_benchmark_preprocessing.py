@@ -0,0 +1,34 @@
+import os
+import sys
+import time
+import unittest
+from qtrees.data_processor import Preprocessor
+from qtrees.helper import get_logger
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "unit"))
+from test_data_processor import make_sensor_data  # noqa: E402
+
+# Roughly the number of trees equipped with sensors today
+N_SENSOR_TREES = int(os.getenv("QTREES_BENCHMARK_SENSOR_TREES", 60))
+
+
+class BenchmarkPreprocessing(unittest.TestCase):
+    def setUp(self):
+        if not os.getenv("QTREES_BENCHMARK"):
+            self.skipTest("QTREES_BENCHMARK not set")
+        self.logger = get_logger(__name__)
+
+    def _time(self, func, X):
+        start = time.perf_counter()
+        func(X.copy())
+        return time.perf_counter() - start
+
+    def test_fill_gaps(self):
+        preprocessor = Preprocessor()
+        for scale in [1, 10, 100]:
+            X = make_sensor_data(n_trees=N_SENSOR_TREES * scale)
+            self.logger.info("_fill_gaps %sx (%s rows): %.2fs", scale, len(X), self._time(preprocessor._fill_gaps, X))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+import unittest
+from qtrees.dwd import RadolanGridWindow
+from qtrees.helper import get_logger
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "unit"))
+from test_dwd import make_radolan_grid, make_radolan_data, make_mask  # noqa: E402
+
+# Window used by script_store_radolan_in_db.py
+SCRIPT_WINDOW = dict(xmin=600, xmax=700, ymin=700, ymax=800)
+N_HOURS = 24
+
+
+class BenchmarkRadolan(unittest.TestCase):
+    def setUp(self):
+        if not os.getenv("QTREES_BENCHMARK"):
+            self.skipTest("QTREES_BENCHMARK not set")
+        self.logger = get_logger(__name__)
+        self.radolan_grid = make_radolan_grid()
+        self.hours = [make_radolan_data(seed=i) for i in range(N_HOURS)]
+
+    def test_grid_window(self):
+        start = time.perf_counter()
+        window = RadolanGridWindow(self.radolan_grid, mask=make_mask(), **SCRIPT_WINDOW)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        for radolan_data in self.hours:
+            window.to_geodataframe(radolan_data)
+        per_hour = (time.perf_counter() - start) / N_HOURS
+        start = time.perf_counter()
+        for radolan_data in self.hours:
+            window.values(radolan_data)
+        values_per_hour = (time.perf_counter() - start) / N_HOURS
+
+        self.logger.info("RADOLAN window %s, %s cells in mask", SCRIPT_WINDOW, len(window.tile_ids))
+        self.logger.info("cached window: %.1f ms once, %.2f ms per hour as GeoDataFrame, %.3f ms per hour as array",
+                         build * 1000, per_hour * 1000, values_per_hour * 1000)
+
+    def test_full_composite(self):
+        start = time.perf_counter()
+        window = RadolanGridWindow(self.radolan_grid, mask=make_mask())
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        for radolan_data in self.hours:
+            window.to_geodataframe(radolan_data)
+        per_hour = (time.perf_counter() - start) / N_HOURS
+        self.logger.info("RADOLAN full 900x900 composite: %.2fs once, %.2f ms per hour", build, per_hour * 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import unittest
+import pandas as pd
+from sqlalchemy import create_engine
+from qtrees.db_writer import BulkWriter
+
+SCHEMA = "bulk_writer_test"
+
+
+class TestBulkWriterSwap(unittest.TestCase):
+    """Runs the staged writes against a scratch Postgres, e.g. QTREES_TEST_DB=postgresql://postgres:<passwd>@localhost:5432/postgres"""
+
+    def setUp(self):
+        url = os.getenv("QTREES_TEST_DB")
+        if not url:
+            self.skipTest("No test DB URL set")
+        self.engine = create_engine(url)
+        with self.engine.begin() as con:
+            con.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}")
+            con.execute(f"CREATE TABLE {SCHEMA}.trees (id TEXT PRIMARY KEY); "
+                        f"INSERT INTO {SCHEMA}.trees VALUES ('a'), ('b'), ('c')")
+            con.execute(f"CREATE TABLE {SCHEMA}.nowcast (id SERIAL PRIMARY KEY, tree_id TEXT REFERENCES {SCHEMA}.trees(id), "
+                        "type_id INTEGER, value REAL, created_at timestamptz NOT NULL DEFAULT now())")
+            con.execute(f"CREATE INDEX idx_nowcast_tree_id ON {SCHEMA}.nowcast(tree_id)")
+            con.execute(f"GRANT SELECT ON {SCHEMA}.nowcast TO PUBLIC")
+            con.execute(f"INSERT INTO {SCHEMA}.nowcast (tree_id, type_id, value) VALUES ('a', 1, 10), ('b', 1, 20)")
+            con.execute(f"CREATE VIEW {SCHEMA}.latest AS SELECT tree_id, value FROM {SCHEMA}.nowcast WHERE type_id = 1")
+            con.execute(f"CREATE MATERIALIZED VIEW {SCHEMA}.dashboard AS SELECT tree_id, AVG(value) AS value FROM {SCHEMA}.latest "
+                        "GROUP BY tree_id")
+            con.execute(f"CREATE UNIQUE INDEX idx_dashboard_tree_id ON {SCHEMA}.dashboard(tree_id)")
+            con.execute(f"GRANT SELECT ON {SCHEMA}.dashboard TO PUBLIC")
+
+    def tearDown(self):
+        with self.engine.begin() as con:
+            con.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+
+    def _query(self, statement):
+        with self.engine.connect() as con:
+            return [tuple(row) for row in con.execute(statement)]
+
+    def _tables(self):
+        return sorted(row[0] for row in self._query(f"SELECT tablename FROM pg_tables WHERE schemaname = '{SCHEMA}'"))
+
+    def test_swap(self):
+        with BulkWriter(self.engine, "nowcast", schema=SCHEMA, staging=True) as writer:
+            writer.write(pd.DataFrame({"tree_id": ["a", "c"], "type_id": [1, 1], "value": [1., 3.]}))
+            writer.write(pd.DataFrame({"tree_id": ["c"], "type_id": [2], "value": [4.]}))
+        self.assertEqual(writer.rebuilt_views, [f"{SCHEMA}.latest", f"{SCHEMA}.dashboard"])
+        self.assertEqual(self._query(f"SELECT tree_id, type_id, value FROM {SCHEMA}.nowcast ORDER BY id"),
+                         [("a", 1, 1.), ("c", 1, 3.), ("c", 2, 4.)])
+        self.assertEqual(self._query(f"SELECT tree_id, value FROM {SCHEMA}.dashboard ORDER BY tree_id"), [("a", 1.), ("c", 3.)])
+        self.assertEqual(self._tables(), ["nowcast", "trees"])
+        self.assertEqual(self._query(f"SELECT indexname FROM pg_indexes WHERE schemaname = '{SCHEMA}' AND tablename = 'nowcast' "
+                                     "ORDER BY 1"), [("idx_nowcast_tree_id",), ("nowcast_pkey",)])
+        self.assertEqual(self._query(f"SELECT conname FROM pg_constraint WHERE conrelid = '{SCHEMA}.nowcast'::regclass "
+                                     "AND contype = 'f'"), [("nowcast_tree_id_fkey",)])
+        self.assertEqual(self._query(f"SELECT indexname FROM pg_indexes WHERE tablename = 'dashboard'"), [("idx_dashboard_tree_id",)])
+        for table in ["nowcast", "dashboard"]:
+            self.assertEqual(self._query(f"SELECT has_table_privilege('public', '{SCHEMA}.{table}', 'SELECT')"), [(True,)])
+        # the serial id keeps counting and its sequence is owned by the new table
+        with self.engine.begin() as con:
+            con.execute(f"INSERT INTO {SCHEMA}.nowcast (tree_id, type_id, value) VALUES ('b', 1, 2)")
+        self.assertEqual(self._query(f"SELECT MAX(id) FROM {SCHEMA}.nowcast"), [(6,)])
+        self.assertEqual(self._query(f"SELECT pg_get_serial_sequence('{SCHEMA}.nowcast', 'id')"), [(f"{SCHEMA}.nowcast_id_seq",)])
+
+    def test_failure_keeps_table(self):
+        with self.assertRaises(RuntimeError):
+            with BulkWriter(self.engine, "nowcast", schema=SCHEMA, staging=True) as writer:
+                writer.write(pd.DataFrame({"tree_id": ["c"], "type_id": [1], "value": [3.]}))
+                raise RuntimeError("inference failed")
+        self.assertEqual(self._query(f"SELECT tree_id, value FROM {SCHEMA}.nowcast ORDER BY id"), [("a", 10.), ("b", 20.)])
+        self.assertEqual(self._tables(), ["nowcast", "trees"])
+
+    def test_invalid_rows_keep_table(self):
+        # the foreign key is checked on the staging table before the swap
+        with self.assertRaises(Exception):
+            with BulkWriter(self.engine, "nowcast", schema=SCHEMA, staging=True) as writer:
+                writer.write(pd.DataFrame({"tree_id": ["unknown"], "type_id": [1], "value": [3.]}))
+        self.assertEqual(self._query(f"SELECT tree_id, value FROM {SCHEMA}.nowcast ORDER BY id"), [("a", 10.), ("b", 20.)])
+        self.assertEqual(self._tables(), ["nowcast", "trees"])
+
+    def test_overlapping_writers(self):
+        first = BulkWriter(self.engine, "nowcast", schema=SCHEMA, staging=True).__enter__()
+        with BulkWriter(self.engine, "nowcast", schema=SCHEMA, staging=True) as second:
+            first.write(pd.DataFrame({"tree_id": ["a"], "type_id": [1], "value": [1.]}))
+            second.write(pd.DataFrame({"tree_id": ["b"], "type_id": [1], "value": [2.]}))
+        self.assertEqual(self._query(f"SELECT tree_id, value FROM {SCHEMA}.nowcast"), [("b", 2.)])
+        first.write(pd.DataFrame({"tree_id": ["c"], "type_id": [1], "value": [3.]}))
+        first.__exit__(None, None, None)
+        self.assertEqual(self._query(f"SELECT tree_id, value FROM {SCHEMA}.nowcast ORDER BY id"), [("a", 1.), ("c", 3.)])
+        self.assertEqual(self._tables(), ["nowcast", "trees"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+from qtrees.data_processor import (DataLoader, Preprocessor, PreprocessorForecast, PreprocessorNowcast, add_lag_features,
+                                   compact_dtypes, get_autoreg_lags, pg_text_array)
+
+
+def make_sensor_data(n_trees, start="2022-03-20", end="2022-10-10", gap_share=0.3, seed=0):
+    """Synthetic sensor measurements with irregular gaps for every tree and depth"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, end, freq="D", tz="UTC")
+    frames = []
+    for tree in range(n_trees):
+        for type_id in [1, 2, 3]:
+            keep = rng.random(len(dates)) > gap_share
+            # force a gap longer than a week once in a while
+            if tree % 3 == 0:
+                keep[40:52] = False
+            timestamps = dates[keep]
+            frames.append(pd.DataFrame({
+                "type_id": type_id,
+                "tree_id": f"tree_{tree:05d}",
+                "timestamp": timestamps,
+                "value": rng.normal(50, 10, len(timestamps)),
+                "gattung": rng.choice(["TILIA", "ACER", "QUERCUS"]),
+                "standalter": pd.Categorical([rng.choice(["jung", "mittel", "alt"])] * len(timestamps),
+                                             categories=["jung", "mittel", "alt"]),
+                "site_id": tree % 5,
+                "shading_index": rng.random(len(timestamps)),
+            }))
+    return pd.concat(frames, ignore_index=True).sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+class TestFillGaps(unittest.TestCase):
+    def test_fills_gaps(self):
+        # a gap longer than a week, a reading later than midnight, and days outside of April to September
+        X = pd.DataFrame({"type_id": [1, 1, 1, 2, 2, 2],
+                          "tree_id": ["a", "a", "a", "a", "b", "b"],
+                          "timestamp": pd.to_datetime(["2022-04-12", "2022-03-30", "2022-04-02", "2022-04-01 10:00",
+                                                       "2022-09-29", "2022-10-02"], utc=True),
+                          "value": [3., 1., 2., 5., 10., 11.],
+                          "gattung": ["TILIA", "TILIA", "TILIA", "TILIA", "ACER", "ACER"]})
+        result = Preprocessor()._fill_gaps(X)
+        expected = pd.DataFrame({
+            "timestamp": pd.to_datetime([f"2022-04-{day:02d}" for day in range(1, 13)] + ["2022-04-01", "2022-09-29", "2022-09-30"],
+                                        utc=True),
+            "value": [1.] + [2.] * 8 + [np.nan, np.nan, 3., np.nan, 10., 10.],
+            "gattung": ["TILIA"] * 9 + [np.nan, np.nan, "TILIA", np.nan, "ACER", "ACER"],
+            "type_id": [1] * 12 + [2] * 3,
+            "tree_id": ["a"] * 13 + ["b"] * 2})
+        pd.testing.assert_frame_equal(result, expected)
+
+    def test_missing_depth_is_skipped(self):
+        X = make_sensor_data(n_trees=3)
+        X = X[~((X.tree_id == "tree_00001") & (X.type_id == 2))]
+        result = Preprocessor()._fill_gaps(X.copy())
+        self.assertFalse(((result.tree_id == "tree_00001") & (result.type_id == 2)).any())
+        self.assertEqual(result[result.type_id == 1].tree_id.nunique(), 3)
+
+
+class TestAutoregressiveFeatures(unittest.TestCase):
+    def test_lags_per_tree_and_depth(self):
+        X = pd.DataFrame({"timestamp": pd.to_datetime(["2022-05-02", "2022-05-01", "2022-05-03", "2022-05-01", "2022-05-02",
+                                                       "2022-05-01"], utc=True),
+                          "value": [2., 1., 3., 10., 20., 7.], "type_id": [1, 1, 1, 2, 2, 1],
+                          "tree_id": ["b", "b", "b", "b", "b", "a"]})
+        result = PreprocessorForecast(autoreg_lag=2)._add_autoregressive_features(X)
+        self.assertEqual(list(result.columns), ["tree_id", "type_id", "timestamp", "shift_2", "shift_1", "value"])
+        self.assertEqual(list(zip(result["tree_id"], result["type_id"])), [("a", 1), ("b", 1), ("b", 1), ("b", 1), ("b", 2), ("b", 2)])
+        np.testing.assert_array_equal(result["value"], [7., 1., 2., 3., 10., 20.])
+        np.testing.assert_array_equal(result["shift_1"], [np.nan, np.nan, 1., 2., np.nan, 10.])
+        np.testing.assert_array_equal(result["shift_2"], [np.nan, np.nan, np.nan, 1., np.nan, np.nan])
+
+    def test_lag_sets(self):
+        self.assertEqual(get_autoreg_lags(3), [1, 2, 3])
+        self.assertEqual(get_autoreg_lags([7, 1, 2]), [1, 2, 7])
+        preprocessor = PreprocessorForecast(autoreg_lag=[1, 7], autoreg_windows=[3])
+        self.assertEqual(preprocessor.autoreg_columns, ["shift_1", "shift_7", "rolling_mean_3"])
+
+    def test_rolling_means(self):
+        X = pd.DataFrame({"tree_id": ["a"] * 4 + ["b"] * 3, "type_id": 1,
+                          "timestamp": list(pd.date_range("2022-05-01", periods=4, tz="UTC")) +
+                                       list(pd.date_range("2022-05-01", periods=3, tz="UTC")),
+                          "value": [1.0, 2.0, 3.0, 4.0, 10.0, np.nan, 30.0]})
+        result = add_lag_features(X.sample(frac=1, random_state=0), lags=[2], windows=[2])
+        np.testing.assert_array_equal(result["shift_2"], [np.nan, np.nan, 1.0, 2.0, np.nan, np.nan, 10.0])
+        np.testing.assert_array_equal(result["rolling_mean_2"], [np.nan, 1.0, 1.5, 2.5, np.nan, 10.0, 10.0])
+
+
+def make_training_data(n_trees, seed=0):
+    """Synthetic training download with the private and weather columns of DataLoader.download_training_data, in default dtypes"""
+    rng = np.random.default_rng(seed)
+    X = make_sensor_data(n_trees=n_trees, seed=seed)
+    X["month"] = X["timestamp"].dt.month
+    X["baumscheibe_surface"] = rng.choice(["Rasen", "offen", None], len(X))
+    X["water_sga"] = np.where(rng.random(len(X)) < 0.3, np.nan, rng.random(len(X)) * 100)
+    X["rainfall_mm"] = rng.random(len(X)) * 20
+    return X
+
+
+class TestCompactDtypes(unittest.TestCase):
+    def setUp(self):
+        self.X = make_training_data(n_trees=12)
+
+    def test_schema(self):
+        result = compact_dtypes(self.X)
+        for col in ["tree_id", "gattung", "standalter", "baumscheibe_surface"]:
+            self.assertIsInstance(result[col].dtype, pd.CategoricalDtype)
+        for col in ["type_id", "month"]:
+            self.assertEqual(result[col].dtype, np.int8)
+        self.assertEqual(result["site_id"].dtype, "Int64")
+        for col in ["value", "shading_index", "water_sga", "rainfall_mm"]:
+            self.assertEqual(result[col].dtype, np.float32)
+        self.assertIs(compact_dtypes(result), result)
+        self.assertLess(result.memory_usage(deep=True).sum(), self.X.memory_usage(deep=True).sum() / 4)
+
+    def test_transform_train_matches(self):
+        for preprocessor_class in [PreprocessorNowcast, PreprocessorForecast]:
+            expected_preprocessor, preprocessor = preprocessor_class(), preprocessor_class()
+            expected_preprocessor.fit(self.X)
+            preprocessor.fit(compact_dtypes(self.X))
+            expected = expected_preprocessor.transform_train(self.X.copy())
+            result = preprocessor.transform_train(compact_dtypes(self.X))
+            self.assertEqual(list(result.columns), list(expected.columns))
+            np.testing.assert_array_equal(result.index, expected.index)
+            np.testing.assert_allclose(result.to_numpy(dtype=float), expected.to_numpy(dtype=float), rtol=1e-6)
+            self.assertEqual(set(result.dtypes) - {np.dtype(np.float32)}, {np.dtype(np.int8), pd.Int64Dtype()})
+
+    def test_bigint_ids(self):
+        # BIGINT site ids beyond 2^24 stay distinct, with missing sites as NA
+        site_ids = pd.Series([2**24, 2**24 + 1, 9007199254740000, np.nan], name="site_id")
+        result = compact_dtypes(site_ids.to_frame())["site_id"]
+        self.assertEqual(result.iloc[:3].tolist(), [2**24, 2**24 + 1, 9007199254740000])
+        self.assertTrue(result.isna().iloc[3])
+
+    def test_fitted_preprocessor_transforms_compact_data(self):
+        # preprocessors fitted on data in default dtypes keep working on compact inference data
+        preprocessor = PreprocessorNowcast()
+        preprocessor.fit(self.X)
+        X = self.X.drop(columns=["value", "type_id", "site_id"]).drop_duplicates(["tree_id", "timestamp"])
+        expected = preprocessor.transform_inference(X.copy())
+        result = preprocessor.transform_inference(compact_dtypes(X))
+        np.testing.assert_allclose(result.to_numpy(dtype=float), expected.to_numpy(dtype=float), rtol=1e-6)
+
+
+class TestPgTextArray(unittest.TestCase):
+    def test_quotes_every_element(self):
+        self.assertEqual(pg_text_array(("00008100:000c8ed5", "e,f", "NULL")), '{"00008100:000c8ed5","e,f","NULL"}')
+
+    def test_escapes_quotes_and_backslashes(self):
+        self.assertEqual(pg_text_array(['a"b', "c\\d"]), '{"a\\"b","c\\\\d"}')
+
+    def test_empty(self):
+        self.assertEqual(pg_text_array([]), "{}")
+
+
+class TestStreamInferenceData(unittest.TestCase):
+    def setUp(self):
+        self.dates = pd.date_range("2023-09-25", "2023-10-06", tz="UTC")
+        self.dates = self.dates[self.dates.month.isin(range(4, 11))]
+        self.trees = pd.DataFrame({"tree_id": [f"tree_{i:02d}" for i in range(7)], "gattung": "TILIA",
+                                   "standalter": [1, 5, 20, 2, 8, 50, 30]})
+        self.weather = pd.DataFrame({"rainfall_mm": np.arange(len(self.dates), dtype=np.float32)}, index=self.dates)
+        self.queries = []
+
+    def read_sql(self, engine, query, params=None):
+        """Answers TREE_DATES_QUERY for the public run like the DB, one page of trees after last_id"""
+        self.queries.append(dict(params))
+        page = self.trees[self.trees["tree_id"] > params["last_id"]].head(params["n_trees"])
+        days = self.dates[(self.dates.date >= params["start"]) & (self.dates.date <= params["end"])].tz_localize(None)
+        rows = page.merge(pd.DataFrame({"timestamp": days}), how="cross")
+        return rows.assign(month=rows["timestamp"].dt.month, shading_index=np.where(rows["timestamp"].dt.month == 9, 0.25, 0.5))
+
+    def test_chunks(self):
+        loader = DataLoader(engine=None)
+        with mock.patch("qtrees.data_processor.read_sql", self.read_sql), \
+                mock.patch.object(DataLoader, "_growing_season_dates", return_value=self.dates), \
+                mock.patch.object(DataLoader, "_get_weather_measurements", return_value=self.weather):
+            chunks = list(loader.stream_inference_data(forecast=False, public_run=True, chunksize=2 * len(self.dates) + 1))
+        # keyset paging by tree id, two whole trees per chunk, one more query for the empty last page
+        self.assertEqual([query["last_id"] for query in self.queries], ["", "tree_01", "tree_03", "tree_05", "tree_06"])
+        self.assertEqual([len(chunk) for chunk in chunks], [24, 24, 24, 12])
+        for chunk in chunks:
+            self.assertEqual(list(chunk.columns), ["tree_id", "gattung", "standalter", "timestamp", "month", "shading_index", "rainfall_mm"])
+            self.assertIsInstance(chunk["tree_id"].dtype, pd.CategoricalDtype)
+            self.assertEqual(chunk["month"].dtype, np.int8)
+            self.assertEqual(str(chunk["timestamp"].dt.tz), "UTC")
+        data = pd.concat([chunk.astype({"tree_id": str, "standalter": str}) for chunk in chunks])
+        self.assertEqual(data["tree_id"].tolist(), np.repeat(self.trees["tree_id"], len(self.dates)).tolist())
+        self.assertEqual(data["timestamp"].tolist(), np.tile(self.dates, len(self.trees)).tolist())
+        self.assertEqual(data.drop_duplicates("tree_id")["standalter"].tolist(), ["jung", "mittel", "alt", "jung", "mittel", "alt", "alt"])
+        np.testing.assert_array_equal(data["shading_index"], np.where(data["month"] == 9, 0.25, 0.5))
+        np.testing.assert_array_equal(data["rainfall_mm"], np.tile(self.weather["rainfall_mm"], len(self.trees)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import io
+import unittest
+import numpy as np
+import pandas as pd
+from qtrees.db_writer import _encode
+
+
+class TestEncode(unittest.TestCase):
+    def setUp(self):
+        # type_id turned float by a merge with missing rows
+        self.df = pd.DataFrame({"tree_id": ["a", "b", "c"], "type_id": [1.0, np.nan, 3.0], "value": [1.5, 2.0, np.nan],
+                                "note": ["", None, "x"]})
+
+    def test_integer_columns(self):
+        result = _encode(self.df, integer_columns=["type_id", "site_id"])
+        self.assertEqual(result["type_id"].dtype, "Int64")
+        self.assertEqual(result["value"].dtype, np.float64)
+        self.assertIs(_encode(self.df), self.df)
+
+    def test_csv(self):
+        buffer = io.StringIO()
+        _encode(self.df, integer_columns=["type_id"]).to_csv(buffer, index=False, header=False, na_rep="\\N")
+        # COPY with NULL '\\N' reads the unquoted empty field as an empty string
+        self.assertEqual(buffer.getvalue().splitlines(), ["a,1,1.5,", "b,\\N,2.0,\\N", "c,3,\\N,x"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import os
+import gzip
+import datetime
+import tempfile
+import threading
+import unittest
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytz
+from shapely.geometry import Point, box
+from qtrees.dwd import RadolanGridWindow, RadolanFetcher, RadolanStack, get_radolan_url
+
+
+def make_radolan_grid(n=900):
+    """Synthetic lon/lat corners of a slightly rotated n x n grid covering Germany, shaped like wradlib's RADOLAN grid"""
+    rows, cols = np.meshgrid(np.arange(n), np.arange(n), indexing="ij")
+    lon = 3.6 + 0.0135 * cols + 0.0004 * rows
+    lat = 46.95 + 0.009 * rows - 0.0002 * cols
+    return np.stack([lon, lat], axis=-1)
+
+
+def make_radolan_data(n=900, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.gamma(0.5, 2.0, (n, n)).astype(np.float32)
+
+
+def make_mask():
+    """Rough stand-in for the Berlin boundary"""
+    return gpd.GeoDataFrame(geometry=[Point(13.4, 52.5).buffer(0.3)], crs="EPSG:4326")
+
+
+class TestRadolanGridWindow(unittest.TestCase):
+    def setUp(self):
+        # corners at integer lon/lat, cell x, y spans lon y to y + 1 and lat x to x + 1
+        rows, cols = np.meshgrid(np.arange(4), np.arange(4), indexing="ij")
+        self.radolan_grid = np.stack([cols, rows], axis=-1).astype(float)
+        self.radolan_data = np.arange(16, dtype=np.float32).reshape(4, 4)
+
+    def test_cells(self):
+        window = RadolanGridWindow(self.radolan_grid, xmin=1, xmax=4, ymin=0, ymax=3)
+        result = window.to_geodataframe(self.radolan_data)
+        self.assertEqual(list(result.index), [0, 1, 2, 3])
+        self.assertEqual(list(result["rainfall_mm"]), [4., 5., 8., 9.])
+        expected = gpd.GeoSeries([box(0, 1, 1, 2), box(1, 1, 2, 2), box(0, 2, 1, 3), box(1, 2, 2, 3)], index=result.index)
+        self.assertTrue(result.geometry.geom_equals(expected).all())
+        self.assertEqual(result.crs, "EPSG:4326")
+
+    def test_mask(self):
+        mask = gpd.GeoDataFrame(geometry=[box(0.5, 1.5, 0.9, 2.5)], crs="EPSG:4326")
+        window = RadolanGridWindow(self.radolan_grid, xmin=1, xmax=4, ymin=0, ymax=3, mask=mask)
+        self.assertEqual(list(window.tile_ids), [0, 2])
+        self.assertEqual(list(window.values(self.radolan_data)), [4., 8.])
+        self.assertTrue(window.geometry.geom_equals(gpd.GeoSeries([box(0, 1, 1, 2), box(0, 2, 1, 3)], index=[0, 2])).all())
+
+    def test_values(self):
+        window = RadolanGridWindow(make_radolan_grid(), xmin=10, xmax=13, ymin=20, ymax=24)
+        radolan_data = make_radolan_data()
+        self.assertEqual(list(window.tile_ids), list(range(6)))
+        self.assertEqual(window.values(radolan_data)[4], radolan_data[11, 21])
+
+
+class TestRadolanStack(unittest.TestCase):
+    def setUp(self):
+        # hours of two UTC days added out of order, tile 7 has no value on the first day
+        self.hours = [datetime.datetime(2023, 7, 1, 22, 50), datetime.datetime(2023, 7, 2, 0, 50),
+                      datetime.datetime(2023, 7, 1, 23, 50), datetime.datetime(2023, 7, 2, 1, 50)]
+        self.values = [[1., np.nan], [4., 2.], [3., np.nan], [np.nan, 6.]]
+        self.expected = pd.DataFrame({"tile_id": [3, 3, 7, 7],
+                                      "date": [datetime.date(2023, 7, 1), datetime.date(2023, 7, 2)] * 2,
+                                      "rainfall_mm": [2., 4., np.nan, 4.],
+                                      "rainfall_max_mm": [3., 4., np.nan, 6.],
+                                      "rainfall_sum_mm": [4., 4., 0., 8.]})
+
+    def _assert_aggregates(self, stack):
+        for hour, values in zip(self.hours, self.values):
+            stack.add(hour, values)
+        pd.testing.assert_frame_equal(stack.aggregate_daily(), self.expected)
+
+    def test_aggregate_daily(self):
+        self._assert_aggregates(RadolanStack([3, 7], max_hours=6))
+
+    def test_memory_mapped(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stack = RadolanStack([3, 7], max_hours=6, path=os.path.join(tmp_dir, "hourly.npy"))
+            self._assert_aggregates(stack)
+            self.assertIsInstance(stack.values, np.memmap)
+
+
+class CountingHandler(SimpleHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        CountingHandler.requests.append(self.path)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestRadolanFetcher(unittest.TestCase):
+    """Runs the fetcher against a local HTTP server serving fixture files instead of the DWD server"""
+
+    def setUp(self):
+        self.serve_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.hours = [datetime.datetime(2023, 7, 1, 0, 50, tzinfo=pytz.timezone("UTC")) + datetime.timedelta(hours=h)
+                      for h in range(6)]
+        self.contents = {}
+        for i, hour in enumerate(self.hours[:5]):
+            # hours 1 and 3 share the same content
+            content = gzip.compress(f"composite {1 if i == 3 else i}".encode(), mtime=0)
+            file_name = get_radolan_url(hour).rsplit("/", 1)[-1]
+            with open(os.path.join(self.serve_dir.name, file_name), "wb") as f:
+                f.write(content)
+            self.contents[hour] = content
+        CountingHandler.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), partial(CountingHandler, directory=self.serve_dir.name))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.serve_dir.cleanup()
+        self.cache_dir.cleanup()
+
+    def test_fetch(self):
+        fetcher = RadolanFetcher(cache_dir=self.cache_dir.name, max_workers=4, base_url=self.base_url)
+        result = fetcher.fetch(self.hours)
+        self.assertEqual(list(result.keys()), self.hours)
+        for hour in self.hours[:5]:
+            self.assertEqual(result[hour], self.contents[hour])
+        # the last hour is not published yet
+        self.assertIsNone(result[self.hours[5]])
+        self.assertEqual(len(CountingHandler.requests), 6)
+
+    def test_cache(self):
+        RadolanFetcher(cache_dir=self.cache_dir.name, base_url=self.base_url).fetch(self.hours)
+        CountingHandler.requests = []
+        result = RadolanFetcher(cache_dir=self.cache_dir.name, base_url=self.base_url).fetch(self.hours)
+        # only the missing hour is requested again
+        self.assertEqual(len(CountingHandler.requests), 1)
+        self.assertEqual(result[self.hours[3]], self.contents[self.hours[3]])
+        objects = [f for _, _, files in os.walk(os.path.join(self.cache_dir.name, "objects")) for f in files]
+        self.assertEqual(len(objects), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
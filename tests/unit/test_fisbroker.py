@@ -0,0 +1,193 @@
+import os
+import tempfile
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from requests.exceptions import HTTPError
+from qtrees.fisbroker import read_file_batchwise, download_wfs_layer, iter_wfs_layer, WfsDownloader
+from qtrees.geo_cache import GeoParquetCache
+from qtrees.db_writer import _encode
+
+
+def make_trees(n=2500, seed=0):
+    """Synthetic WFS tree layer in EPSG:25833 with a few duplicated ids"""
+    rng = np.random.default_rng(seed)
+    return gpd.GeoDataFrame({
+        "gisid": [f"00008100_{i:06d}" for i in rng.permutation(n)],
+        "baumid": [f"00008100:{i % (n - 100):06d}" for i in range(n)],
+        "art_dtsch": rng.choice(["Linde", "Ahorn", None], n),
+        "pflanzjahr": rng.integers(1900, 2020, n).astype(float),
+    }, geometry=gpd.points_from_xy(rng.uniform(380000, 410000, n), rng.uniform(5810000, 5830000, n)), crs=25833)
+
+
+class TestReadFileBatchwise(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.trees_file = os.path.join(self.tmp_dir.name, "wfs_baumbestand.xml")
+        make_trees().to_file(self.trees_file, driver="GML")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_matches_read_file(self):
+        batches = list(read_file_batchwise(self.trees_file, 1000))
+        self.assertEqual([len(batch) for batch in batches], [1000, 1000, 500])
+        for i, batch in enumerate(batches):
+            expected = gpd.read_file(self.trees_file, rows=slice(1000 * i, 1000 * (i + 1)))
+            self.assertEqual(batch.crs, expected.crs)
+            pd.testing.assert_frame_equal(pd.DataFrame(batch), pd.DataFrame(expected))
+
+    def test_encodes_geometries_for_copy(self):
+        batch = next(read_file_batchwise(self.trees_file, 10)).to_crs(4326)
+        geometries = shapely.from_wkb(_encode(batch)["geometry"].to_numpy())
+        self.assertTrue((shapely.get_srid(geometries) == 4326).all())
+        self.assertTrue(shapely.equals_exact(geometries, batch.geometry.to_numpy(), tolerance=0).all())
+
+
+class WfsHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the FIS-Broker WFS, serving GetFeature requests with startIndex, count and sortBy as GML"""
+    trees = None
+    tmp_dir = None
+    report_hits = True
+    extra_hits = 0
+    # order of unsorted requests changes between requests, as WFS 2.0 allows
+    ignore_sort = False
+    failing_pages = set()
+    requests = []
+
+    def do_GET(self):
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        WfsHandler.requests.append(params)
+        if params.get("resultType") == "hits":
+            matched = f'numberMatched="{len(self.trees) + self.extra_hits}" ' if self.report_hits else ""
+            return self._send(f'<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" {matched}'
+                              f'numberReturned="0"/>'.encode())
+        start, count = int(params["startIndex"]), int(params["count"])
+        if start // count in WfsHandler.failing_pages:
+            WfsHandler.failing_pages.discard(start // count)
+            self.send_response(503)
+            self.end_headers()
+            return
+        trees = self.trees
+        if "sortBy" in params and not self.ignore_sort:
+            trees = trees.sort_values(params["sortBy"].split()[0])
+        else:
+            trees = trees.sample(frac=1, random_state=start)
+        file_path = os.path.join(self.tmp_dir, f"response_{start}_{count}.xml")
+        trees.iloc[start:start + count].to_file(file_path, driver="GML")
+        with open(file_path, "rb") as f:
+            self._send(f.read())
+
+    def _send(self, content):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestWfsDownloader(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        WfsHandler.trees = make_trees(n=1050)
+        WfsHandler.tmp_dir = self.tmp_dir.name
+        WfsHandler.report_hits = True
+        WfsHandler.extra_hits = 0
+        WfsHandler.ignore_sort = False
+        WfsHandler.failing_pages = set()
+        WfsHandler.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), WfsHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/fb/wfs/data/senstadt/s_wfs_baumbestand"
+        self.target_dir = os.path.join(self.tmp_dir.name, "wfs_baumbestand_pages")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def _downloader(self):
+        return WfsDownloader(self.url, "fis:s_wfs_baumbestand", self.target_dir, page_size=200, max_workers=3)
+
+    def _assert_complete(self, paths):
+        gdf = pd.concat([gpd.read_file(path) for path in paths], ignore_index=True)
+        self.assertEqual(list(gdf["gisid"]), sorted(WfsHandler.trees["gisid"]))
+
+    def test_download(self):
+        paths = self._downloader().download()
+        self.assertEqual(len(paths), 6)
+        self._assert_complete(paths)
+        starts = sorted(int(params["startIndex"]) for params in WfsHandler.requests if "startIndex" in params)
+        self.assertEqual(starts, [0, 200, 400, 600, 800, 1000])
+        self.assertTrue(all(params["sortBy"] == "gisid ASC" for params in WfsHandler.requests if "startIndex" in params))
+
+    def test_resumes_after_failure(self):
+        WfsHandler.failing_pages = {2}
+        with self.assertRaises(HTTPError):
+            self._downloader().download()
+        WfsHandler.requests = []
+        paths = self._downloader().download()
+        # only the failed page is requested again
+        self.assertEqual([params.get("startIndex") for params in WfsHandler.requests], [None, "400"])
+        self._assert_complete(paths)
+
+    def test_unknown_size(self):
+        WfsHandler.report_hits = False
+        self._assert_complete(self._downloader().download())
+
+    def test_download_wfs_layer(self):
+        gdf = download_wfs_layer("wfs_baumbestand", self.target_dir, url=self.url, page_size=200, max_workers=3)
+        self.assertEqual(sorted(gdf["baumid"]), sorted(WfsHandler.trees["baumid"]))
+        self.assertFalse(os.path.exists(self.target_dir))
+
+    def test_unstable_order(self):
+        WfsHandler.ignore_sort = True
+        with self.assertRaisesRegex(RuntimeError, "more than once"):
+            download_wfs_layer("wfs_baumbestand", self.target_dir, url=self.url, page_size=200, max_workers=3)
+        self.assertFalse(os.path.exists(self.target_dir))
+
+    def test_cache_page_by_page(self):
+        cache = GeoParquetCache(self.tmp_dir.name)
+        pages = iter_wfs_layer("wfs_baumbestand", self.target_dir, url=self.url, page_size=200, max_workers=3)
+        gdf = gpd.read_parquet(cache.write_batches("wfs_baumbestand", pages))
+        self.assertEqual(list(gdf["gisid"]), sorted(WfsHandler.trees["gisid"]))
+        self.assertEqual(gdf.crs, WfsHandler.trees.crs)
+        WfsHandler.ignore_sort = True
+        with self.assertRaises(RuntimeError):
+            cache.write_batches("wfs_baumbestand", iter_wfs_layer("wfs_baumbestand", self.target_dir, url=self.url,
+                                                                  page_size=200, max_workers=3))
+        pd.testing.assert_frame_equal(cache.read("wfs_baumbestand"), gdf)
+
+    def test_resumes_after_failed_consumer(self):
+        pages = iter_wfs_layer("wfs_baumbestand", self.target_dir, url=self.url, page_size=200, max_workers=3)
+        with self.assertRaises(RuntimeError):
+            for i, _ in enumerate(pages):
+                if i == 2:
+                    raise RuntimeError("DB unavailable")
+        pages.close()
+        files = os.listdir(self.target_dir)
+        self.assertIn("manifest.json", files)
+        self.assertEqual(len([file for file in files if file.startswith("page_") and file.endswith(".xml")]), 6)
+        WfsHandler.requests = []
+        gdf = download_wfs_layer("wfs_baumbestand", self.target_dir, url=self.url, page_size=200, max_workers=3)
+        # only the size of the layer is requested again
+        self.assertEqual([params.get("resultType") for params in WfsHandler.requests], ["hits"])
+        self.assertEqual(list(gdf["gisid"]), sorted(WfsHandler.trees["gisid"]))
+        self.assertFalse(os.path.exists(self.target_dir))
+
+    def test_missing_features(self):
+        WfsHandler.extra_hits = 10
+        with self.assertRaisesRegex(RuntimeError, "the server matched 1060"):
+            download_wfs_layer("wfs_baumbestand", self.target_dir, url=self.url, page_size=200, max_workers=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
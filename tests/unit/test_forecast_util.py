@@ -0,0 +1,126 @@
+import datetime
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from qtrees.forecast_util import WeatherContext, RecursiveForecaster, forecast_depths, predict_depths
+
+FEATURES = ["gattung", "shading_index", "temp_avg_c", "rainfall_mm"]
+WEATHER_COLUMNS = ["temp_avg_c", "rainfall_mm"]
+LAST_DATE = pd.Timestamp("2022-06-30", tz="UTC")
+
+
+def make_weather(history_days=3, horizon=14, seed=0):
+    """WeatherContext filled with random weather instead of loading it from the DB"""
+    rng = np.random.default_rng(seed)
+    weather = WeatherContext(LAST_DATE, WEATHER_COLUMNS, history_days=history_days, horizon=horizon)
+    weather.weather = pd.DataFrame(rng.random((history_days + horizon, len(WEATHER_COLUMNS))) * 20,
+                                   index=weather.dates, columns=WEATHER_COLUMNS)
+    return weather
+
+
+def make_models(lags, seed=0):
+    rng = np.random.default_rng(seed)
+    X = pd.DataFrame(rng.random((300, len(FEATURES))) * 20, columns=FEATURES)
+    autoreg = pd.DataFrame(rng.random((300, len(lags))) * 50, columns=[f"shift_{i}" for i in lags])
+    y = X["rainfall_mm"] * 2 + autoreg.mean(axis=1) + rng.normal(0, 1, 300)
+    aux_model = RandomForestRegressor(n_estimators=10, max_depth=4, random_state=seed).fit(X, y)
+    model = RandomForestRegressor(n_estimators=10, max_depth=4, random_state=seed).fit(pd.concat([X, autoreg], axis=1), y)
+    return model, aux_model
+
+
+def make_base_X(n_trees=25, seed=0):
+    rng = np.random.default_rng(seed)
+    index = pd.Index([f"tree_{i:05d}" for i in range(n_trees)], name="tree_id")
+    return pd.DataFrame({"gattung": rng.integers(0, 5, n_trees).astype(float),
+                         "shading_index": rng.random(n_trees)}, index=index)
+
+
+class LinearModel:
+    """Model with fixed coefficients, so forecasts can be worked out by hand"""
+
+    def __init__(self, coef):
+        self.coef = np.asarray(coef, dtype=float)
+
+    def predict(self, X):
+        return np.asarray(X) @ self.coef
+
+
+class TestWeatherContext(unittest.TestCase):
+    def setUp(self):
+        self.queries = []
+
+    def read_sql(self, engine, sql, params=None, **kwargs):
+        """Answers WEATHER_CONTEXT_QUERY with one row per day, as the DB returns DATE columns"""
+        self.queries.append((sql, params))
+        days = pd.date_range(params["start"] + datetime.timedelta(days=1), params["end"]).date
+        measured = days <= params["last_date"]
+        weather = pd.DataFrame({"date": days, "temp_avg_c": np.where(measured, 20., 25.),
+                                "rainfall_mm": np.arange(len(days), dtype=float)})
+        return weather.set_index(kwargs["index_col"])
+
+    def test_load(self):
+        weather = WeatherContext(LAST_DATE, WEATHER_COLUMNS, history_days=3, horizon=4)
+        with mock.patch("qtrees.forecast_util.read_sql", self.read_sql):
+            weather.load(engine=None)
+        sql, params = self.queries[0]
+        # measurements of the 3 days up to the last date, forecasts of the 4 days after it
+        self.assertEqual(params, dict(tile_id=2, start=datetime.date(2022, 6, 27), last_date=datetime.date(2022, 6, 30),
+                                      end=datetime.date(2022, 7, 4)))
+        self.assertIn("SELECT DISTINCT ON (date) date, temp_avg_c, rainfall_mm", sql)
+        self.assertTrue(weather.weather.index.equals(weather.dates))
+        self.assertEqual(str(weather.weather.index.tz), "UTC")
+        self.assertEqual(weather.get(LAST_DATE)["temp_avg_c"], 20.)
+        self.assertEqual(weather.get("2022-07-01 00:00+00:00")["temp_avg_c"], 25.)
+        self.assertEqual(weather.get(LAST_DATE + pd.Timedelta(days=4))["rainfall_mm"], 6.)
+
+    def test_missing_forecast(self):
+        weather = WeatherContext(LAST_DATE, WEATHER_COLUMNS, history_days=3, horizon=4)
+        read_sql = lambda *args, **kwargs: self.read_sql(*args, **kwargs).iloc[:-1]
+        with mock.patch("qtrees.forecast_util.read_sql", read_sql), self.assertRaises(SystemExit) as exit_code:
+            weather.load(engine=None)
+        self.assertEqual(exit_code.exception.code, 121)
+
+
+class TestRecursiveForecaster(unittest.TestCase):
+    def test_recursion(self):
+        base_X = pd.DataFrame({"gattung": [0., 0.], "shading_index": [1., 2.]}, index=pd.Index(["a", "b"], name="tree_id"))
+        weather = WeatherContext(LAST_DATE, WEATHER_COLUMNS, history_days=2, horizon=3)
+        weather.weather = pd.DataFrame({"temp_avg_c": 0., "rainfall_mm": [10., 20., 1., 2., 3.]}, index=weather.dates)
+        # history: shading_index + rainfall of the last two measured days, i.e. 21, 22 on 06-30 and 11, 12 on 06-29
+        aux_model = LinearModel([0, 1, 0, 1])
+        # forecast: shading_index + rainfall + shift_1 - shift_2
+        model = LinearModel([0, 1, 0, 1, 1, -1])
+        result = RecursiveForecaster(model, aux_model, FEATURES, WEATHER_COLUMNS, lags=[1, 2]).predict(base_X, weather)
+        expected = pd.DataFrame([[12., -6., -14.], [13., -5., -13.]], index=base_X.index,
+                                columns=pd.date_range("2022-07-01", periods=3, tz="UTC", name="timestamp"))
+        pd.testing.assert_frame_equal(result, expected)
+
+    def test_forecast_depths(self):
+        base_X, weather = make_base_X(n_trees=4), make_weather(history_days=7, horizon=5)
+        forecasters = {}
+        for type_id in [1, 2, 3]:
+            model, aux_model = make_models(lags=[1, 7], seed=type_id)
+            forecasters[type_id] = RecursiveForecaster(model, aux_model, FEATURES, WEATHER_COLUMNS, lags=[1, 7])
+        result = forecast_depths(forecasters, base_X, weather)
+        self.assertEqual(list(result.columns), ["type_id", "tree_id", "timestamp", "value"])
+        self.assertEqual(len(result), 4 * 4 * 5)
+        means = result[result.type_id < 4].groupby(["tree_id", "timestamp"])["value"].mean()
+        depth_mean = result[result.type_id == 4].set_index(["tree_id", "timestamp"])["value"]
+        pd.testing.assert_series_equal(depth_mean.sort_index(), means, check_names=False)
+
+
+class TestPredictDepths(unittest.TestCase):
+    def test_depth_mean(self):
+        model, _ = make_models(lags=[1])
+        X = pd.concat([make_base_X(n_trees=3), pd.DataFrame({"temp_avg_c": 10.0, "rainfall_mm": [0.0, 5.0, 10.0],
+                                                            "shift_1": 30.0}, index=make_base_X(n_trees=3).index)], axis=1)
+        X = X[FEATURES + ["shift_1"]]
+        result = predict_depths({1: model, 2: model}, X)
+        self.assertEqual(list(result.columns), ["tree_id", "type_id", "value"])
+        np.testing.assert_allclose(result.loc[result.type_id == 4, "value"], model.predict(X))
+
+
+if __name__ == '__main__':
+    unittest.main()
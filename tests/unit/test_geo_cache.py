@@ -0,0 +1,80 @@
+import os
+import sys
+import datetime
+import tempfile
+import unittest
+import pandas as pd
+import geopandas as gpd
+import pytz
+from qtrees.geo_cache import GeoParquetCache, iter_parquet_batches
+
+sys.path.append(os.path.dirname(__file__))
+from test_fisbroker import make_trees  # noqa: E402
+
+
+class TestGeoParquetCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = GeoParquetCache(self.tmp_dir.name, max_age=datetime.timedelta(days=1))
+        self.trees = make_trees(n=500)
+        self.n_fetches = 0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def fetch(self):
+        self.n_fetches += 1
+        return self.trees
+
+    def test_fetches_once(self):
+        gdf = self.cache.get("wfs_baumbestand", self.fetch)
+        pd.testing.assert_frame_equal(pd.DataFrame(gdf), pd.DataFrame(self.trees))
+        self.assertEqual(gdf.crs, self.trees.crs)
+        self.cache.get("wfs_baumbestand", self.fetch)
+        self.assertEqual(self.n_fetches, 1)
+
+    def test_refetches_stale_layer(self):
+        self.cache.write("wfs_baumbestand", self.trees, timestamp=datetime.datetime.now(pytz.utc) - datetime.timedelta(days=2))
+        self.cache.get("wfs_baumbestand", self.fetch)
+        self.assertEqual(self.n_fetches, 1)
+        # only the new download is kept
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp_dir.name, "wfs_baumbestand"))), 1)
+
+    def test_reads_columns(self):
+        self.cache.write("wfs_baumbestand", self.trees)
+        gdf = self.cache.read("wfs_baumbestand", columns=["baumid"])
+        self.assertEqual(list(gdf.columns), ["baumid", "geometry"])
+        self.assertIsInstance(gdf, gpd.GeoDataFrame)
+
+    def test_batches(self):
+        file_path = self.cache.write("wfs_baumbestand", self.trees)
+        batches = list(iter_parquet_batches(file_path, 200))
+        self.assertEqual([len(batch) for batch in batches], [200, 200, 100])
+        self.assertEqual(batches[0].crs, self.trees.crs)
+        pd.testing.assert_frame_equal(pd.DataFrame(pd.concat(batches, ignore_index=True)), pd.DataFrame(self.trees))
+
+    def test_write_batches(self):
+        # GML pages leave out columns without any value and type columns by their own values
+        batches = [self.trees.iloc[:200], self.trees.iloc[200:400].drop(columns="art_dtsch"),
+                   self.trees.iloc[400:].assign(art_dtsch=None)]
+        file_path = self.cache.write_batches("wfs_baumbestand", iter(batches))
+        self.assertEqual(self.cache.latest("wfs_baumbestand")[1], file_path)
+        gdf = self.cache.read("wfs_baumbestand")
+        expected = pd.concat(batches, ignore_index=True)
+        self.assertEqual(gdf.crs, self.trees.crs)
+        pd.testing.assert_frame_equal(pd.DataFrame(gdf), pd.DataFrame(expected[gdf.columns]), check_dtype=False)
+        self.assertEqual(os.listdir(os.path.dirname(file_path)), [os.path.basename(file_path)])
+
+    def test_write_batches_failure_keeps_cache(self):
+        file_path = self.cache.write("wfs_baumbestand", self.trees, timestamp=datetime.datetime.now(pytz.utc) - datetime.timedelta(days=2))
+
+        def failing_batches():
+            yield self.trees.iloc[:200]
+            raise RuntimeError("download failed")
+        with self.assertRaises(RuntimeError):
+            self.cache.write_batches("wfs_baumbestand", failing_batches())
+        self.assertEqual(os.listdir(os.path.dirname(file_path)), [os.path.basename(file_path)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import pandas as pd
+from qtrees.helper import DBSession
+
+
+class TestDBSession(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.url = "sqlite:///" + os.path.join(self.tmp_dir.name, "qtrees.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_connections_are_returned_to_the_pool(self):
+        with DBSession(url=self.url, pool_size=2, max_overflow=0) as session:
+            with session.begin() as con:
+                con.exec_driver_sql("CREATE TABLE weather (date TEXT, rainfall_mm REAL)")
+                con.exec_driver_sql("INSERT INTO weather VALUES ('2023-07-01', 1.5), ('2023-07-02', 0.5)")
+            # more reads than connections in the pool
+            for _ in range(5):
+                weather = session.read_sql("SELECT * FROM weather WHERE rainfall_mm > ?", params=(1.,))
+            self.assertEqual(weather["rainfall_mm"].tolist(), [1.5])
+            self.assertEqual(session.engine.pool.checkedout(), 0)
+            # pandas adds its own queries to the two statements and five reads
+            self.assertGreaterEqual(session.metrics.count, 7)
+
+    def test_postgres_engine(self):
+        env = {"DB_QTREES": "db.example", "POSTGRES_PASSWD": "secret"}
+        with mock.patch.dict(os.environ, env):
+            session = DBSession(pool_size=3, max_overflow=1, statement_timeout_ms=1000)
+        try:
+            url = session.engine.url
+            self.assertEqual((url.username, url.host, url.port, url.database), ("postgres", "db.example", 5432, "qtrees"))
+            self.assertEqual(session.engine.pool.size(), 3)
+        finally:
+            session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import pickle
+import tempfile
+import unittest
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from qtrees.model_registry import ModelRegistry, get_registry
+
+
+class TestModelRegistry(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.registry = ModelRegistry(path=self.tmp_dir.name)
+        rng = np.random.default_rng(0)
+        self.X = rng.random((50, 3))
+        self.model = RandomForestRegressor(n_estimators=5, random_state=0).fit(self.X, rng.random(50))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_loads_once(self):
+        self.registry.dump(self.model, self.registry.model_path("forecast", 1))
+        model = self.registry.model("forecast", 1)
+        self.assertIs(self.registry.model("forecast", 1), model)
+        np.testing.assert_array_equal(model.predict(self.X), self.model.predict(self.X))
+
+    def test_reads_plain_pickles(self):
+        file_path = self.registry.preprocessor_path("nowcast")
+        os.makedirs(os.path.dirname(file_path))
+        with open(file_path, "wb") as f:
+            pickle.dump({"lags": [1, 2, 3]}, f)
+        self.assertEqual(self.registry.preprocessor("nowcast"), {"lags": [1, 2, 3]})
+
+    def test_memory_maps_arrays(self):
+        file_path = os.path.join(self.tmp_dir.name, "array.m")
+        self.registry.dump(np.arange(10.0), file_path)
+        self.assertIsInstance(self.registry.load(file_path), np.memmap)
+
+    def test_shared_registry(self):
+        self.assertIs(get_registry(self.tmp_dir.name), get_registry(self.tmp_dir.name))
+        self.assertIsNot(get_registry(self.tmp_dir.name), get_registry(self.tmp_dir.name, prefix="test_"))
+
+
+if __name__ == '__main__':
+    unittest.main()
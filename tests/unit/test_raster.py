@@ -0,0 +1,126 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import rasterio
+import cv2
+from functools import partial
+from rasterio.transform import from_origin
+from pyproj import Transformer
+from rasterio.merge import merge
+from qtrees.raster import sample_raster, filter_raster, build_mosaic
+
+
+def make_sun_hours_map(file_path, height=300, width=400, seed=0, data=None):
+    """Synthetic sun hours map in EPSG:25833 with 1m pixels somewhere in Berlin"""
+    if data is None:
+        data = np.random.default_rng(seed).uniform(0, 16, (height, width)).astype(np.float32)
+    height, width = data.shape
+    with rasterio.open(file_path, "w", driver="GTiff", height=height, width=width, count=1, dtype="float32",
+                       crs="EPSG:25833", transform=from_origin(392000.0, 5820000.0, 1.0, 1.0)) as dst:
+        dst.write(data, 1)
+
+
+class TestSampleRaster(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, "172_sunhours_merged.tiff")
+        make_sun_hours_map(self.file_path)
+        rng = np.random.default_rng(1)
+        # mostly inside the map, a few points beyond every border
+        self.x = rng.uniform(391990.0, 392410.0, 500)
+        self.y = rng.uniform(5819690.0, 5820010.0, 500)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_nearest_pixels(self):
+        file_path = os.path.join(self.tmp_dir.name, "small.tiff")
+        make_sun_hours_map(file_path, data=np.arange(12, dtype=np.float32).reshape(3, 4))
+        # pixel centers, points within pixels, and points beyond the borders snapped to the border pixels
+        x = [392000.5, 392001.2, 392003.9, 391995.0, 392010.0, 392002.5]
+        y = [5819999.5, 5819998.8, 5819997.1, 5820010.0, 5819990.0, 5820005.0]
+        np.testing.assert_array_equal(sample_raster(file_path, x, y, block_rows=1), [0., 5., 11., 0., 11., 2.])
+
+    def test_projects_coordinates(self):
+        lon, lat = Transformer.from_crs("EPSG:25833", "EPSG:4326", always_xy=True).transform(self.x, self.y)
+        np.testing.assert_array_equal(sample_raster(self.file_path, lon, lat, crs="EPSG:4326"),
+                                      sample_raster(self.file_path, self.x, self.y))
+
+
+class TestFilterRaster(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, "sunhours_merged.tiff")
+        self.target_path = os.path.join(self.tmp_dir.name, "filtered.tiff")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_box_filter(self):
+        # one pixel on the corner of four blocks and one in the corner of the map
+        data = np.zeros((700, 600), dtype=np.float32)
+        data[256, 256] = 9.
+        data[0, 0] = 9.
+        make_sun_hours_map(self.file_path, data=data)
+        kernel = np.ones((3, 3), np.float32) / 9
+        filter_raster(self.file_path, self.target_path, partial(cv2.filter2D, ddepth=-1, kernel=kernel), halo=1,
+                      block_size=256, workers=3)
+        expected = np.zeros_like(data)
+        expected[255:258, 255:258] = 1.
+        expected[:2, :2] = 1.
+        with rasterio.open(self.target_path) as dst:
+            self.assertEqual(dst.block_shapes[0], (256, 256))
+            self.assertEqual(dst.compression.value, "DEFLATE")
+            np.testing.assert_allclose(dst.read(1), expected, rtol=1e-6)
+
+    def test_matches_whole_map(self):
+        make_sun_hours_map(self.file_path, height=700, width=600)
+        with rasterio.open(self.file_path) as src:
+            data = src.read(1)
+        for kernel_size in [5, 21]:
+            with self.subTest(kernel_size=kernel_size):
+                gaussian_filter = partial(cv2.GaussianBlur, ksize=(kernel_size, kernel_size), sigmaX=0)
+                filter_raster(self.file_path, self.target_path, gaussian_filter, halo=kernel_size // 2, block_size=256,
+                              workers=3)
+                with rasterio.open(self.target_path) as dst:
+                    np.testing.assert_array_equal(dst.read(1), gaussian_filter(data))
+
+
+class TestBuildMosaic(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(2)
+        self.file_paths = []
+        # 3 x 2 overlapping elevation tiles of 300 x 250 pixels with some missing values
+        for i in range(3):
+            for j in range(2):
+                data = rng.uniform(30, 120, (250, 300)).astype(np.float32)
+                data[rng.random(data.shape) < 0.05] = -9999
+                file_path = os.path.join(self.tmp_dir.name, f"tile_{i}_{j}.tiff")
+                with rasterio.open(file_path, "w", driver="GTiff", height=250, width=300, count=1, dtype="float32",
+                                   nodata=-9999, crs="EPSG:25833",
+                                   transform=from_origin(392000.0 + 280 * i, 5820000.0 - 230 * j, 1.0, 1.0)) as dst:
+                    dst.write(data, 1)
+                self.file_paths.append(file_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_matches_merge(self):
+        target_path = os.path.join(self.tmp_dir.name, "merged.tiff")
+        build_mosaic(self.file_paths, target_path, block_size=256, overviews=True)
+        datasets = [rasterio.open(file_path) for file_path in self.file_paths]
+        expected, transform = merge(datasets)
+        for dataset in datasets:
+            dataset.close()
+        with rasterio.open(target_path) as dst:
+            self.assertEqual(dst.transform, transform)
+            self.assertEqual(dst.nodata, -9999)
+            self.assertEqual(dst.block_shapes[0], (256, 256))
+            self.assertTrue(len(dst.overviews(1)) > 0)
+            np.testing.assert_array_equal(dst.read(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import json
+import datetime
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import pandas as pd
+from qtrees.solaranywhere import SolarAnywhereClient, get_weather, aggregate_daily, VARIABLE_MAP, RAINFALL_VARIABLE_MAP, \
+    DAILY_AGGREGATIONS
+
+
+def make_periods(latitude, longitude, start, end):
+    """Deterministic hourly weather data periods of a site as returned by SolarAnywhere"""
+    hours = pd.date_range(pd.Timestamp(start).tz_localize("CET"), pd.Timestamp(end).tz_localize("CET"), freq="H",
+                          inclusive="left")
+    rng = np.random.default_rng(int(latitude * 1000 + longitude * 10))
+    periods = pd.DataFrame({name: rng.uniform(0, 800, len(hours)).round(1)
+                            for name in {**VARIABLE_MAP, **RAINFALL_VARIABLE_MAP}})
+    periods.insert(0, "StartTime", [hour.isoformat() for hour in hours])
+    return periods.to_dict(orient="records")
+
+
+class SolarAnywhereHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the SolarAnywhere API, results are ready after a few polls"""
+    n_pending_polls = 2
+    submitted = []
+    polls = {}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.headers.get("X-Api-Key") != "secret":
+            return self._send({"Message": "Invalid API key"}, status=401)
+        with self.lock:
+            request_id = f"request-{len(self.submitted)}"
+            self.submitted.append(payload)
+            self.polls[request_id] = 0
+        self._send({"WeatherRequestId": request_id})
+
+    def do_GET(self):
+        request_id = self.path.rsplit("/", 1)[-1]
+        with self.lock:
+            self.polls[request_id] += 1
+            if self.polls[request_id] <= self.n_pending_polls:
+                return self._send({"Status": "Pending"})
+            payload = self.submitted[int(request_id.split("-")[1])]
+        start = payload["Options"]["StartTime"][:19]
+        end = payload["Options"]["EndTime"][:19]
+        results = [{"Status": "Success", "WeatherDataPeriods": {
+            "WeatherDataPeriods": make_periods(site["Latitude"], site["Longitude"], start, end)}}
+            for site in payload["Sites"]]
+        self._send({"Status": "Done", "WeatherDataResults": results})
+
+    def _send(self, body, status=200):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestAggregateDaily(unittest.TestCase):
+    def test_aggregations(self):
+        # 22:00 UTC is already the next day in CET
+        hourly = pd.DataFrame([[1, "2023-06-30T21:00:00+00:00", 0., 0., 0., 20., 2., 1.],
+                               [1, "2023-06-30T22:00:00+00:00", 0., 0., 0., 18., 4., .5],
+                               [1, "2023-06-30T23:00:00+00:00", 10., 6., 4., 16., 6., 0.],
+                               [2, "2023-06-30T22:00:00+00:00", 100., 60., 40., 25., 1., 2.]],
+                              columns=["tile_id", "StartTime", *VARIABLE_MAP, *RAINFALL_VARIABLE_MAP])
+        expected = pd.DataFrame([[1, datetime.date(2023, 6, 30), 0., 0., 0., 20., 2., 0., 0., 0., 1., 20., 2.],
+                                 [1, datetime.date(2023, 7, 1), 10., 6., 4., 18., 6., 10., 6., 4., .5, 17., 5.],
+                                 [2, datetime.date(2023, 7, 1), 100., 60., 40., 25., 1., 100., 60., 40., 2., 25., 1.]],
+                                columns=["tile_id", "date", *DAILY_AGGREGATIONS])
+        pd.testing.assert_frame_equal(aggregate_daily(hourly), expected)
+        hindcast = aggregate_daily(hourly.drop(columns=list(RAINFALL_VARIABLE_MAP)), hindcast=True)
+        pd.testing.assert_frame_equal(hindcast, expected.drop(columns="rainfall_mm"))
+
+
+class TestSolarAnywhereClient(unittest.TestCase):
+    def setUp(self):
+        SolarAnywhereHandler.n_pending_polls = 2
+        SolarAnywhereHandler.submitted = []
+        SolarAnywhereHandler.polls = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SolarAnywhereHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/api/v2"
+        start, end = datetime.date(2023, 7, 1), datetime.date(2023, 7, 4)
+        # two tiles are already up to date for the first day
+        self.tiles = pd.DataFrame({"tile_id": [1, 2, 3, 4, 5], "lat": [52.45, 52.55, 52.45, 52.55, 52.65],
+                                   "lng": [13.3, 13.3, 13.4, 13.4, 13.5],
+                                   "start": [start, start, start, start + datetime.timedelta(days=1), start + datetime.timedelta(days=1)],
+                                   "end": end})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_batches_sites(self):
+        client = SolarAnywhereClient("secret", url=self.url, max_sites=2, poll_interval=0.01)
+        result = client.get_weather(self.tiles)
+        # one request per time range and at most two sites
+        self.assertEqual(sorted(len(payload["Sites"]) for payload in SolarAnywhereHandler.submitted), [1, 2, 2])
+        self.assertTrue(all(polls == 3 for polls in SolarAnywhereHandler.polls.values()))
+        for tile in self.tiles.itertuples():
+            # every tile gets the days of its own time range and the data of its own site
+            hourly = pd.DataFrame(make_periods(tile.lat, tile.lng, str(tile.start), str(tile.end))).assign(tile_id=tile.tile_id)
+            actual = result[result["tile_id"] == tile.tile_id].reset_index(drop=True)
+            pd.testing.assert_frame_equal(actual, aggregate_daily(hourly))
+
+    def test_single_site(self):
+        SolarAnywhereHandler.n_pending_polls = 0
+        result = get_weather(52.45, 13.3, "secret", start="2023-07-01", end="2023-07-02", url=self.url)
+        self.assertEqual(list(result["date"]), [datetime.date(2023, 7, 1)])
+
+    def test_invalid_key(self):
+        with self.assertRaises(ValueError):
+            SolarAnywhereClient("wrong", url=self.url).get_weather(self.tiles)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+import numpy as np
+import pandas as pd
+from qtrees.watering_features import add_watering_features, rolling_event_sums
+
+
+class TestRollingEventSums(unittest.TestCase):
+    def test_sums(self):
+        result = rolling_event_sums([0, 0, 0, 1], [0, 3, 9, 3], [1., 2., 4., 8.], [0, 0, 0, 0, 1, 1], [0, 3, 9, 10, 2, 9], window=7)
+        np.testing.assert_array_equal(result, [1., 3., 6., 4., 0., 8.])
+
+
+class TestAddWateringFeatures(unittest.TestCase):
+    def setUp(self):
+        # two short seasons, the window runs from the end of the first into the second one
+        self.dates = pd.DatetimeIndex(["2023-06-01", "2023-06-02", "2023-06-03", "2023-10-01", "2023-10-02"], tz="UTC")
+        self.water_sga = pd.DataFrame({"tree_id": ["a", "a", "a", "a", "a", "b"],
+                                       "date": pd.to_datetime(["2023-06-01", "2023-06-03", "2023-06-03", "2023-07-15",
+                                                               "2023-10-01", "2023-06-02"]).date,
+                                       "amount_liters": [10., 5., 1., 100., 2., 4.]})
+        self.water_gdk = pd.DataFrame({"tree_id": ["b"], "date": pd.to_datetime(["2023-10-02"]).date, "amount_liters": [7.]})
+        # tree c is never watered, 2023-07-15 is outside the calendar
+        self.rows = pd.DataFrame({"tree_id": ["a", "a", "a", "a", "b", "b", "c", "a"],
+                                  "timestamp": pd.to_datetime(["2023-06-01", "2023-06-03", "2023-10-01", "2023-10-02",
+                                                               "2023-06-02", "2023-10-02", "2023-06-02", "2023-07-15"], utc=True),
+                                  "gattung": "TILIA"})
+
+    def test_sums(self):
+        waterings = {"water_sga": self.water_sga, "water_gdk": self.water_gdk}
+        result = add_watering_features(self.rows, waterings, self.dates, window=3)
+        self.assertEqual(list(result.columns), ["tree_id", "timestamp", "gattung", "water_sga", "water_gdk"])
+        np.testing.assert_array_equal(result["water_sga"], [10., 16., 8., 8., 4., 0., np.nan, np.nan])
+        np.testing.assert_array_equal(result["water_gdk"], [0., 0., 0., 0., 0., 7., np.nan, np.nan])
+
+    def test_source_without_waterings(self):
+        waterings = {"water_sga": self.water_sga, "water_gdk": self.water_gdk.iloc[:0]}
+        result = add_watering_features(self.rows, waterings, self.dates, window=3)
+        np.testing.assert_array_equal(result["water_gdk"], [0., 0., 0., 0., 0., 0., np.nan, np.nan])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+from sqlalchemy.engine import make_url
+from qtrees.weather_features import WEATHER_COLUMNS, WeatherFeatureStore, rolling_features
+
+
+def make_weather(n_days=60, seed=0):
+    rng = np.random.default_rng(seed)
+    weather = pd.DataFrame(rng.random((n_days, len(WEATHER_COLUMNS))) * 20, columns=WEATHER_COLUMNS,
+                           index=pd.date_range("2023-05-01", periods=n_days, name="date"))
+    weather.iloc[[3, 20, 21, 22], 1] = np.nan
+    return weather
+
+
+class InMemoryWeatherFeatureStore(WeatherFeatureStore):
+    """Reads the daily weather from a DataFrame instead of the DB"""
+
+    def __init__(self, weather, engine=None, **kwargs):
+        super().__init__(engine=engine, **kwargs)
+        self.weather = weather
+        self.reads = []
+
+    def _read_raw(self, source, since=None):
+        self.reads.append(since)
+        return self.weather if since is None else self.weather.loc[pd.Timestamp(since):]
+
+
+class TestRollingFeatures(unittest.TestCase):
+    def test_sums_and_means(self):
+        raw = pd.DataFrame({"rainfall_mm": [1., np.nan, 2., np.nan, np.nan, np.nan],
+                            "temp_avg_c": [10., 20., np.nan, 40., 50., 60.]},
+                           index=pd.date_range("2023-05-01", periods=6, name="date"))
+        result = rolling_features(raw, window=3)
+        # missing values are skipped, windows without any value stay missing
+        expected = pd.DataFrame({"rainfall_mm": [1., 1., 3., 2., 2., np.nan],
+                                 "temp_avg_c": [10., 15., 15., 30., 45., 50.]}, index=raw.index)
+        pd.testing.assert_frame_equal(result, expected)
+
+
+class TestWeatherFeatureStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.weather = make_weather()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_incremental_matches_full(self):
+        store = InMemoryWeatherFeatureStore(self.weather.iloc[:30], path=self.tmp_dir.name)
+        store.update("public")
+        for end in [31, 45, 60]:
+            store.weather = self.weather.iloc[:end]
+            store.update("public")
+        full = InMemoryWeatherFeatureStore(self.weather, path=tempfile.mkdtemp(dir=self.tmp_dir.name))
+        full.update("public")
+        pd.testing.assert_frame_equal(store.get("public"), full.get("public"), check_exact=True, check_freq=False)
+        # only the refresh window is read again after the first update
+        self.assertIsNone(store.reads[0])
+        self.assertEqual(store.reads[1], pd.Timestamp("2023-05-23").date())
+
+    def test_late_corrections(self):
+        store = InMemoryWeatherFeatureStore(self.weather.iloc[:40], path=self.tmp_dir.name)
+        store.update("public")
+        corrected = self.weather.copy()
+        corrected.iloc[37, 2] = 100.
+        store.weather = corrected
+        store.update("public")
+        result = store.get("public", start="2023-06-05", end="2023-06-10")
+        expected = rolling_features(corrected).loc["2023-06-05":"2023-06-10"]
+        self.assertEqual(list(result.columns), WEATHER_COLUMNS)
+        self.assertEqual(str(result.index.tz), "UTC")
+        np.testing.assert_allclose(result.to_numpy(), expected.to_numpy(), rtol=1e-12)
+
+    def test_get_only_reads_the_stored_features(self):
+        store = InMemoryWeatherFeatureStore(self.weather.iloc[:40], path=self.tmp_dir.name)
+        with self.assertRaises(ValueError):
+            store.get("public")
+        store.update("public")
+        store.weather = self.weather
+        for _ in range(3):
+            result = store.get("public")
+        self.assertEqual(len(store.reads), 1)
+        self.assertEqual(len(result), 40)
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["weather_features_public.parquet"])
+
+    def test_tz_aware_lookup(self):
+        store = InMemoryWeatherFeatureStore(self.weather, path=self.tmp_dir.name)
+        store.update("public")
+        # DataLoader looks up its tz-aware date, midnight in Berlin is still the previous day in UTC
+        result = store.get("public", start=pd.Timestamp("2023-06-05", tz="UTC"), end=pd.Timestamp("2023-06-07 00:00", tz="Europe/Berlin"))
+        self.assertEqual(list(result.index.strftime("%Y-%m-%d")), ["2023-06-05", "2023-06-06"])
+
+    def test_one_history_per_database(self):
+        stores = [InMemoryWeatherFeatureStore(self.weather.iloc[:n], path=self.tmp_dir.name,
+                                              engine=SimpleNamespace(url=make_url(url)))
+                  for n, url in [(40, "postgresql://qtrees@db.example.org:5432/qtrees"),
+                                 (20, "postgresql://postgres:secret@/qtrees_test?host=/tmp/pgdata")]]
+        for store in stores:
+            store.update("public")
+        self.assertEqual([len(store.get("public")) for store in stores], [40, 20])
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), ["db.example.org_5432_qtrees", "tmp_pgdata_5432_qtrees_test"])
+
+    def test_unknown_source(self):
+        with self.assertRaises(ValueError):
+            InMemoryWeatherFeatureStore(self.weather, path=self.tmp_dir.name).update("dwd")
+
+
+if __name__ == '__main__':
+    unittest.main()